@@ -1,26 +1,43 @@
 from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List, Union
 from datetime import datetime
-from rag_query_pipeline import rag_pipeline
-from pymongo import MongoClient
+from rag_query_pipeline import rag_pipeline_async, rag_pipeline_stream, rag_batch, wait_for_session_titles, RAG_BATCH_CONCURRENCY, RAG_BATCH_MAX_CONCURRENCY, HYBRID_SEARCH_ENABLED
+from common.model_client import close_async_client
+from common.hot_index import check_hot_index_dir
+from common.lexical_index import check_lexical_index_dir
+from common.single_flight import SingleFlight
+from common.metrics import render_metrics, stage_timer
+from common.chat_history import get_session, get_turns, list_sessions, CHAT_HISTORY_PAGE_SIZE
 from dotenv import load_dotenv
 from uuid import uuid4
-import os
+import json
 import uvicorn
 
 # ---- Load Environment Variables ----
 load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
-
-# ---- MongoDB Setup ----
-mongo_client = MongoClient(MONGO_URI)
-mongo_db = mongo_client["rag_db"]
-chat_collection = mongo_db["chat_history"]
 
 # ---- FastAPI App ----
 app = FastAPI(title="RAG API", version="1.0")
 
+# Identical /rag requests that arrive while one is running share its result and history write.
+rag_flights = SingleFlight("rag")
+
+
+@app.on_event("startup")
+async def check_shared_index_dirs():
+    # Ingestion writes these indexes; refuse to serve from a directory it cannot see.
+    check_hot_index_dir()
+    if HYBRID_SEARCH_ENABLED:
+        check_lexical_index_dir()
+
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    await wait_for_session_titles()
+    await close_async_client()
+
 # ---- Request Schema for RAG ----
 class RAGRequest(BaseModel):
     user_id: str
@@ -28,6 +45,20 @@ class RAGRequest(BaseModel):
     user_query: str
     type: str  # "file", "folder", or "all"
     file_or_folder_path: Optional[str] = ""
+    deadline_ms: Optional[int] = None  # defaults to RAG_DEADLINE_MS
+
+# ---- Request Schema for Batch RAG ----
+class BatchQuery(BaseModel):
+    id: Optional[str] = None
+    user_query: str
+    type: str = "all"
+    file_or_folder_path: Optional[str] = ""
+
+class BatchRAGRequest(BaseModel):
+    user_id: str
+    queries: List[BatchQuery]
+    top_k: int = 5
+    concurrency: int = Field(RAG_BATCH_CONCURRENCY, ge=1, le=RAG_BATCH_MAX_CONCURRENCY)
 
 # ---- Chat Message Schema ----
 class ChatMessage(BaseModel):
@@ -42,12 +73,18 @@ class RAGResponse(BaseModel):
     file_or_folder: str
     chunks_used: List[str]
     answer: str
+    prompt_tokens: int = 0
+    degradations: List[str] = []
+    cached: bool = False
+    coalesced: bool = False
 
 # ---- Session History Schema ----
 class HistoryResponse(BaseModel):
     session_id: str
     objective: str
     created_at: datetime
+    turn_count: int = 0
+    offset: int = 0
     history: List[ChatMessage]
 
 # ---- Full User History Schema ----
@@ -55,43 +92,88 @@ class SessionHistory(BaseModel):
     session_id: str
     objective: str
     created_at: datetime
+    turn_count: int = 0
     history: List[ChatMessage]
 
 # ---- RAG Endpoint ----
 @app.post("/rag", response_model=Union[RAGResponse, dict])
-def handle_rag_query(payload: RAGRequest):
+async def handle_rag_query(payload: RAGRequest):
     try:
         #  Generate new session ID if not provided or empty
         session_id = payload.session_id.strip() or str(uuid4())
 
-        response = rag_pipeline(
-            user_id=payload.user_id,
-            session_id=session_id,
-            user_query=payload.user_query,
-            type=payload.type,
-            file_or_folder_path=payload.file_or_folder_path or ""
-        )
+        file_or_folder_path = payload.file_or_folder_path or ""
+        key = (payload.user_id, session_id, payload.user_query.strip(), payload.type, file_or_folder_path)
+        with stage_timer("rag"):
+            response, shared = await rag_flights.do(key, lambda: rag_pipeline_async(
+                user_id=payload.user_id,
+                session_id=session_id,
+                user_query=payload.user_query,
+                type=payload.type,
+                file_or_folder_path=file_or_folder_path,
+                deadline_ms=payload.deadline_ms
+            ))
 
         if isinstance(response, dict):
             #  Ensure updated session_id is returned in the response
-            response["session_id"] = session_id
-            return response
+            return {**response, "session_id": session_id, "coalesced": shared}
         else:
             raise HTTPException(status_code=500, detail=response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# ---- Retrieve Specific Session History ----
-@app.get("/session_history", response_model=HistoryResponse)
-def get_chat_history(user_id: str = Query(...), session_id: str = Query(...)):
-    user_doc = chat_collection.find_one({"user_id": user_id})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found.")
+# ---- Streaming RAG Endpoint ----
+@app.post("/rag/stream")
+async def handle_rag_query_stream(payload: RAGRequest):
+    """Server-sent events: `metadata`, then one `token` per LLM delta, then `done` (or `error`)."""
+    session_id = payload.session_id.strip() or str(uuid4())
+
+    async def event_source():
+        with stage_timer("rag_stream"):
+            async for event, data in rag_pipeline_stream(
+                user_id=payload.user_id,
+                session_id=session_id,
+                user_query=payload.user_query,
+                type=payload.type,
+                file_or_folder_path=payload.file_or_folder_path or "",
+                deadline_ms=payload.deadline_ms
+            ):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ---- Batch RAG Endpoint ----
+@app.post("/rag/batch")
+async def handle_rag_batch(payload: BatchRAGRequest):
+    """JSON lines, one result per query in completion order; `index` refers to the request's `queries`."""
+    async def lines():
+        async for result in rag_batch(
+            payload.user_id,
+            [dict(q) for q in payload.queries],
+            top_k=payload.top_k,
+            concurrency=payload.concurrency
+        ):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-    sessions = user_doc.get("sessions", [])
-    session = next((s for s in sessions if s["session_id"] == session_id), None)
 
+# ---- Retrieve Specific Session History ----
+@app.get("/session_history", response_model=HistoryResponse)
+def get_chat_history(
+    user_id: str = Query(...),
+    session_id: str = Query(...),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(CHAT_HISTORY_PAGE_SIZE, ge=1)
+):
+    """One page of a session's turns, oldest first. Page with `offset` up to `turn_count`."""
+    session = get_session(user_id, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found.")
 
@@ -99,18 +181,34 @@ def get_chat_history(user_id: str = Query(...), session_id: str = Query(...)):
         "session_id": session["session_id"],
         "objective": session.get("objective", ""),
         "created_at": session.get("created_at", datetime.utcnow()),
-        "history": session.get("history", [])
+        "turn_count": session.get("turn_count", 0),
+        "offset": offset,
+        "history": get_turns(user_id, session_id, offset, limit)
     }
 
 
 # ---- Retrieve All Sessions for a User ----
 @app.get("/full_history", response_model=List[SessionHistory])
-def get_full_user_history(user_id: str = Query(...)):
-    user_doc = chat_collection.find_one({"user_id": user_id})
-    if not user_doc or not user_doc.get("sessions"):
+def get_full_user_history(
+    user_id: str = Query(...),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1),
+    history_limit: int = Query(CHAT_HISTORY_PAGE_SIZE, ge=0)
+):
+    """One page of sessions, most recent first, each with its last `history_limit` turns."""
+    sessions = list_sessions(user_id, offset, limit, history_limit)
+    if not sessions and offset == 0:
         raise HTTPException(status_code=404, detail="No history found for this user.")
 
-    return user_doc["sessions"]
+    return sessions
+
+
+# ---- Prometheus Metrics ----
+@app.get("/metrics")
+def metrics():
+    """Stage latencies, counters and Celery queue depths in the Prometheus text format."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 # ---- Run the App ----
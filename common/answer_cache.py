@@ -0,0 +1,208 @@
+# answer_cache.py
+"""
+Answer cache for /rag, keyed by (user_id, type, file_or_folder_path, normalized query).
+
+Entries live in an in-process LRU with a TTL, at most
+ANSWER_CACHE_MAX_PER_SCOPE per scope. A lookup can also match a previously
+answered query in the same scope whose embedding is at least
+ANSWER_CACHE_SIMILARITY similar. That search is one matrix product against the
+scope's normalized query embeddings, and only compares embeddings from the same
+embedding version (see common/embedding_versions.py).
+
+Freshness is checked against `rag_db.document_changes`. Ingestion appends one
+record per changed file, with the file's ancestor folders. An entry is stale
+once any change inside its scope is newer than the moment the entry's
+retrieval started.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from common.resources import mongo_db
+from common.scope import normalize_folder, folder_ancestor_metadata
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_MAX_PER_SCOPE = int(os.getenv("ANSWER_CACHE_MAX_PER_SCOPE", "1000"))
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+_changes_indexed = False
+
+
+def _changes_collection():
+    global _changes_indexed
+    changes = mongo_db("rag_db")["document_changes"]
+    if not _changes_indexed:
+        changes.create_index([("user_id", 1), ("changed_at", 1)])
+        changes.create_index([("user_id", 1), ("ancestors", 1), ("changed_at", 1)])
+        # Changes older than the cache TTL can no longer invalidate anything.
+        changes.create_index("changed_at", expireAfterSeconds=int(ANSWER_CACHE_TTL) + 60)
+        _changes_indexed = True
+    return changes
+
+
+def record_document_changes(user_id: str, file_paths: list):
+    """Called by ingestion whenever files are added, modified or deleted."""
+    if not file_paths:
+        return
+    now = datetime.utcnow()
+    _changes_collection().insert_many([{
+        "user_id": user_id,
+        "file_path": path,
+        "ancestors": list(folder_ancestor_metadata(os.path.dirname(path)).values()),
+        "changed_at": now
+    } for path in file_paths])
+
+
+def scope_changed_since(user_id: str, type: str, file_or_folder_path: str, since: datetime) -> bool:
+    query = {"user_id": user_id, "changed_at": {"$gt": since}}
+    if type == "file":
+        query["file_path"] = file_or_folder_path
+    elif type == "folder" and file_or_folder_path:
+        query["ancestors"] = normalize_folder(file_or_folder_path)
+    return _changes_collection().find_one(query, {"_id": 1}) is not None
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.strip().lower()).rstrip("?.! ")
+
+
+def _unit_vector(embedding):
+    import numpy as np
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+class AnswerCache:
+    """Thread-safe LRU of pipeline responses with per-entry expiry."""
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, max_per_scope: int = ANSWER_CACHE_MAX_PER_SCOPE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_per_scope = max_per_scope
+        self._entries = OrderedDict()
+        self._by_scope = {}
+        self._matrices = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scope(user_id, type, file_or_folder_path):
+        return (user_id, type, file_or_folder_path or "")
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._matrices.pop((key[:3], entry["version"]), None)
+            keys = self._by_scope.get(key[:3])
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self._by_scope[key[:3]]
+
+    def _scope_matrix(self, scope, version):
+        """(keys, stacked unit embeddings) of the scope's entries for one embedding version.
+        Rebuilt on the first lookup after the scope changes."""
+        cached = self._matrices.get((scope, version))
+        if cached is None:
+            import numpy as np
+
+            keys = [
+                key for key in self._by_scope.get(scope, ())
+                if self._entries[key]["version"] == version and self._entries[key]["vector"] is not None
+            ]
+            if keys:
+                # One version should mean one model; vectors of another length are skipped.
+                dim = self._entries[keys[-1]]["vector"].shape[0]
+                keys = [key for key in keys if self._entries[key]["vector"].shape[0] == dim]
+            matrix = np.vstack([self._entries[key]["vector"] for key in keys]) if keys else None
+            cached = self._matrices[(scope, version)] = (keys, matrix)
+        return cached
+
+    def get(self, user_id, type, file_or_folder_path, query):
+        """Exact lookup by normalized query. Returns the entry dict or None."""
+        key = self._scope(user_id, type, file_or_folder_path) + (normalize_query(query),)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires"] < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_similar(self, user_id, type, file_or_folder_path, embedding, version: str = ""):
+        """Best entry in the same scope and embedding `version` whose query embedding clears
+        the similarity threshold. CPU-bound for large scopes, so callers on the event loop
+        should run it in a thread."""
+        if not embedding:
+            return None
+        import numpy as np
+
+        query = _unit_vector(embedding)
+        if query is None:
+            return None
+        scope = self._scope(user_id, type, file_or_folder_path)
+        with self._lock:
+            keys, matrix = self._scope_matrix(scope, version)
+        if matrix is None or matrix.shape[1] != query.shape[0]:
+            return None
+        # The matrix is never modified in place, so it can be scanned outside the lock.
+        scores = matrix @ query
+        now = time.monotonic()
+        with self._lock:
+            for i in np.argsort(-scores):
+                if scores[i] < self.similarity:
+                    return None
+                entry = self._entries.get(keys[i])
+                if entry is None:
+                    continue
+                if entry["expires"] < now:
+                    self._drop(keys[i])
+                    continue
+                self._entries.move_to_end(keys[i])
+                return entry
+        return None
+
+    def put(self, user_id, type, file_or_folder_path, query, response, embedding, started_at: datetime,
+            version: str = ""):
+        scope = self._scope(user_id, type, file_or_folder_path)
+        key = scope + (normalize_query(query),)
+        vector = _unit_vector(embedding) if embedding else None
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {
+                "key": key,
+                "response": response,
+                "vector": vector,
+                "version": version,
+                "started_at": started_at,
+                "expires": time.monotonic() + self.ttl
+            }
+            self._matrices.pop((scope, version), None)
+            scope_keys = self._by_scope.setdefault(scope, OrderedDict())
+            scope_keys[key] = None
+            while len(scope_keys) > self.max_per_scope:
+                self._drop(next(iter(scope_keys)))
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, entry):
+        with self._lock:
+            self._drop(entry["key"])
+
+
+answer_cache = AnswerCache()
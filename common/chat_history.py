@@ -0,0 +1,141 @@
+# chat_history.py
+"""
+Chat history in `rag_db`: one `chat_sessions` document per session (objective,
+timestamps, turn count) and one `chat_turns` document per query/answer pair.
+
+Appending a turn touches two small documents instead of rewriting a per-user
+array, the prompt only reads the last CHAT_HISTORY_TURNS turns, and the history
+endpoints page through sessions and turns with indexed, projected queries.
+"""
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, DESCENDING
+
+from common.resources import mongo_db
+
+load_dotenv()
+
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "6"))
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+
+_indexed = False
+
+_SESSION_FIELDS = {"_id": 0, "session_id": 1, "objective": 1, "created_at": 1, "updated_at": 1, "turn_count": 1}
+_TURN_FIELDS = {"_id": 0, "query": 1, "answer": 1}
+
+
+def _collections():
+    global _indexed
+    db = mongo_db("rag_db")
+    sessions, turns = db["chat_sessions"], db["chat_turns"]
+    if not _indexed:
+        sessions.create_index([("user_id", 1), ("session_id", 1)], unique=True)
+        sessions.create_index([("user_id", 1), ("updated_at", DESCENDING)])
+        turns.create_index([("user_id", 1), ("session_id", 1), ("turn", 1)], unique=True)
+        _indexed = True
+    return sessions, turns
+
+
+def page_size(limit) -> int:
+    return max(1, min(limit or CHAT_HISTORY_PAGE_SIZE, CHAT_HISTORY_MAX_PAGE_SIZE))
+
+
+def get_recent_turns(user_id: str, session_id: str, limit: int = CHAT_HISTORY_TURNS) -> list:
+    """The last `limit` turns of a session, oldest first, as [{"query", "answer"}]."""
+    if limit <= 0:
+        return []
+    _, turns = _collections()
+    cursor = turns.find(
+        {"user_id": user_id, "session_id": session_id}, _TURN_FIELDS
+    ).sort("turn", DESCENDING).limit(limit)
+    return list(cursor)[::-1]
+
+
+def append_turn(user_id: str, session_id: str, user_query: str, answer: str, objective: str = "") -> dict:
+    """Stores a turn, creating the session on first use. Returns the session document.
+
+    A new session starts with `objective` as a placeholder title and `title_pending`
+    set, so exactly one caller can later claim it and generate the real title.
+    """
+    sessions, turns = _collections()
+    now = datetime.utcnow()
+    session = sessions.find_one_and_update(
+        {"user_id": user_id, "session_id": session_id},
+        {
+            "$inc": {"turn_count": 1},
+            "$set": {"updated_at": now},
+            "$setOnInsert": {"objective": objective, "title_pending": True, "created_at": now}
+        },
+        projection=_SESSION_FIELDS,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    turns.insert_one({
+        "user_id": user_id,
+        "session_id": session_id,
+        "turn": session["turn_count"],
+        "query": user_query,
+        "answer": answer,
+        "created_at": now
+    })
+    return session
+
+
+def claim_title(user_id: str, session_id: str) -> bool:
+    """True for the one caller that gets to generate this session's title."""
+    sessions, _ = _collections()
+    result = sessions.update_one(
+        {"user_id": user_id, "session_id": session_id, "title_pending": True},
+        {"$set": {"title_pending": False}}
+    )
+    return result.modified_count == 1
+
+
+def set_objective(user_id: str, session_id: str, objective: str):
+    sessions, _ = _collections()
+    sessions.update_one({"user_id": user_id, "session_id": session_id}, {"$set": {"objective": objective}})
+
+
+def get_session(user_id: str, session_id: str):
+    sessions, _ = _collections()
+    return sessions.find_one({"user_id": user_id, "session_id": session_id}, _SESSION_FIELDS)
+
+
+def get_turns(user_id: str, session_id: str, offset: int = 0, limit: int = None) -> list:
+    """One page of a session's turns, oldest first."""
+    _, turns = _collections()
+    cursor = turns.find(
+        {"user_id": user_id, "session_id": session_id}, _TURN_FIELDS
+    ).sort("turn", 1).skip(max(offset, 0)).limit(page_size(limit))
+    return list(cursor)
+
+
+def list_sessions(user_id: str, offset: int = 0, limit: int = None, history_limit: int = 0) -> list:
+    """One page of a user's sessions, most recently active first.
+
+    With `history_limit` > 0 each session carries its last `history_limit` turns,
+    fetched for the whole page in a single aggregation.
+    """
+    sessions, turns = _collections()
+    page = list(
+        sessions.find({"user_id": user_id}, _SESSION_FIELDS)
+        .sort("updated_at", DESCENDING).skip(max(offset, 0)).limit(page_size(limit))
+    )
+    if not page or history_limit <= 0:
+        for session in page:
+            session["history"] = []
+        return page
+
+    recent = turns.aggregate([
+        {"$match": {"user_id": user_id, "session_id": {"$in": [s["session_id"] for s in page]}}},
+        {"$sort": {"session_id": 1, "turn": -1}},
+        {"$group": {"_id": "$session_id", "turns": {"$push": {"query": "$query", "answer": "$answer"}}}},
+        {"$project": {"turns": {"$slice": ["$turns", page_size(history_limit)]}}}
+    ])
+    history = {doc["_id"]: doc["turns"][::-1] for doc in recent}
+    for session in page:
+        session["history"] = history.get(session["session_id"], [])
+    return page
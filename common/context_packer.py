@@ -0,0 +1,87 @@
+# context_packer.py
+"""
+Fits reranked chunks and chat history into the LLM prompt's token budget.
+
+Chunks are taken best-first until the first one that does not fit; it and
+every lower-scoring chunk are dropped. Text repeated between chunks is removed before
+counting: exact or contained duplicates are dropped, and the overlap the
+splitter leaves between neighbouring chunks (up to CHUNK_OVERLAP_CHARS) is
+trimmed. History keeps its most recent turns within its own, smaller budget.
+"""
+import os
+
+from common.tokenizer import count_tokens, MESSAGE_OVERHEAD_TOKENS
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "100"))
+MIN_OVERLAP_CHARS = 20
+CHUNK_SEPARATOR_TOKENS = 2
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of `left` that is also a prefix of `right`."""
+    longest = min(len(left), len(right), CHUNK_OVERLAP_CHARS)
+    for size in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def dedupe_chunks(chunks: list) -> list:
+    """Removes repeated text from chunks in priority order, keeping the earlier copy."""
+    kept = []
+    for chunk in chunks:
+        text = chunk.strip()
+        if not text or any(text in other for other in kept):
+            continue
+        for other in kept:
+            head = _overlap(other, text)
+            if head:
+                text = text[head:].lstrip()
+            tail = _overlap(text, other)
+            if tail:
+                text = text[:-tail].rstrip()
+        # A chunk trimmed down to a sliver adds nothing the kept chunks don't already say.
+        if text and (text == chunk.strip() or len(text) >= MIN_OVERLAP_CHARS):
+            kept.append(text)
+    return kept
+
+
+def pack_context(chunks: list, history: list, fixed_tokens: int = 0,
+                 budget: int = CONTEXT_TOKEN_BUDGET, history_budget: int = HISTORY_TOKEN_BUDGET) -> dict:
+    """Selects chunks (best first) and recent history turns that fit in `budget` prompt tokens.
+
+    `fixed_tokens` is what the prompt costs with no context or history (system prompt,
+    question). Returns {"chunks", "history", "prompt_tokens", "dropped_chunks", "dropped_turns"}.
+    """
+    used = fixed_tokens
+
+    kept_history = []
+    history_used = 0
+    for item in reversed(history):
+        cost = count_tokens(item["query"]) + count_tokens(item["answer"]) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if history_used + cost > min(history_budget, budget - used):
+            break
+        kept_history.append(item)
+        history_used += cost
+    kept_history.reverse()
+    used += history_used
+
+    deduped = dedupe_chunks(chunks)
+    kept_chunks = []
+    for text in deduped:
+        cost = count_tokens(text) + CHUNK_SEPARATOR_TOKENS
+        if used + cost > budget:
+            # Stop here: a smaller chunk further down must not displace a better one that didn't fit.
+            break
+        kept_chunks.append(text)
+        used += cost
+
+    return {
+        "chunks": kept_chunks,
+        "history": kept_history,
+        "prompt_tokens": used,
+        "dropped_chunks": len(chunks) - len(kept_chunks),
+        "dropped_turns": len(history) - len(kept_history)
+    }
@@ -0,0 +1,61 @@
+# deadline.py
+"""
+Per-request time budget for the RAG pipeline.
+
+Required stages (embedding, vector search, LLM) always run. Optional stages
+(summary routing, lexical search, reranking, history) are given whatever is
+left after reserving RAG_LLM_RESERVE_MS for the LLM, and are skipped or cut
+short when that runs out. Each such decision is recorded by name so the
+response can report how it was degraded.
+"""
+import asyncio
+import os
+import time
+
+RAG_DEADLINE_MS = int(os.getenv("RAG_DEADLINE_MS", "0"))  # 0 disables deadlines
+RAG_LLM_RESERVE_MS = int(os.getenv("RAG_LLM_RESERVE_MS", "3000"))
+
+
+class Deadline:
+    def __init__(self, budget_ms: int = None, llm_reserve_ms: int = RAG_LLM_RESERVE_MS):
+        budget_ms = RAG_DEADLINE_MS if budget_ms is None else budget_ms
+        self.expires = time.monotonic() + budget_ms / 1000 if budget_ms and budget_ms > 0 else None
+        self.llm_reserve = llm_reserve_ms / 1000
+        self.degradations = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.expires is not None
+
+    def remaining(self):
+        """Seconds left for the whole request, or None without a deadline."""
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def optional_budget(self):
+        """Seconds optional stages may still use, or None without a deadline."""
+        if self.expires is None:
+            return None
+        return max(0.0, self.remaining() - self.llm_reserve)
+
+    def degrade(self, name: str):
+        if name not in self.degradations:
+            self.degradations.append(name)
+
+    async def run_optional(self, name: str, aw, fallback):
+        """Awaits an optional stage within the optional budget, or returns `fallback`
+        and records `<name>_skipped` / `<name>_timeout`."""
+        budget = self.optional_budget()
+        if budget is not None and budget <= 0:
+            if asyncio.isfuture(aw):
+                aw.cancel()
+            else:
+                aw.close()
+            self.degrade(f"{name}_skipped")
+            return fallback
+        try:
+            return await asyncio.wait_for(aw, timeout=budget)
+        except asyncio.TimeoutError:
+            self.degrade(f"{name}_timeout")
+            return fallback
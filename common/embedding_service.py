@@ -0,0 +1,129 @@
+# embedding_service.py
+"""
+Query embedding service for the API process.
+
+* Exact repeats are answered from an LRU of recent query embeddings
+  (cache_size=0 turns it off).
+* Identical queries already in flight share one pending result.
+* Distinct queries arriving within EMBED_BATCH_WINDOW_MS of each other are
+  sent to the embedding endpoint as a single batched request.
+
+Live /rag queries use INTERACTIVE services with the LRU. Offline batches use
+a BATCH service without it, so they neither spend the interactive reserve of
+the rate limiter nor push live queries out of the cache.
+"""
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+
+from common import model_client
+from common.metrics import CACHE_LOOKUPS
+from common.resilience import ModelCallError
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+QUERY_EMBED_BATCH_SIZE = int(os.getenv("QUERY_EMBED_BATCH_SIZE", "32"))
+
+
+def _consume_exception(future):
+    # Waiters may have gone away; mark the exception as retrieved so asyncio doesn't warn.
+    if not future.cancelled():
+        future.exception()
+
+
+class QueryEmbeddingService:
+    def __init__(self, model: str, input_type: str = "query", cache_size: int = EMBED_CACHE_SIZE,
+                 batch_size: int = QUERY_EMBED_BATCH_SIZE, window_ms: float = EMBED_BATCH_WINDOW_MS,
+                 priority: str = model_client.INTERACTIVE):
+        self.model = model
+        self.input_type = input_type
+        self.priority = priority
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.window = window_ms / 1000
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._loop = None
+        self._in_flight = {}
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    def _cached(self, text):
+        with self._cache_lock:
+            embedding = self._cache.get(text)
+            if embedding is not None:
+                self._cache.move_to_end(text)
+            return embedding
+
+    def _remember(self, text, embedding):
+        with self._cache_lock:
+            self._cache[text] = embedding
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    async def embed(self, text: str) -> list:
+        """Returns the embedding for `text`; raises ModelCallError if the batch call fails."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Futures are bound to their loop (e.g. repeated asyncio.run() in scripts).
+            self._loop, self._in_flight, self._pending, self._flush_handle = loop, {}, [], None
+
+        embedding = self._cached(text) if self.cache_size else None
+        if embedding is not None:
+            CACHE_LOOKUPS.labels(cache="query_embedding", result="hit").inc()
+            return embedding
+
+        future = self._in_flight.get(text)
+        if future is None:
+            if self.cache_size:
+                CACHE_LOOKUPS.labels(cache="query_embedding", result="miss").inc()
+            future = loop.create_future()
+            future.add_done_callback(_consume_exception)
+            self._in_flight[text] = future
+            self._pending.append(text)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.window, self._flush)
+        else:
+            CACHE_LOOKUPS.labels(cache="query_embedding", result="coalesced").inc()
+        # shield: one caller being cancelled must not cancel the result others are waiting on.
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        texts, self._pending = self._pending, []
+        if texts:
+            task = self._loop.create_task(self._run_batch(texts))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, texts):
+        try:
+            res = await model_client.async_post("embed", {
+                "input": texts,
+                "model": self.model,
+                "input_type": self.input_type
+            }, priority=self.priority)
+            data = sorted(res.json()["data"], key=lambda d: d.get("index", 0))
+            for text, item in zip(texts, data):
+                if self.cache_size:
+                    self._remember(text, item["embedding"])
+                future = self._in_flight.get(text)
+                if future is not None and not future.done():
+                    future.set_result(item["embedding"])
+        except Exception as e:
+            for text in texts:
+                future = self._in_flight.get(text)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+        finally:
+            for text in texts:
+                future = self._in_flight.pop(text, None)
+                if future is not None and not future.done():
+                    future.set_exception(ModelCallError("Embedding response was missing an input"))
@@ -0,0 +1,156 @@
+# embedding_versions.py
+"""
+Which embedding model and chunk collection version each user is served from.
+
+`rag_db.embedding_versions` holds one document per user that has been
+re-embedded (see data_ingestion/reembed.py):
+
+* `active`  - {"version", "model"} used by queries and ingestion.
+* `standby` - the shadow version being built, or the previous version kept
+  for rollback. Ingestion writes to it as well, so either side can be made
+  active at any time without losing documents.
+* `reembed` - progress of the re-embedding job for the standby version.
+
+Users without a document are served from the unversioned collections with
+EMBED_MODEL. Swapping and rolling back replace `active` and `standby` in one
+conditional update, so a reader sees either the old or the new pair, never
+a model paired with the other version's vectors. Processes cache the pair for
+EMBED_VERSION_TTL seconds.
+"""
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from common.resources import mongo_db
+
+load_dotenv()
+
+EMBED_MODEL = os.getenv("EMBED_MODEL")
+EMBED_VERSION_TTL = float(os.getenv("EMBED_VERSION_TTL", "15"))
+
+_indexed = False
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _collection():
+    global _indexed
+    versions = mongo_db("rag_db")["embedding_versions"]
+    if not _indexed:
+        versions.create_index("user_id", unique=True)
+        _indexed = True
+    return versions
+
+
+def default_version() -> dict:
+    return {"version": "", "model": EMBED_MODEL}
+
+
+def version_slug(model: str) -> str:
+    """A collection-name-safe version id for a model, e.g. "nvidia/nv-embedqa-e5-v5" -> "nvidia-nv-embedqa-e5-v5"."""
+    return re.sub(r"[^a-z0-9]+", "-", model.lower()).strip("-")[:48]
+
+
+def get_state(user_id: str, fresh: bool = False) -> dict:
+    """{"active", "standby", "reembed"} for the user, cached for EMBED_VERSION_TTL seconds."""
+    now = time.monotonic()
+    if not fresh:
+        with _cache_lock:
+            cached = _cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+    doc = _collection().find_one({"user_id": user_id}, {"_id": 0}) or {}
+    state = {
+        "active": doc.get("active") or default_version(),
+        "standby": doc.get("standby"),
+        "reembed": doc.get("reembed"),
+    }
+    with _cache_lock:
+        _cache[user_id] = (state, now + EMBED_VERSION_TTL)
+    return state
+
+
+def active_version(user_id: str) -> dict:
+    return get_state(user_id)["active"]
+
+
+def write_versions(user_id: str) -> list:
+    """Every version ingestion has to keep current: the active one first, then the standby."""
+    state = get_state(user_id)
+    return [state["active"]] + ([state["standby"]] if state["standby"] else [])
+
+
+def _forget(user_id):
+    with _cache_lock:
+        _cache.pop(user_id, None)
+
+
+def begin_reembed(user_id: str, version: str, model: str) -> dict:
+    """Makes `version` the user's standby and returns its job progress. Re-running with
+    the same version resumes; a different standby has to be retired first."""
+    state = get_state(user_id, fresh=True)
+    target = {"version": version, "model": model}
+    if state["active"]["version"] == version:
+        raise ValueError(f"{user_id} is already served from version '{version}'")
+    if state["standby"] and state["standby"] != target:
+        raise ValueError(
+            f"{user_id} already has standby version '{state['standby']['version']}'. Retire it before re-embedding."
+        )
+    if state["reembed"] and state["reembed"]["version"] == version:
+        return state["reembed"]
+
+    now = datetime.utcnow()
+    reembed = {"version": version, "model": model, "status": "running", "offset": 0,
+               "copied": 0, "total": None, "started_at": now, "updated_at": now}
+    _collection().update_one(
+        {"user_id": user_id},
+        {"$set": {"standby": target, "reembed": reembed},
+         "$setOnInsert": {"active": state["active"]}},
+        upsert=True
+    )
+    _forget(user_id)
+    return reembed
+
+
+def save_progress(user_id: str, **fields):
+    fields["updated_at"] = datetime.utcnow()
+    _collection().update_one({"user_id": user_id}, {"$set": {f"reembed.{k}": v for k, v in fields.items()}})
+
+
+def swap(user_id: str, require_ready: bool = True) -> dict:
+    """Exchanges active and standby in one compare-and-set update. Returns the new active version."""
+    state = get_state(user_id, fresh=True)
+    if not state["standby"]:
+        raise ValueError(f"{user_id} has no standby version to swap to")
+    if require_ready and (not state["reembed"] or state["reembed"]["status"] != "ready"
+                          or state["reembed"]["version"] != state["standby"]["version"]):
+        raise ValueError(f"Re-embedding of '{state['standby']['version']}' for {user_id} has not finished")
+    result = _collection().update_one(
+        {"user_id": user_id, "active": state["active"], "standby": state["standby"]},
+        {"$set": {"active": state["standby"], "standby": state["active"]}}
+    )
+    if result.modified_count != 1:
+        raise RuntimeError(f"Versions of {user_id} changed during the swap; try again")
+    _forget(user_id)
+    return state["standby"]
+
+
+def retire_standby(user_id: str):
+    """Stops writing to the standby version and returns it so its data can be dropped."""
+    state = get_state(user_id, fresh=True)
+    if not state["standby"]:
+        return None
+    _collection().update_one(
+        {"user_id": user_id, "standby": state["standby"]},
+        {"$set": {"standby": None, "reembed": None}}
+    )
+    _forget(user_id)
+    return state["standby"]
+
+
+def list_states() -> list:
+    return list(_collection().find({}, {"_id": 0}).sort("user_id", 1))
@@ -0,0 +1,391 @@
+# hot_index.py
+"""
+In-process vector index for hot tenants (HOT_INDEX_USERS), read from memory-mapped
+files so every uvicorn worker on the host shares the same pages.
+
+Each user's directory under HOT_INDEX_DIR holds:
+
+* `vectors.<gen>.bin` - (capacity, dim) matrix of chunk embeddings (HOT_INDEX_DTYPE)
+* `norms.<gen>.bin`, `live.<gen>.bin`, `files.<gen>.bin` - per-row squared norm,
+  live flag and file id, so scope masks and distances are vectorized
+* `rows.sqlite3` - chunk id and text per (generation, row), plus the file table
+* `state.json` - dim, dtype, used row count, capacity and file generation
+
+Ingestion is the only writer (serialized by a lock file). It appends rows, marks
+replaced or deleted rows dead, and rewrites the files under a new generation when
+they must grow or are mostly dead. Readers notice a new state.json and remap.
+Distances are squared L2, like the Chroma collections.
+
+The ingestion workers write the index and the API reads it, so HOT_INDEX_DIR
+must be an absolute path on storage every worker and API host shares. It is
+required whenever HOT_INDEX_USERS is set; check_hot_index_dir() fails fast at
+startup otherwise.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+
+from common.scope import normalize_folder
+
+HOT_INDEX_DIR = os.getenv("HOT_INDEX_DIR")
+HOT_INDEX_USERS = {u.strip() for u in os.getenv("HOT_INDEX_USERS", "").split(",") if u.strip()}
+HOT_INDEX_DTYPE = os.getenv("HOT_INDEX_DTYPE", "float32")  # or "float16"
+HOT_INDEX_INITIAL_CAPACITY = 4096
+HOT_INDEX_BLOCK_ROWS = 65536
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    file_path TEXT UNIQUE NOT NULL,
+    folder_path TEXT NOT NULL,
+    uuid TEXT
+);
+CREATE INDEX IF NOT EXISTS files_folder_path ON files(folder_path);
+CREATE INDEX IF NOT EXISTS files_uuid ON files(uuid);
+CREATE TABLE IF NOT EXISTS rows (
+    gen INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    chunk_id TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (gen, row),
+    UNIQUE (gen, chunk_id)
+);
+CREATE INDEX IF NOT EXISTS rows_file_id ON rows(gen, file_id);
+"""
+
+
+def hot_index_dir() -> Path:
+    """HOT_INDEX_DIR, which must be an absolute path shared by the ingestion workers and the API."""
+    if not HOT_INDEX_DIR or not os.path.isabs(HOT_INDEX_DIR):
+        raise RuntimeError(
+            f"HOT_INDEX_DIR must be an absolute path on storage shared by the ingestion workers "
+            f"and the API (got {HOT_INDEX_DIR!r})"
+        )
+    return Path(HOT_INDEX_DIR)
+
+
+def check_hot_index_dir():
+    """Raises at startup when hot tenants are configured without a usable HOT_INDEX_DIR."""
+    if HOT_INDEX_USERS:
+        hot_index_dir()
+
+
+class HotIndex:
+    def __init__(self, user_id: str, index_dir: Path = None, dtype: str = HOT_INDEX_DTYPE,
+                 version: str = ""):
+        import numpy as np
+
+        self.user_id = user_id
+        self.dir = Path(index_dir or hot_index_dir()) / (f"{user_id}__{version}" if version else user_id)
+        self.dtype = np.dtype(dtype)
+        self._local = threading.local()
+        self._map_lock = threading.Lock()
+        self._state_mtime = None
+        self._state = None
+        self._maps = None
+
+    # ---- Files and state ----
+    def exists(self) -> bool:
+        return (self.dir / "state.json").exists()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.dir / "rows.sqlite3", timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _read_state(self):
+        with open(self.dir / "state.json") as f:
+            return json.load(f)
+
+    def _write_state(self, state):
+        tmp = self.dir / "state.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.dir / "state.json")
+
+    def _open_maps(self, state, mode):
+        import numpy as np
+
+        gen, capacity, dim = state["generation"], state["capacity"], state["dim"]
+        dtype = np.dtype(state["dtype"])
+        return {
+            "vectors": np.memmap(self.dir / f"vectors.{gen}.bin", dtype=dtype, mode=mode, shape=(capacity, dim)),
+            "norms": np.memmap(self.dir / f"norms.{gen}.bin", dtype=np.float32, mode=mode, shape=(capacity,)),
+            "live": np.memmap(self.dir / f"live.{gen}.bin", dtype=np.uint8, mode=mode, shape=(capacity,)),
+            "files": np.memmap(self.dir / f"files.{gen}.bin", dtype=np.int32, mode=mode, shape=(capacity,))
+        }
+
+    def _reader_maps(self):
+        """Current (state, maps) for searching, remapped when a writer published a new state."""
+        path = self.dir / "state.json"
+        mtime = path.stat().st_mtime_ns
+        with self._map_lock:
+            if mtime != self._state_mtime:
+                state = self._read_state()
+                if self._state is None or state["generation"] != self._state["generation"]:
+                    self._maps = self._open_maps(state, "r")
+                self._state, self._state_mtime = state, mtime
+            return self._state, self._maps
+
+    @contextmanager
+    def _writer(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.dir / "write.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _grow(self, state, maps, needed):
+        """Copies live rows into files of a new generation with room for `needed` more rows.
+
+        Readers keep using the old generation until the new state is published.
+        """
+        import numpy as np
+
+        conn = self._conn()
+        old_gen = state["generation"]
+        live_rows = np.flatnonzero(maps["live"][:state["count"]]) if maps else np.array([], dtype=np.int64)
+        capacity = HOT_INDEX_INITIAL_CAPACITY
+        while capacity < (len(live_rows) + needed) * 1.25:
+            capacity *= 2
+        new_state = {**state, "generation": old_gen + 1, "capacity": capacity, "count": len(live_rows)}
+        new_maps = self._open_maps(new_state, "w+")
+        if len(live_rows):
+            for name in new_maps:
+                new_maps[name][:len(live_rows)] = maps[name][live_rows]
+            with conn:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS remap (old INTEGER PRIMARY KEY, new INTEGER)")
+                conn.execute("DELETE FROM remap")
+                conn.executemany("INSERT INTO remap VALUES (?, ?)",
+                                 ((int(old), new) for new, old in enumerate(live_rows)))
+                conn.execute(
+                    "INSERT INTO rows (gen, row, chunk_id, file_id, text) "
+                    "SELECT ?, remap.new, rows.chunk_id, rows.file_id, rows.text "
+                    "FROM rows JOIN remap ON remap.old = rows.row WHERE rows.gen = ?",
+                    (new_state["generation"], old_gen)
+                )
+        for m in new_maps.values():
+            m.flush()
+        return new_state, new_maps
+
+    def _publish(self, state, old_gen):
+        """Makes `state` visible to readers and drops an older generation it replaced."""
+        self._write_state(state)
+        if state["generation"] != old_gen:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM rows WHERE gen = ?", (old_gen,))
+            for name in ("vectors", "norms", "live", "files"):
+                # Readers that still map the old files keep them alive until they remap.
+                (self.dir / f"{name}.{old_gen}.bin").unlink(missing_ok=True)
+
+    # ---- Writes (ingestion) ----
+    def _file_ids(self, conn, metadatas):
+        ids = {}
+        for meta in metadatas:
+            path = meta.get("file_path", "")
+            if path in ids:
+                continue
+            conn.execute(
+                "INSERT INTO files (file_path, folder_path, uuid) VALUES (?, ?, ?) "
+                "ON CONFLICT(file_path) DO UPDATE SET folder_path = excluded.folder_path, uuid = excluded.uuid",
+                (path, normalize_folder(meta.get("folder_path") or str(PurePosixPath(path).parent)), meta.get("uuid"))
+            )
+            ids[path] = conn.execute("SELECT id FROM files WHERE file_path = ?", (path,)).fetchone()[0]
+        return ids
+
+    def upsert(self, ids: list, embeddings: list, documents: list, metadatas: list):
+        """Adds or replaces chunks by their Chroma ids."""
+        import numpy as np
+
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._writer():
+            conn = self._conn()
+            if self.exists():
+                state = self._read_state()
+                maps = self._open_maps(state, "r+")
+            else:
+                state = {"dim": vectors.shape[1], "dtype": self.dtype.name, "count": 0, "capacity": 0, "generation": 0}
+                maps = None
+            if vectors.shape[1] != state["dim"]:
+                raise ValueError(f"Hot index for {self.user_id} has dim {state['dim']}, got {vectors.shape[1]}")
+            old_gen = state["generation"]
+
+            with conn:
+                replaced = []
+                for start in range(0, len(ids), 500):
+                    batch = ids[start:start + 500]
+                    marks = ",".join("?" * len(batch))
+                    replaced += [r[0] for r in conn.execute(
+                        f"SELECT row FROM rows WHERE gen = ? AND chunk_id IN ({marks})", [old_gen, *batch]
+                    )]
+                    conn.execute(f"DELETE FROM rows WHERE gen = ? AND chunk_id IN ({marks})", [old_gen, *batch])
+                if replaced and maps is not None:
+                    maps["live"][replaced] = 0
+                file_ids = self._file_ids(conn, metadatas)
+
+            if maps is None or state["count"] + len(ids) > state["capacity"]:
+                state, maps = self._grow(state, maps, len(ids))
+
+            first = state["count"]
+            rows = range(first, first + len(ids))
+            maps["vectors"][first:first + len(ids)] = vectors.astype(self.dtype)
+            maps["norms"][first:first + len(ids)] = np.einsum("ij,ij->i", vectors, vectors)
+            maps["files"][first:first + len(ids)] = [file_ids[m.get("file_path", "")] for m in metadatas]
+            maps["live"][first:first + len(ids)] = 1
+            with conn:
+                conn.executemany(
+                    "INSERT INTO rows (gen, row, chunk_id, file_id, text) VALUES (?, ?, ?, ?, ?)",
+                    ((state["generation"], row, chunk_id, file_ids[meta.get("file_path", "")], text)
+                     for row, chunk_id, text, meta in zip(rows, ids, documents, metadatas))
+                )
+            for m in maps.values():
+                m.flush()
+            state["count"] = first + len(ids)
+            self._publish(state, old_gen)
+
+    def _delete_rows(self, select_sql, delete_sql, keys, after=None):
+        """Marks rows matching `keys` dead, in slices of 500 keys per statement."""
+        if not self.exists():
+            return
+        with self._writer():
+            conn = self._conn()
+            state = self._read_state()
+            old_gen = state["generation"]
+            maps = self._open_maps(state, "r+")
+            with conn:
+                rows = []
+                for start in range(0, len(keys), 500):
+                    batch = list(keys[start:start + 500])
+                    marks = ",".join("?" * len(batch))
+                    rows += [r[0] for r in conn.execute(select_sql.format(marks=marks), [old_gen, *batch])]
+                    conn.execute(delete_sql.format(marks=marks), [old_gen, *batch])
+                    if after:
+                        conn.execute(after.format(marks=marks), batch)
+            if rows:
+                maps["live"][rows] = 0
+                maps["live"].flush()
+            live = int(maps["live"][:state["count"]].sum())
+            # Compact once most rows are dead, so searches don't scan garbage.
+            if state["count"] > HOT_INDEX_INITIAL_CAPACITY and live < state["count"] / 2:
+                state, maps = self._grow(state, maps, 0)
+            self._publish(state, old_gen)
+
+    def delete_files(self, file_paths: list):
+        in_files = "file_id IN (SELECT id FROM files WHERE file_path IN ({marks}))"
+        self._delete_rows(
+            f"SELECT row FROM rows WHERE gen = ? AND {in_files}",
+            f"DELETE FROM rows WHERE gen = ? AND {in_files}",
+            file_paths,
+            after="DELETE FROM files WHERE file_path IN ({marks})"
+        )
+
+    def delete_ids(self, ids: list):
+        self._delete_rows(
+            "SELECT row FROM rows WHERE gen = ? AND chunk_id IN ({marks})",
+            "DELETE FROM rows WHERE gen = ? AND chunk_id IN ({marks})",
+            ids
+        )
+
+    def drop(self):
+        """Removes the index files, e.g. when its embedding version is retired."""
+        with self._writer():
+            for path in self.dir.iterdir():
+                if path.name != "write.lock":
+                    path.unlink()
+        self._local = threading.local()
+        self._state_mtime = self._state = self._maps = None
+
+    # ---- Reads (query path) ----
+    def _scope_file_ids(self, type, file_or_folder_path, uuids):
+        conn = self._conn()
+        if uuids:
+            marks = ",".join("?" * len(uuids))
+            return [r[0] for r in conn.execute(f"SELECT id FROM files WHERE uuid IN ({marks})", list(uuids))]
+        if type == "file":
+            return [r[0] for r in conn.execute("SELECT id FROM files WHERE file_path = ?", (file_or_folder_path,))]
+        if type == "folder" and file_or_folder_path:
+            folder = normalize_folder(file_or_folder_path)
+            prefix = folder.rstrip("/") + "/"
+            return [r[0] for r in conn.execute(
+                "SELECT id FROM files WHERE folder_path = ? OR substr(folder_path, 1, ?) = ?",
+                (folder, len(prefix), prefix)
+            )]
+        return None
+
+    def search_many(self, query_embeddings: list, n_results: int, type: str = "all",
+                    file_or_folder_path: str = "", uuids: list = None) -> list:
+        """Returns one [(chunk_id, text, distance)] list per query, nearest first."""
+        import numpy as np
+
+        state, maps = self._reader_maps()
+        count = state["count"]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if count == 0:
+            return [[] for _ in queries]
+
+        mask = maps["live"][:count].astype(bool)
+        scope = self._scope_file_ids(type, file_or_folder_path, uuids)
+        if scope is not None:
+            mask &= np.isin(maps["files"][:count], scope)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return [[] for _ in queries]
+
+        # Squared L2: |v|^2 - 2 v.q + |q|^2, computed in blocks to bound float32 temporaries.
+        dots = np.empty((len(queries), len(candidates)), dtype=np.float32)
+        for start in range(0, len(candidates), HOT_INDEX_BLOCK_ROWS):
+            block = candidates[start:start + HOT_INDEX_BLOCK_ROWS]
+            if len(block) == block[-1] - block[0] + 1:
+                vectors = maps["vectors"][block[0]:block[-1] + 1]
+            else:
+                vectors = maps["vectors"][block]
+            dots[:, start:start + len(block)] = queries @ vectors.astype(np.float32, copy=False).T
+        distances = maps["norms"][candidates][None, :] - 2 * dots + np.einsum("ij,ij->i", queries, queries)[:, None]
+        np.maximum(distances, 0, out=distances)
+
+        k = min(n_results, len(candidates))
+        results = []
+        conn = self._conn()
+        for row_distances in distances:
+            top = np.argpartition(row_distances, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+            top = top[np.argsort(row_distances[top])]
+            rows = [int(r) for r in candidates[top]]
+            marks = ",".join("?" * len(rows))
+            found = {r: (cid, text) for r, cid, text in conn.execute(
+                f"SELECT row, chunk_id, text FROM rows WHERE gen = ? AND row IN ({marks})", [state["generation"], *rows]
+            )}
+            results.append([
+                (found[r][0], found[r][1], float(d))
+                for r, d in zip(rows, row_distances[top]) if r in found
+            ])
+        return results
+
+    def search(self, query_embedding, n_results: int, type: str = "all",
+               file_or_folder_path: str = "", uuids: list = None) -> list:
+        return self.search_many([query_embedding], n_results, type, file_or_folder_path, uuids)[0]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_hot_index(user_id: str, version: str = ""):
+    """The user's HotIndex for an embedding version, or None when the user is not a hot tenant."""
+    if user_id not in HOT_INDEX_USERS:
+        return None
+    with _indexes_lock:
+        if (user_id, version) not in _indexes:
+            _indexes[(user_id, version)] = HotIndex(user_id, version=version)
+        return _indexes[(user_id, version)]
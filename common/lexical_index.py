@@ -0,0 +1,150 @@
+# lexical_index.py
+"""
+Per-user lexical (BM25) index over chunk text, kept next to the vector store
+so exact strings such as case citations ("2009 SCC OnLine ITAT 1081") can be
+found even when dense retrieval misses them.
+
+Each user gets a SQLite FTS5 database under LEXICAL_INDEX_DIR. FTS5 ranks
+with BM25 and supports incremental inserts and deletes, so ingestion keeps
+the index current chunk by chunk and queries never trigger a rebuild. A side
+table maps Chroma chunk ids and file paths to FTS rowids, which makes deletes
+by file an indexed lookup.
+
+The ingestion workers write the index and the API reads it, so LEXICAL_INDEX_DIR
+must be an absolute path on storage every worker and API host shares;
+check_lexical_index_dir() fails fast at startup otherwise.
+"""
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+from common.scope import normalize_folder
+
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR")
+LEXICAL_MAX_QUERY_TERMS = 32
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text USING fts5(text, tokenize = 'unicode61');
+CREATE TABLE IF NOT EXISTS chunk_map (
+    rowid INTEGER PRIMARY KEY,
+    chunk_id TEXT UNIQUE NOT NULL,
+    file_path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_map_file_path ON chunk_map(file_path);
+"""
+
+
+def _fts_query(query: str) -> str:
+    """Turns free text into an FTS5 OR-query of quoted terms, so user input is never parsed as syntax."""
+    terms = re.findall(r"\w+", query.lower())[:LEXICAL_MAX_QUERY_TERMS]
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+
+
+def check_lexical_index_dir() -> Path:
+    """LEXICAL_INDEX_DIR, which must be an absolute path shared by the ingestion workers and the API."""
+    if not LEXICAL_INDEX_DIR or not os.path.isabs(LEXICAL_INDEX_DIR):
+        raise RuntimeError(
+            f"LEXICAL_INDEX_DIR must be an absolute path on storage shared by the ingestion workers "
+            f"and the API (got {LEXICAL_INDEX_DIR!r})"
+        )
+    return Path(LEXICAL_INDEX_DIR)
+
+
+class LexicalIndex:
+    def __init__(self, user_id: str, index_dir: Path = None):
+        self.path = Path(index_dir or check_lexical_index_dir()) / f"{user_id}.sqlite3"
+        self._local = threading.local()
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _delete_rowids(self, conn, rowids):
+        for start in range(0, len(rowids), 500):
+            batch = rowids[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            conn.execute(f"DELETE FROM chunk_text WHERE rowid IN ({marks})", batch)
+            conn.execute(f"DELETE FROM chunk_map WHERE rowid IN ({marks})", batch)
+
+    def upsert_chunks(self, ids: list, documents: list, metadatas: list):
+        """Adds or replaces chunks by their Chroma ids."""
+        conn = self._conn()
+        with conn:
+            existing = []
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                existing += [r[0] for r in conn.execute(
+                    f"SELECT rowid FROM chunk_map WHERE chunk_id IN ({','.join('?' * len(batch))})", batch
+                )]
+            self._delete_rowids(conn, existing)
+            for chunk_id, text, meta in zip(ids, documents, metadatas):
+                cur = conn.execute(
+                    "INSERT INTO chunk_map (chunk_id, file_path) VALUES (?, ?)",
+                    (chunk_id, meta.get("file_path", ""))
+                )
+                conn.execute("INSERT INTO chunk_text (rowid, text) VALUES (?, ?)", (cur.lastrowid, text))
+
+    def delete_files(self, file_paths: list):
+        conn = self._conn()
+        with conn:
+            rowids = []
+            for start in range(0, len(file_paths), 500):
+                batch = list(file_paths[start:start + 500])
+                rowids += [r[0] for r in conn.execute(
+                    f"SELECT rowid FROM chunk_map WHERE file_path IN ({','.join('?' * len(batch))})", batch
+                )]
+            self._delete_rowids(conn, rowids)
+
+    def search(self, query: str, type: str = "all", file_or_folder_path: str = "", limit: int = 50) -> list:
+        """Returns up to `limit` (chunk_id, text, file_path, bm25) tuples, best first."""
+        match = _fts_query(query)
+        if not match:
+            return []
+        sql = (
+            "SELECT m.chunk_id, t.text, m.file_path, bm25(chunk_text) AS score "
+            "FROM chunk_text t JOIN chunk_map m ON m.rowid = t.rowid "
+            "WHERE chunk_text MATCH ?"
+        )
+        params = [match]
+        if type == "file":
+            sql += " AND m.file_path = ?"
+            params.append(file_or_folder_path)
+        elif type == "folder" and file_or_folder_path:
+            sql += " AND substr(m.file_path, 1, ?) = ?"
+            prefix = normalize_folder(file_or_folder_path).rstrip("/") + "/"
+            params += [len(prefix), prefix]
+        # FTS5's bm25() is lower-is-better.
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        return self._conn().execute(sql, params).fetchall()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(user_id: str) -> LexicalIndex:
+    with _indexes_lock:
+        if user_id not in _indexes:
+            _indexes[user_id] = LexicalIndex(user_id)
+        return _indexes[user_id]
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """Fuses ranked lists of ids into one list ordered by sum of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
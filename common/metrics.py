@@ -0,0 +1,238 @@
+# metrics.py
+"""
+Prometheus metrics for the API and the Celery workers.
+
+* `idp_stage_seconds{stage}` - latency of each pipeline stage: `scan`, `hash`,
+  `convert`, `render`, `extract` (one document), `vlm_page`, `llm`,
+  `llm_first_token`, `embed_batch`, `rerank`, `chroma_write`, `chroma_query`,
+  `hot_index_query`, `ingest` (one file), `rag` and `rag_stream`.
+* `idp_mongo_seconds{command}` - every MongoDB command, timed by a listener on
+  the shared client (see common/resources.py).
+* `idp_pages_total{format}`, `idp_chunks_total{operation}`,
+  `idp_tokens_total{kind}` and `idp_cache_lookups_total{cache,result}`.
+* `idp_queue_depth{queue}` - messages waiting in each Celery queue, read from
+  the broker when /metrics is scraped (at most every QUEUE_DEPTH_TTL seconds).
+
+The API serves everything at `/metrics`. With several uvicorn workers, set
+PROMETHEUS_MULTIPROC_DIR so the endpoint aggregates all of them. Celery worker
+processes export their own metrics every METRICS_EXPORT_INTERVAL seconds, to
+METRICS_PUSHGATEWAY_URL and/or as node_exporter textfiles in
+METRICS_TEXTFILE_DIR, labelled `worker="<host>:<pid>"`.
+"""
+import os
+import socket
+import threading
+import time
+
+from dotenv import load_dotenv
+from prometheus_client import (
+    REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+    delete_from_gateway, generate_latest, push_to_gateway, write_to_textfile
+)
+from prometheus_client.core import GaugeMetricFamily, Metric
+
+load_dotenv()
+
+BROKER_URL = os.getenv("BROKER_URL")
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_PUSHGATEWAY_URL = os.getenv("METRICS_PUSHGATEWAY_URL")
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "15"))
+METRICS_QUEUES = [q for q in os.getenv("METRICS_QUEUES", "text_extraction_queue,data_ingestion_queue").split(",") if q]
+QUEUE_DEPTH_TTL = float(os.getenv("QUEUE_DEPTH_TTL", "10"))
+
+# From a 5 ms Chroma query up to a five-minute VLM page or document.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_SECONDS = Histogram("idp_stage_seconds", "Latency of a pipeline stage.", ["stage"], buckets=STAGE_BUCKETS)
+MONGO_SECONDS = Histogram("idp_mongo_seconds", "Latency of MongoDB commands.", ["command"], buckets=STAGE_BUCKETS)
+PAGES = Counter("idp_pages_total", "Pages (sheets for spreadsheets) extracted from documents.", ["format"])
+CHUNKS = Counter("idp_chunks_total", "Chunks written to or deleted from the vector store.", ["operation"])
+TOKENS = Counter("idp_tokens_total", "Tokens sent to or returned by the models.", ["kind"])
+CACHE_LOOKUPS = Counter("idp_cache_lookups_total", "Cache lookups by cache and result.", ["cache", "result"])
+
+
+# ---- Recording ----
+def stage_timer(stage: str):
+    """Context manager (or decorator for sync functions) timing a block into idp_stage_seconds."""
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+
+def record_cache(cache: str, hits: int = 0, misses: int = 0):
+    if hits:
+        CACHE_LOOKUPS.labels(cache=cache, result="hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache=cache, result="miss").inc(misses)
+
+
+def record_llm_usage(body: dict):
+    """Counts prompt and completion tokens from an OpenAI-compatible response body."""
+    usage = body.get("usage") or {}
+    TOKENS.labels(kind="prompt").inc(usage.get("prompt_tokens") or 0)
+    TOKENS.labels(kind="completion").inc(usage.get("completion_tokens") or 0)
+
+
+def mongo_listener():
+    """A pymongo CommandListener that times every command into idp_mongo_seconds."""
+    from pymongo import monitoring
+
+    class MongoCommandTimer(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            MONGO_SECONDS.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+
+        def failed(self, event):
+            MONGO_SECONDS.labels(command=event.command_name).observe(event.duration_micros / 1e6)
+
+    return MongoCommandTimer()
+
+
+# ---- Queue depth ----
+class QueueDepthCollector:
+    """Reports the broker's message count for each Celery queue, cached for `ttl` seconds."""
+
+    def __init__(self, broker_url: str = BROKER_URL, queues: list = METRICS_QUEUES, ttl: float = QUEUE_DEPTH_TTL):
+        self.broker_url = broker_url
+        self.queues = queues
+        self.ttl = ttl
+        self._depths = {}
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def _read_depths(self):
+        from kombu import Connection
+
+        depths = {}
+        with Connection(self.broker_url, connect_timeout=2) as conn:
+            for queue in self.queues:
+                # A passive declare of a missing queue closes the channel, so each gets its own.
+                try:
+                    with conn.channel() as channel:
+                        depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+                except Exception:
+                    continue
+        return depths
+
+    def collect(self):
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                try:
+                    self._depths = self._read_depths()
+                except Exception as e:
+                    print(f"[Metrics Error] Could not read queue depths: {e}")
+                    self._depths = {}
+                self._expires = time.monotonic() + self.ttl
+            depths = dict(self._depths)
+        gauge = GaugeMetricFamily("idp_queue_depth", "Messages waiting in a Celery queue.", labels=["queue"])
+        for queue, depth in depths.items():
+            gauge.add_metric([queue], depth)
+        yield gauge
+
+
+# ---- API exposition ----
+_api_registry = None
+_api_registry_lock = threading.Lock()
+
+
+def render_metrics():
+    """(body, content type) for the API's /metrics endpoint."""
+    global _api_registry
+    with _api_registry_lock:
+        if _api_registry is None:
+            registry = CollectorRegistry()
+            if PROMETHEUS_MULTIPROC_DIR:
+                from prometheus_client import multiprocess
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                registry.register(REGISTRY)
+            if BROKER_URL:
+                registry.register(QueueDepthCollector())
+            _api_registry = registry
+    return generate_latest(_api_registry), CONTENT_TYPE_LATEST
+
+
+# ---- Worker export ----
+class _WorkerLabelled:
+    """This process's metrics with a `worker` label, so the textfiles of different
+    worker processes hold distinct series."""
+
+    def __init__(self, worker: str):
+        self.worker = worker
+
+    def collect(self):
+        for family in REGISTRY.collect():
+            labelled = Metric(family.name, family.documentation, family.type, family.unit)
+            labelled.samples = [s._replace(labels={**s.labels, "worker": self.worker}) for s in family.samples]
+            yield labelled
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _textfile_path(job: str) -> str:
+    return os.path.join(METRICS_TEXTFILE_DIR, f"{job}_{socket.gethostname()}_{os.getpid()}.prom")
+
+
+def export_worker_metrics(job: str):
+    """Pushes and/or writes this process's metrics once."""
+    if METRICS_PUSHGATEWAY_URL:
+        push_to_gateway(METRICS_PUSHGATEWAY_URL, job=job, registry=REGISTRY, grouping_key={"worker": _worker_id()})
+    if METRICS_TEXTFILE_DIR:
+        os.makedirs(METRICS_TEXTFILE_DIR, exist_ok=True)
+        registry = CollectorRegistry()
+        registry.register(_WorkerLabelled(_worker_id()))
+        write_to_textfile(_textfile_path(job), registry)
+
+
+def _export_loop(job: str, stop: threading.Event):
+    while not stop.wait(METRICS_EXPORT_INTERVAL):
+        try:
+            export_worker_metrics(job)
+        except Exception as e:
+            print(f"[Metrics Error] Export failed: {e}")
+
+
+_exporter_stop = None
+
+
+def start_worker_exporter(job: str):
+    global _exporter_stop
+    _exporter_stop = threading.Event()
+    threading.Thread(target=_export_loop, args=(job, _exporter_stop), name="metrics-export", daemon=True).start()
+
+
+def stop_worker_exporter(job: str):
+    """Stops exporting and removes this process's series, which would otherwise stay at
+    their last values after the process has gone."""
+    if _exporter_stop is not None:
+        _exporter_stop.set()
+    try:
+        if METRICS_PUSHGATEWAY_URL:
+            delete_from_gateway(METRICS_PUSHGATEWAY_URL, job=job, grouping_key={"worker": _worker_id()})
+        if METRICS_TEXTFILE_DIR and os.path.exists(_textfile_path(job)):
+            os.remove(_textfile_path(job))
+    except Exception as e:
+        print(f"[Metrics Error] Cleanup failed: {e}")
+
+
+_installed = False
+
+
+def install_worker_exporter(job: str):
+    """Exports metrics from every prefork child of a Celery worker, if METRICS_PUSHGATEWAY_URL
+    or METRICS_TEXTFILE_DIR is set. Safe to call from more than one app module."""
+    global _installed
+    if _installed or not (METRICS_PUSHGATEWAY_URL or METRICS_TEXTFILE_DIR):
+        return
+    from celery.signals import worker_process_init, worker_process_shutdown
+
+    worker_process_init.connect(lambda **_: start_worker_exporter(job), weak=False)
+    worker_process_shutdown.connect(lambda **_: stop_worker_exporter(job), weak=False)
+    _installed = True
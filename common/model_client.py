@@ -0,0 +1,299 @@
+# model_client.py
+"""
+Shared HTTP client for the VLM, LLM, embedding and rerank endpoints.
+
+Every call goes through the endpoint's limiter (see rate_limiter.py) so that
+backfills cannot starve the interactive /rag path. Query-path callers pass
+priority=INTERACTIVE; everything else defaults to BATCH.
+
+Calls carry connect/read timeouts, retry transient failures with jittered
+backoff while the endpoint's retry budget allows, and fail fast with
+CircuitOpenError while the endpoint's circuit breaker is open. A call that
+does not succeed raises ModelCallError instead of returning a bad response.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+import httpx
+import requests
+from dotenv import load_dotenv
+
+from common.metrics import observe_stage
+from common.rate_limiter import get_limiter, INTERACTIVE, BATCH
+from common.resilience import CircuitBreaker, RetryBudget, ModelCallError, backoff_delay
+
+load_dotenv()
+
+ENDPOINT_URLS = {
+    "vlm": os.getenv("VLM_URL"),
+    "text": os.getenv("TEXT_URL"),
+    "embed": os.getenv("EMBED_URL"),
+    "rerank": os.getenv("RERANK_URL"),
+}
+# Read timeouts per endpoint (seconds); override with <ENDPOINT>_READ_TIMEOUT.
+READ_TIMEOUTS = {"vlm": 120.0, "text": 60.0, "embed": 15.0, "rerank": 15.0}
+CONNECT_TIMEOUT = float(os.getenv("MODEL_CONNECT_TIMEOUT", "3.05"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "2"))
+RATE_LIMIT_WAIT_TIMEOUT = float(os.getenv("RATE_LIMIT_WAIT_TIMEOUT", "120"))
+# How long a call may queue for the limiter, unless the caller passes its own bound
+# (the /rag pipeline passes what is left of the request deadline).
+INTERACTIVE_WAIT_TIMEOUT = float(os.getenv("INTERACTIVE_WAIT_TIMEOUT", "30"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+MODEL_HTTP_MAX_CONNECTIONS = int(os.getenv("MODEL_HTTP_MAX_CONNECTIONS", "200"))
+# idp_stage_seconds stage for a successful call, including limiter waits and retries.
+# A VLM call is one page and an embed call one batch.
+MODEL_STAGES = {"vlm": "vlm_page", "text": "llm", "embed": "embed_batch", "rerank": "rerank"}
+
+_session = requests.Session()
+_breakers = {}
+_budgets = {}
+_lock = threading.Lock()
+_async_client = None
+_async_client_loop = None
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    with _lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        return _breakers[endpoint]
+
+
+def get_retry_budget(endpoint: str) -> RetryBudget:
+    with _lock:
+        if endpoint not in _budgets:
+            _budgets[endpoint] = RetryBudget()
+        return _budgets[endpoint]
+
+
+def get_timeout(endpoint: str) -> tuple:
+    read = float(os.getenv(f"{endpoint.upper()}_READ_TIMEOUT", READ_TIMEOUTS.get(endpoint, 30.0)))
+    return (CONNECT_TIMEOUT, read)
+
+
+def _is_healthy(status_code: int) -> bool:
+    return status_code != 429 and status_code < 500
+
+
+def _retry_after(res) -> float:
+    try:
+        return float(res.headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _output_tokens(endpoint: str, res) -> int:
+    """Completion tokens of a chat completion, so the limiter does not read a long answer as overload."""
+    if endpoint not in ("text", "vlm"):
+        return 0
+    try:
+        body = res.json()
+        tokens = (body.get("usage") or {}).get("completion_tokens")
+        if tokens is None:
+            tokens = len(body["choices"][0]["message"]["content"] or "") // 4
+        return int(tokens)
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+        return 0
+
+
+def _wait_timeout(priority: str, wait_timeout) -> float:
+    if wait_timeout is not None:
+        return max(0.0, wait_timeout)
+    return INTERACTIVE_WAIT_TIMEOUT if priority == INTERACTIVE else RATE_LIMIT_WAIT_TIMEOUT
+
+
+def post(endpoint: str, payload: dict, priority: str = BATCH, wait_timeout: float = None) -> requests.Response:
+    """POSTs `payload` as JSON to the named endpoint and returns the successful response.
+
+    `wait_timeout` bounds the total time spent queueing for the limiter across attempts.
+    """
+    limiter = get_limiter(endpoint)
+    breaker = get_breaker(endpoint)
+    budget = get_retry_budget(endpoint)
+    budget.record_request()
+    call_started = time.monotonic()
+    wait_until = call_started + _wait_timeout(priority, wait_timeout)
+
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            limiter.acquire(priority, timeout=max(0.0, wait_until - time.monotonic()))
+        except TimeoutError as e:
+            breaker.cancel()
+            raise ModelCallError(str(e)) from e
+        except BaseException:
+            breaker.cancel()
+            raise
+
+        started = time.monotonic()
+        ok, retry_after, error = False, 0.0, None
+        try:
+            res = _session.post(
+                ENDPOINT_URLS[endpoint], json=payload,
+                headers={"Content-Type": "application/json"}, timeout=get_timeout(endpoint)
+            )
+            ok = _is_healthy(res.status_code)
+            if not ok:
+                retry_after = _retry_after(res)
+                error = f"HTTP {res.status_code}"
+        except requests.RequestException as e:
+            error = f"{type(e).__name__}: {e}"
+        except BaseException:
+            # No verdict on the endpoint, but a half-open probe slot must not stay taken.
+            breaker.cancel()
+            raise
+        finally:
+            limiter.release(time.monotonic() - started, ok, _output_tokens(endpoint, res) if ok else 0)
+
+        if ok:
+            breaker.record_success()
+            observe_stage(MODEL_STAGES.get(endpoint, endpoint), time.monotonic() - call_started)
+            return res
+        breaker.record_failure()
+
+        if attempt >= MODEL_MAX_RETRIES or breaker.state == breaker.OPEN or not budget.try_spend():
+            raise ModelCallError(f"'{endpoint}' call failed after {attempt + 1} attempt(s): {error}")
+        attempt += 1
+        time.sleep(max(min(retry_after, 30.0), backoff_delay(attempt)))
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns the pooled AsyncClient for the running event loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=MODEL_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=MODEL_HTTP_MAX_CONNECTIONS
+        ))
+        _async_client_loop = loop
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.aclose()
+    _async_client, _async_client_loop = None, None
+
+
+async def async_post(endpoint: str, payload: dict, priority: str = INTERACTIVE,
+                     wait_timeout: float = None) -> httpx.Response:
+    """Non-blocking post() for the API process, sharing its limiter, breaker and retry budget."""
+    limiter = get_limiter(endpoint)
+    breaker = get_breaker(endpoint)
+    budget = get_retry_budget(endpoint)
+    connect, read = get_timeout(endpoint)
+    budget.record_request()
+    call_started = time.monotonic()
+    wait_until = call_started + _wait_timeout(priority, wait_timeout)
+
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            await limiter.acquire_async(priority, timeout=max(0.0, wait_until - time.monotonic()))
+        except TimeoutError as e:
+            breaker.cancel()
+            raise ModelCallError(str(e)) from e
+        except BaseException:
+            breaker.cancel()
+            raise
+
+        started = time.monotonic()
+        ok, retry_after, error = False, 0.0, None
+        try:
+            res = await get_async_client().post(
+                ENDPOINT_URLS[endpoint], json=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=httpx.Timeout(read, connect=connect)
+            )
+            ok = _is_healthy(res.status_code)
+            if not ok:
+                retry_after = _retry_after(res)
+                error = f"HTTP {res.status_code}"
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+        except BaseException:
+            # No verdict on the endpoint, but a half-open probe slot must not stay taken.
+            breaker.cancel()
+            raise
+        finally:
+            limiter.release(time.monotonic() - started, ok, _output_tokens(endpoint, res) if ok else 0)
+
+        if ok:
+            breaker.record_success()
+            observe_stage(MODEL_STAGES.get(endpoint, endpoint), time.monotonic() - call_started)
+            return res
+        breaker.record_failure()
+
+        if attempt >= MODEL_MAX_RETRIES or breaker.state == breaker.OPEN or not budget.try_spend():
+            raise ModelCallError(f"'{endpoint}' call failed after {attempt + 1} attempt(s): {error}")
+        attempt += 1
+        await asyncio.sleep(max(min(retry_after, 30.0), backoff_delay(attempt)))
+
+
+async def async_stream(endpoint: str, payload: dict, priority: str = INTERACTIVE, wait_timeout: float = None):
+    """Yields content deltas from an OpenAI-compatible streaming chat completion.
+
+    Streams are not retried: once tokens have been forwarded to a client the call
+    cannot be replayed transparently.
+    """
+    limiter = get_limiter(endpoint)
+    breaker = get_breaker(endpoint)
+    connect, read = get_timeout(endpoint)
+    breaker.before_call()
+    try:
+        await limiter.acquire_async(priority, timeout=_wait_timeout(priority, wait_timeout))
+    except TimeoutError as e:
+        breaker.cancel()
+        raise ModelCallError(str(e)) from e
+    except BaseException:
+        breaker.cancel()
+        raise
+
+    started = time.monotonic()
+    first_token_latency = None
+    outcome = None  # True on success, False on failure, None if the consumer went away
+    try:
+        async with get_async_client().stream(
+            "POST", ENDPOINT_URLS[endpoint], json={**payload, "stream": True},
+            headers={"Content-Type": "application/json"},
+            timeout=httpx.Timeout(read, connect=connect)
+        ) as res:
+            if not _is_healthy(res.status_code):
+                outcome = False
+                raise ModelCallError(f"'{endpoint}' stream failed: HTTP {res.status_code}")
+            async for line in res.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    if first_token_latency is None:
+                        first_token_latency = time.monotonic() - started
+                    yield delta
+            outcome = True
+    except httpx.HTTPError as e:
+        outcome = False
+        raise ModelCallError(f"'{endpoint}' stream failed: {type(e).__name__}: {e}") from e
+    finally:
+        # Time to first token is the latency signal; total stream time depends on answer length.
+        limiter.release(first_token_latency or (time.monotonic() - started), outcome is not False)
+        if outcome is True:
+            breaker.record_success()
+            observe_stage(MODEL_STAGES.get(endpoint, endpoint), time.monotonic() - started)
+            if first_token_latency is not None:
+                observe_stage(f"{MODEL_STAGES.get(endpoint, endpoint)}_first_token", first_token_latency)
+        elif outcome is False:
+            breaker.record_failure()
+        else:
+            breaker.cancel()
@@ -0,0 +1,233 @@
+# rate_limiter.py
+"""
+Per-endpoint admission control shared by the extraction workers, the
+ingestion workers and the RAG API.
+
+Two layers guard each model endpoint:
+
+* A token bucket whose state lives outside the process (Redis when
+  RATE_LIMIT_REDIS_URL is set, otherwise a flock-protected file under
+  RATE_LIMIT_STATE_DIR), so every worker and API process on the host draws
+  from the same budget.
+* An AIMD concurrency limit inside the process. It starts at the endpoint's
+  maximum, grows by one slot per window of healthy calls and halves on errors
+  or slow responses, at most once per round trip. A response is slow when it
+  takes longer than the target latency plus the per-output-token allowance, so
+  a long answer is not mistaken for an overloaded endpoint.
+
+Interactive (query path) callers may spend the whole bucket; batch callers
+must leave RATE_LIMIT_INTERACTIVE_RESERVE of it untouched.
+"""
+import asyncio
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_STATE_DIR = Path(os.getenv("RATE_LIMIT_STATE_DIR", Path(tempfile.gettempdir()) / "idp_rate_limits"))
+RATE_LIMIT_INTERACTIVE_RESERVE = float(os.getenv("RATE_LIMIT_INTERACTIVE_RESERVE", "0.2"))
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Defaults per endpoint: requests/sec, burst, max in-flight per process, target latency (s)
+# and the extra latency allowed per output token (s).
+ENDPOINT_DEFAULTS = {
+    "vlm": (2.0, 4, 4, 30.0, 0.05),
+    "text": (5.0, 10, 8, 20.0, 0.05),
+    "embed": (20.0, 40, 16, 2.0, 0.0),
+    "rerank": (10.0, 20, 8, 3.0, 0.0),
+}
+
+
+class FileTokenBucket:
+    """Token bucket persisted in a JSON file and serialised with flock."""
+
+    def __init__(self, name: str, rate: float, capacity: float, state_dir: Path = RATE_LIMIT_STATE_DIR):
+        self.rate = rate
+        self.capacity = capacity
+        state_dir.mkdir(parents=True, exist_ok=True)
+        self.path = state_dir / f"{name}.json"
+
+    def try_acquire(self, tokens: float = 1.0, reserve: float = 0.0) -> float:
+        """Takes `tokens` if available above the reserve; otherwise returns seconds to wait."""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                now = time.time()
+                state = json.loads(raw) if raw else {"level": self.capacity, "ts": now}
+                level = min(self.capacity, state["level"] + (now - state["ts"]) * self.rate)
+                floor = reserve * self.capacity
+                wait = 0.0
+                if level - tokens >= floor:
+                    level -= tokens
+                else:
+                    wait = (tokens + floor - level) / self.rate
+                f.seek(0)
+                f.truncate()
+                json.dump({"level": level, "ts": now}, f)
+                # Write through before unlocking, not when the file closes.
+                f.flush()
+                return wait
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RedisTokenBucket:
+    """Token bucket stored in Redis and updated atomically with a Lua script."""
+
+    _SCRIPT = """
+    local state = redis.call('HMGET', KEYS[1], 'level', 'ts')
+    local rate, capacity, tokens, floor, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    level = math.min(capacity, level + (now - ts) * rate)
+    local wait = 0
+    if level - tokens >= floor then
+        level = level - tokens
+    else
+        wait = (tokens + floor - level) / rate
+    end
+    redis.call('HSET', KEYS[1], 'level', level, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], 3600)
+    return tostring(wait)
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float, redis_url: str = RATE_LIMIT_REDIS_URL):
+        import redis
+
+        self.rate = rate
+        self.capacity = capacity
+        self.key = f"idp:ratelimit:{name}"
+        self._client = redis.Redis.from_url(redis_url)
+        self._script = self._client.register_script(self._SCRIPT)
+
+    def try_acquire(self, tokens: float = 1.0, reserve: float = 0.0) -> float:
+        wait = self._script(keys=[self.key], args=[self.rate, self.capacity, tokens, reserve * self.capacity, time.time()])
+        return float(wait)
+
+
+class AdaptiveConcurrency:
+    """In-process AIMD limit on concurrent calls to one endpoint."""
+
+    def __init__(self, max_limit: int, target_latency: float, min_limit: int = 1, token_latency: float = 0.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.token_latency = token_latency
+        self.limit = float(max(min_limit, max_limit))
+        self.in_flight = 0
+        self._decreased_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def try_enter(self, reserve: float = 0.0) -> bool:
+        with self._lock:
+            allowed = max(1, math.floor(self.limit * (1 - reserve)))
+            if self.in_flight < allowed:
+                self.in_flight += 1
+                return True
+            return False
+
+    def cancel(self):
+        """Gives back a slot that was never used for a call."""
+        with self._lock:
+            self.in_flight -= 1
+
+    def exit(self, latency: float, ok: bool, output_tokens: int = 0):
+        with self._lock:
+            self.in_flight -= 1
+            if not ok or latency > self.target_latency + output_tokens * self.token_latency:
+                # Calls already in flight when the limit was cut report the same overload;
+                # only one that started after the last cut may cut again.
+                now = time.monotonic()
+                if now - latency >= self._decreased_at:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._decreased_at = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class EndpointLimiter:
+    """Combines the shared token bucket and the local concurrency limit for one endpoint."""
+
+    def __init__(self, name: str):
+        prefix = name.upper()
+        rate, burst, max_conc, target, token_target = ENDPOINT_DEFAULTS.get(name, (5.0, 10, 8, 10.0, 0.0))
+        rate = float(os.getenv(f"{prefix}_RATE_LIMIT", rate))
+        burst = float(os.getenv(f"{prefix}_BURST", burst))
+        max_conc = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", max_conc))
+        target = float(os.getenv(f"{prefix}_TARGET_LATENCY", target))
+        token_target = float(os.getenv(f"{prefix}_TARGET_TOKEN_LATENCY", token_target))
+
+        self.name = name
+        if RATE_LIMIT_REDIS_URL:
+            self.bucket = RedisTokenBucket(name, rate, burst)
+        else:
+            self.bucket = FileTokenBucket(name, rate, burst)
+        self.concurrency = AdaptiveConcurrency(max_conc, target, token_latency=token_target)
+
+    def try_acquire(self, priority: str = BATCH) -> float:
+        """Returns 0 once a call may start, otherwise the suggested wait in seconds."""
+        reserve = 0.0 if priority == INTERACTIVE else RATE_LIMIT_INTERACTIVE_RESERVE
+        if not self.concurrency.try_enter(reserve):
+            return 0.05
+        wait = self.bucket.try_acquire(reserve=reserve)
+        if wait > 0:
+            self.concurrency.cancel()
+        return wait
+
+    def acquire(self, priority: str = BATCH, timeout: float = None):
+        """Blocks until a call may start; raises TimeoutError after `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(priority)
+            if wait <= 0:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TimeoutError(f"Rate limit wait for '{self.name}' exceeded {timeout}s")
+            time.sleep(min(wait, 1.0))
+
+    async def acquire_async(self, priority: str = BATCH, timeout: float = None):
+        """Awaitable acquire() that yields to the event loop while waiting.
+
+        The bucket check takes a flock or a Redis round trip, so each attempt runs
+        in a worker thread rather than on the event loop."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            attempt = asyncio.ensure_future(asyncio.to_thread(self.try_acquire, priority))
+            try:
+                wait = await asyncio.shield(attempt)
+            except asyncio.CancelledError:
+                # The thread still finishes; give back the slot if it won one.
+                attempt.add_done_callback(self._release_unused)
+                raise
+            if wait <= 0:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TimeoutError(f"Rate limit wait for '{self.name}' exceeded {timeout}s")
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _release_unused(self, attempt: asyncio.Future):
+        if not attempt.cancelled() and attempt.exception() is None and attempt.result() <= 0:
+            self.concurrency.cancel()
+
+    def release(self, latency: float, ok: bool, output_tokens: int = 0):
+        self.concurrency.exit(latency, ok, output_tokens)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str) -> EndpointLimiter:
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = EndpointLimiter(name)
+        return _limiters[name]
@@ -0,0 +1,96 @@
+# reranker.py
+"""
+Reranking client for the API process.
+
+* Scores are cached per (query, chunk text hash), so repeated queries only send
+  passages the reranker has not scored for that query yet.
+* Remaining passages are split into sub-batches of RERANK_BATCH_SIZE that are
+  scored in parallel. Cross-encoder logits are per (query, passage) pair, so
+  sub-batch results merge by simple sorting.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from common import model_client
+from common.metrics import record_cache
+
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "25"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "50000"))
+
+
+def _passage_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Reranker:
+    def __init__(self, model: str, batch_size: int = RERANK_BATCH_SIZE, cache_size: int = RERANK_CACHE_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, query, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                score = self._scores.get((query, key))
+                if score is not None:
+                    self._scores.move_to_end((query, key))
+                    found[key] = score
+            return found
+
+    def _remember(self, query, scores):
+        with self._lock:
+            for key, score in scores.items():
+                self._scores[(query, key)] = score
+                self._scores.move_to_end((query, key))
+            while len(self._scores) > self.cache_size:
+                self._scores.popitem(last=False)
+
+    async def _score_batch(self, query, passages, priority):
+        """Returns one logit per passage, in order."""
+        res = await model_client.async_post("rerank", {
+            "model": self.model,
+            "query": {"text": query},
+            "passages": [{"text": p} for p in passages],
+            "truncate": "END"
+        }, priority=priority)
+        data = res.json()
+        if "rankings" not in data:
+            raise ValueError(f"Rerank response missing 'rankings': {data}")
+        logits = [None] * len(passages)
+        for ranking in data["rankings"]:
+            logits[ranking["index"]] = ranking["logit"]
+        return logits
+
+    async def rerank(self, query: str, passages: list, priority: str = model_client.INTERACTIVE) -> list:
+        """Returns [(passage, logit)] best first. Passages that could not be scored
+        follow in their original order with a logit of None."""
+        keys = [_passage_key(p) for p in passages]
+        scores = self._cached(query, keys)
+        record_cache("rerank", hits=len(scores), misses=len(passages) - len(scores))
+
+        missing = list({k: p for k, p in zip(keys, passages) if k not in scores}.items())
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        results = await asyncio.gather(
+            *(self._score_batch(query, [p for _, p in batch], priority) for batch in batches),
+            return_exceptions=True
+        )
+        fresh = {}
+        for batch, logits in zip(batches, results):
+            if isinstance(logits, Exception):
+                print(f"[Rerank Error] {logits}")
+                continue
+            fresh.update({key: logit for (key, _), logit in zip(batch, logits) if logit is not None})
+        self._remember(query, fresh)
+        scores.update(fresh)
+
+        scored = sorted(
+            ((p, scores[k]) for p, k in zip(passages, keys) if k in scores),
+            key=lambda item: -item[1]
+        )
+        return scored + [(p, None) for p, k in zip(passages, keys) if k not in scores]
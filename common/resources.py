@@ -0,0 +1,58 @@
+# resources.py
+"""
+Process-wide clients, created on first use instead of at import time.
+
+Every module that talks to MongoDB shares one MongoClient (and its connection
+pool) from here rather than opening its own, and the local Chroma
+PersistentClient used by text_extraction is only opened by the tasks that
+write to it. Importing a task module or the API therefore stays cheap, which
+keeps Celery autoscaling and `uvicorn --reload` restarts fast. Measure with
+`python3 -m utilities.startup_benchmark`.
+
+Clients are keyed by process id: a prefork Celery child that inherits a
+client from its parent gets a fresh one, since neither pymongo nor Chroma
+connections survive a fork.
+"""
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+LOCAL_CHROMA_PATH = os.getenv("LOCAL_CHROMA_PATH", "./rag_local_db")
+
+_resources = {}
+_lock = threading.Lock()
+
+
+def get_resource(name: str, factory):
+    """The process's `name` resource, built with `factory()` the first time it is asked for."""
+    key = (name, os.getpid())
+    resource = _resources.get(key)
+    if resource is not None:
+        return resource
+    with _lock:
+        if key not in _resources:
+            _resources[key] = factory()
+        return _resources[key]
+
+
+def mongo_client():
+    def connect():
+        from pymongo import MongoClient
+        from common.metrics import mongo_listener
+        return MongoClient(MONGO_URI, event_listeners=[mongo_listener()])
+    return get_resource("mongo", connect)
+
+
+def mongo_db(name: str):
+    return mongo_client()[name]
+
+
+def local_chroma_client():
+    def connect():
+        import chromadb
+        return chromadb.PersistentClient(path=LOCAL_CHROMA_PATH)
+    return get_resource("local_chroma", connect)
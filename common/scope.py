@@ -0,0 +1,57 @@
+# scope.py
+"""
+Chunk metadata and Chroma `where` clauses for file/folder scoped retrieval.
+
+Every chunk stores each ancestor folder of its file under a depth-indexed key
+(`folder_1` = "/share", `folder_2` = "/share/iv-data", ...). A folder scope
+then becomes a single exact match on the key for that folder's depth, which
+Chroma can evaluate as part of the vector query instead of returning a global
+top-N that is filtered afterwards.
+"""
+from pathlib import PurePosixPath
+
+MAX_FOLDER_DEPTH = 32
+
+
+def normalize_folder(path: str) -> str:
+    return str(PurePosixPath(path)) if path else ""
+
+
+def folder_depth(path: str) -> int:
+    parts = PurePosixPath(path).parts
+    return len(parts) - 1 if parts and parts[0] == "/" else len(parts)
+
+
+def folder_ancestor_metadata(folder_path: str) -> dict:
+    """Returns {"folder_<depth>": ancestor} for the folder and every folder above it."""
+    if not folder_path:
+        return {}
+    folder = PurePosixPath(normalize_folder(folder_path))
+    metadata = {}
+    for ancestor in [folder, *folder.parents]:
+        depth = folder_depth(str(ancestor))
+        if 0 < depth <= MAX_FOLDER_DEPTH:
+            metadata[f"folder_{depth}"] = str(ancestor)
+    return metadata
+
+
+def scope_where(type: str, file_or_folder_path: str):
+    """Returns the Chroma `where` filter for a query scope, or None for type="all"."""
+    if type == "file":
+        return {"file_path": file_or_folder_path}
+    if type == "folder" and file_or_folder_path:
+        folder = normalize_folder(file_or_folder_path)
+        depth = folder_depth(folder)
+        if 0 < depth <= MAX_FOLDER_DEPTH:
+            return {f"folder_{depth}": folder}
+    return None
+
+
+def in_scope(metadata: dict, type: str, file_or_folder_path: str) -> bool:
+    """Python-side scope check, used for chunks ingested before ancestor metadata existed."""
+    path = metadata.get("file_path", "")
+    if type == "folder":
+        return path.startswith(file_or_folder_path)
+    if type == "file":
+        return path == file_or_folder_path
+    return True
@@ -0,0 +1,61 @@
+# scope_backfill.py
+"""
+Whether a user's chunks may still lack ancestor-folder metadata.
+
+Chunks ingested before `folder_<depth>` keys existed (see common/scope.py) do
+not match a folder scope's `where` clause. Until utilities/backfill_folder_metadata.py
+has added the keys, folder-scoped queries also search a global top-N filtered
+in Python. The utility records its completion in `rag_db.scope_backfill`, per
+user or for everyone (user_id "*"). Processes re-check pending users every
+SCOPE_BACKFILL_TTL seconds; a completed backfill is never re-checked.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from common.resources import mongo_db
+
+load_dotenv()
+
+SCOPE_BACKFILL_TTL = float(os.getenv("SCOPE_BACKFILL_TTL", "60"))
+ALL_USERS = "*"
+
+_indexed = False
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _collection():
+    global _indexed
+    markers = mongo_db("rag_db")["scope_backfill"]
+    if not _indexed:
+        markers.create_index("user_id", unique=True)
+        _indexed = True
+    return markers
+
+
+def legacy_scope_pending(user_id: str) -> bool:
+    """True until the folder-metadata backfill has run for the user (or for everyone)."""
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(user_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    pending = _collection().find_one({"user_id": {"$in": [user_id, ALL_USERS]}}) is None
+    with _cache_lock:
+        _cache[user_id] = (pending, now + SCOPE_BACKFILL_TTL if pending else float("inf"))
+    return pending
+
+
+def mark_complete(user_id: str = ALL_USERS):
+    _collection().update_one(
+        {"user_id": user_id}, {"$set": {"user_id": user_id, "completed_at": datetime.utcnow()}}, upsert=True
+    )
+    with _cache_lock:
+        if user_id == ALL_USERS:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
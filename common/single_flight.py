@@ -0,0 +1,43 @@
+# single_flight.py
+"""
+Single-flight execution for the API process: concurrent calls with the same
+key share one in-flight coroutine and all receive its result.
+
+The shared task is shielded, so a caller that disconnects does not cancel the
+work other callers are waiting on. Coalescing is per process; identical
+requests routed to different uvicorn workers still run separately. Joined and
+new flights are counted in idp_cache_lookups_total{cache=<name>}.
+"""
+import asyncio
+
+from common.metrics import CACHE_LOOKUPS
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._loop = None
+        self._flights = {}
+
+    async def do(self, key, fn):
+        """Returns (result, shared). `fn` is only called when no flight for `key` is running;
+        `shared` is True for callers that joined an existing flight."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._flights = loop, {}
+
+        task = self._flights.get(key)
+        shared = task is not None
+        CACHE_LOOKUPS.labels(cache=self.name, result="coalesced" if shared else "miss").inc()
+        if not shared:
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Mark a failure as retrieved even if every caller has gone away.
+            task.exception()
@@ -0,0 +1,260 @@
+# tenancy.py
+"""
+Where each user's chunk and summary vectors live in ChromaDB (CHROMA_TENANCY):
+
+* "collection" (default) - `{user_id}_chunks` and `{user_id}_summaries`, two
+  collections per user.
+* "shared" - CHROMA_SHARDS pairs of shared collections (`chunks_007`,
+  `summaries_007`). A user always hashes to the same shard, writes are tagged
+  with `user_id` and every read and delete is filtered by it, so the number of
+  collections no longer grows with the number of tenants.
+* "database" - one Chroma database per user inside CHROMA_TENANT, holding
+  `chunks` and `summaries`. Tenants are isolated by the server instead of by
+  name prefixes.
+
+Chunk collections can also carry an embedding version (see
+common/embedding_versions.py), which is appended to the name as `__<version>`
+so a re-embedded copy can be built next to the one being served.
+
+Collection handles are cached per process for CHROMA_HANDLE_TTL seconds, so
+queries and ingestion tasks do not pay a get_collection round trip each time.
+Switching layouts is done with `python3 -m utilities.migrate_tenancy`. chromadb
+itself is only imported when the first client is opened.
+"""
+import os
+import re
+import threading
+import time
+import zlib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+CHROMA_TENANCY = os.getenv("CHROMA_TENANCY", "collection").lower()
+CHROMA_SHARDS = int(os.getenv("CHROMA_SHARDS", "16"))
+CHROMA_TENANT = os.getenv("CHROMA_TENANT", "default_tenant")
+CHROMA_HANDLE_TTL = float(os.getenv("CHROMA_HANDLE_TTL", "300"))
+
+TENANCY_MODES = ("collection", "shared", "database")
+CHUNKS = "chunks"
+SUMMARIES = "summaries"
+KINDS = (CHUNKS, SUMMARIES)
+PAGE_SIZE = 1000
+
+_CHUNKS_NAME = re.compile(rf"^(.+)_{CHUNKS}(?:__.+)?$")
+_SHARD_NAME = re.compile(rf"^{CHUNKS}_\d{{3}}(?:__.+)?$")
+
+
+def shard_for(user_id: str, shards: int = CHROMA_SHARDS) -> int:
+    return zlib.crc32(user_id.encode("utf-8")) % shards
+
+
+def _with_user(user_id, where):
+    return {"user_id": user_id} if not where else {"$and": [{"user_id": user_id}, where]}
+
+
+class SharedCollection:
+    """One user's view of a shared collection, with the same calls the pipeline makes
+    on a plain Chroma collection."""
+
+    def __init__(self, collection, user_id: str):
+        self.collection = collection
+        self.user_id = user_id
+        self.name = collection.name
+
+    def _tag(self, metadatas, n):
+        return [{**(m or {}), "user_id": self.user_id} for m in (metadatas or [None] * n)]
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.collection.upsert(
+            ids=ids, embeddings=embeddings, documents=documents, metadatas=self._tag(metadatas, len(ids))
+        )
+
+    def add(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.collection.add(
+            ids=ids, embeddings=embeddings, documents=documents, metadatas=self._tag(metadatas, len(ids))
+        )
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        self.collection.update(
+            ids=ids, embeddings=embeddings, documents=documents,
+            metadatas=None if metadatas is None else self._tag(metadatas, len(ids))
+        )
+
+    def query(self, where=None, **kwargs):
+        return self.collection.query(where=_with_user(self.user_id, where), **kwargs)
+
+    def get(self, ids=None, where=None, **kwargs):
+        return self.collection.get(ids=ids, where=_with_user(self.user_id, where), **kwargs)
+
+    def delete(self, ids=None, where=None):
+        self.collection.delete(ids=ids, where=_with_user(self.user_id, where))
+
+    def count(self) -> int:
+        # Pages the user's ids, so callers should cache it (see SUMMARY_COUNT_TTL).
+        total, offset = 0, 0
+        while True:
+            page = self.get(include=[], limit=PAGE_SIZE * 10, offset=offset)
+            total += len(page["ids"])
+            if len(page["ids"]) < PAGE_SIZE * 10:
+                return total
+            offset += PAGE_SIZE * 10
+
+
+class CollectionRegistry:
+    """Resolves (user, kind) to a collection handle under one tenancy mode and caches it."""
+
+    def __init__(self, mode: str = CHROMA_TENANCY, host: str = CHROMA_HOST, port: int = CHROMA_PORT,
+                 shards: int = CHROMA_SHARDS, ttl: float = CHROMA_HANDLE_TTL):
+        if mode not in TENANCY_MODES:
+            raise ValueError(f"CHROMA_TENANCY must be one of {TENANCY_MODES}, got {mode!r}")
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.shards = shards
+        self.ttl = ttl
+        self._clients = {}
+        self._handles = {}
+        self._admin = None
+        self._lock = threading.Lock()
+
+    # ---- Clients ----
+    def _admin_client(self):
+        if self._admin is None:
+            from chromadb import AdminClient
+            from chromadb.config import Settings
+            self._admin = AdminClient(Settings(
+                chroma_api_impl="chromadb.api.fastapi.FastAPI",
+                chroma_server_host=self.host,
+                chroma_server_http_port=self.port
+            ))
+        return self._admin
+
+    def _client(self, database=None, create=False):
+        with self._lock:
+            client = self._clients.get(database)
+        if client is not None:
+            return client
+        from chromadb import HttpClient
+        if database is None:
+            client = HttpClient(host=self.host, port=self.port)
+        else:
+            if create:
+                try:
+                    self._admin_client().get_database(database, tenant=CHROMA_TENANT)
+                except Exception:
+                    self._admin_client().create_database(database, tenant=CHROMA_TENANT)
+            client = HttpClient(host=self.host, port=self.port, tenant=CHROMA_TENANT, database=database)
+        with self._lock:
+            return self._clients.setdefault(database, client)
+
+    # ---- Handles ----
+    def collection_name(self, user_id: str, kind: str, version: str = "") -> str:
+        if self.mode == "shared":
+            name = f"{kind}_{shard_for(user_id, self.shards):03d}"
+        elif self.mode == "database":
+            name = kind
+        else:
+            name = f"{user_id}_{kind}"
+        return f"{name}__{version}" if version else name
+
+    def _resolve(self, user_id, kind, create, version):
+        client = self._client(user_id if self.mode == "database" else None, create)
+        name = self.collection_name(user_id, kind, version)
+        collection = client.get_or_create_collection(name=name) if create else client.get_collection(name=name)
+        return SharedCollection(collection, user_id) if self.mode == "shared" else collection
+
+    def get(self, user_id: str, kind: str, create: bool = False, version: str = ""):
+        """The user's `kind` collection. Raises if it does not exist and `create` is False."""
+        key = (user_id, kind, version)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._handles.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        handle = self._resolve(user_id, kind, create, version)
+        with self._lock:
+            self._handles[key] = (handle, now + self.ttl)
+        return handle
+
+    def forget(self, user_id: str = None):
+        """Drops cached handles, e.g. after a collection was deleted or migrated."""
+        with self._lock:
+            if user_id is None:
+                self._handles.clear()
+            else:
+                for key in [k for k in self._handles if k[0] == user_id]:
+                    del self._handles[key]
+
+    # ---- Administration (migrations, utilities) ----
+    def list_users(self) -> list:
+        """Users with chunks in any embedding version under this layout."""
+        if self.mode == "database":
+            return sorted(db["name"] for db in self._admin_client().list_databases(tenant=CHROMA_TENANT))
+        names = [c if isinstance(c, str) else c.name for c in self._client().list_collections()]
+        if self.mode == "collection":
+            return sorted({m.group(1) for m in map(_CHUNKS_NAME.match, names) if m})
+        users = set()
+        for name in names:
+            if not _SHARD_NAME.match(name):
+                continue
+            collection = self._client().get_collection(name=name)
+            offset = 0
+            while True:
+                page = collection.get(include=["metadatas"], limit=PAGE_SIZE, offset=offset)
+                if not page["ids"]:
+                    break
+                users.update(m["user_id"] for m in page["metadatas"] if m and m.get("user_id"))
+                offset += PAGE_SIZE
+        return sorted(users)
+
+    def drop_version(self, user_id: str, version: str):
+        """Deletes one embedding version of the user's chunks, e.g. a retired standby."""
+        if self.mode == "shared":
+            self.get(user_id, CHUNKS, version=version).delete()
+        else:
+            client = self._client(user_id if self.mode == "database" else None)
+            client.delete_collection(name=self.collection_name(user_id, CHUNKS, version))
+        self.forget(user_id)
+
+    def drop_user(self, user_id: str, chunk_version: str = ""):
+        """Deletes the user's summaries and `chunk_version` chunks under this layout
+        (the whole database in "database" mode)."""
+        if self.mode == "database":
+            self._admin_client().delete_database(user_id, tenant=CHROMA_TENANT)
+            with self._lock:
+                self._clients.pop(user_id, None)
+        else:
+            for kind in KINDS:
+                version = chunk_version if kind == CHUNKS else ""
+                try:
+                    if self.mode == "shared":
+                        self.get(user_id, kind, version=version).delete()
+                    else:
+                        self._client().delete_collection(name=self.collection_name(user_id, kind, version))
+                except Exception as e:
+                    print(f"[Tenancy] No {kind} to drop for {user_id}: {e}")
+        self.forget(user_id)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> CollectionRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = CollectionRegistry()
+        return _registry
+
+
+def chunk_collection(user_id: str, create: bool = False, version: str = ""):
+    return get_registry().get(user_id, CHUNKS, create, version)
+
+
+def summary_collection(user_id: str, create: bool = False):
+    return get_registry().get(user_id, SUMMARIES, create)
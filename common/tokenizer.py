@@ -0,0 +1,49 @@
+# tokenizer.py
+"""
+Process-wide token counting. The tiktoken encoding is loaded once and counts
+for recently seen texts (chunks that keep coming back for popular queries)
+are memoized.
+
+Counts use cl100k_base, which is close to but not identical to the Llama
+tokenizer, so budgets built on them should keep some headroom.
+"""
+import os
+from functools import lru_cache
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "20000"))
+TOKEN_COUNT_CACHE_MAX_CHARS = 8192
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # tiktoken downloads encodings on first use; without one, fall back to ~4 chars per token.
+        print(f"[Tokenizer Error] {e}. Estimating token counts from text length.")
+        return None
+
+
+def _encode_count(text: str) -> int:
+    enc = get_encoding()
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+_cached_count = lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(_encode_count)
+
+
+def count_tokens(text: str) -> int:
+    # Whole documents (e.g. for summaries) are counted but not kept in the memo.
+    if len(text) > TOKEN_COUNT_CACHE_MAX_CHARS:
+        return _encode_count(text)
+    return _cached_count(text)
+
+
+def count_message_tokens(messages: list) -> int:
+    """Approximate prompt size of chat messages, including per-message framing."""
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
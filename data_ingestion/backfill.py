@@ -0,0 +1,299 @@
+# backfill.py
+"""
+Bulk ingestion for onboarding a tenant from extraction_results/<user>.json.
+
+Records are streamed from the JSON file and pushed through three stages
+connected by bounded queues (chunking -> batched embedding -> batched Chroma
+upserts), so a slow stage throttles the ones before it instead of buffering
+the whole corpus in memory. Progress is checkpointed after each flush, and a
+restarted run skips every record that was already made durable.
+
+    python -m data_ingestion.backfill --user shilpa
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+
+from data_ingestion.worker import (
+    app, CHROMA_MAX_BATCH, chunk_text, get_embeddings, build_chunk_records,
+    upsert_in_batches, summarize_text, store_summary, get_mongo_collection, chunk_targets,
+)
+from data_ingestion.manifest import record_manifest
+from common import tenancy
+from common.answer_cache import record_document_changes
+from common.lexical_index import get_lexical_index
+from common.hot_index import get_hot_index
+from common.metrics import CHUNKS
+from data_ingestion.checkpoints import (
+    load_backfill_offset, save_backfill_offset, reset_backfill, save_document_progress,
+)
+
+EXTRACTION_RESULTS_PATH = Path("extraction_results")
+BACKFILL_QUEUE_DEPTH = int(os.getenv("BACKFILL_QUEUE_DEPTH", "8"))
+BACKFILL_EMBED_WORKERS = int(os.getenv("BACKFILL_EMBED_WORKERS", "2"))
+BACKFILL_REPORT_EVERY = int(os.getenv("BACKFILL_REPORT_EVERY", "50"))
+
+_DONE = object()
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_extraction_records(source_path: Path, start: int = 0, read_size: int = 1 << 20):
+    """Yields (offset, record) pairs from a JSON array file without loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(source_path, "r", encoding="utf-8") as f:
+        buf = f.read(read_size).lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{source_path} does not contain a JSON array")
+        # Decode in place from `pos`; the consumed prefix is only dropped on a refill.
+        pos, offset = 1, 0
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if buf.startswith("]", pos):
+                return
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = f.read(read_size)
+                if not more:
+                    if buf[pos:].strip():
+                        raise
+                    return
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            if offset >= start:
+                yield offset, record
+            offset += 1
+
+
+class BackfillStats:
+    """Thread-safe throughput counters for a backfill run."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.docs = 0
+        self.chunks = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, docs=0, chunks=0, tokens=0):
+        with self._lock:
+            self.docs += docs
+            self.chunks += chunks
+            self.tokens += tokens
+
+    def snapshot(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "docs": self.docs,
+            "chunks": self.chunks,
+            "embedding_tokens": self.tokens,
+            "elapsed_s": round(elapsed, 2),
+            "docs_per_s": round(self.docs / elapsed, 2),
+            "chunks_per_s": round(self.chunks / elapsed, 2),
+            "tokens_per_s": round(self.tokens / elapsed, 2),
+        }
+
+
+def _payload_from_record(record: dict) -> dict:
+    payload = dict(record)
+    payload["status"] = "add"
+    payload.setdefault("last_updated", record.get("last_modified"))
+    return payload
+
+
+def _chunk_stage(records, chunk_queue, stop, errors):
+    try:
+        for offset, record in records:
+            if stop.is_set():
+                break
+            extracted_text = record.get("extracted_text", {})
+            if not record.get("uuid") or "error" in extracted_text:
+                chunk_queue.put((offset, None, [], ""))
+                continue
+            text = "\n".join(extracted_text.values())
+            chunk_queue.put((offset, _payload_from_record(record), chunk_text(text), text))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for _ in range(BACKFILL_EMBED_WORKERS):
+            chunk_queue.put(_DONE)
+
+
+def _embed_stage(chunk_queue, write_queue, stats, model, with_summaries, stop, errors):
+    try:
+        while not stop.is_set():
+            item = chunk_queue.get()
+            if item is _DONE:
+                break
+            offset, payload, chunks, text = item
+            if payload is None:
+                write_queue.put((offset, None, None, None))
+                continue
+            embeddings, tokens = get_embeddings(chunks, model=model)
+            stats.add(tokens=tokens)
+            records = build_chunk_records(payload, chunks, embeddings)
+            summary = summarize_text(text) if with_summaries else None
+            write_queue.put((offset, payload, records, summary))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        write_queue.put(_DONE)
+
+
+def run_backfill(user_id: str, source_path=None, with_summaries: bool = True, reset: bool = False) -> dict:
+    """Ingests every extraction record for `user_id`, resuming from the last checkpoint."""
+    source_path = Path(source_path) if source_path else EXTRACTION_RESULTS_PATH / f"{user_id}.json"
+    source = str(source_path)
+    if reset:
+        reset_backfill(user_id, source)
+    start = load_backfill_offset(user_id, source)
+    print(f"[INFO] Backfill for {user_id} from {source}, resuming at record {start}")
+
+    # The embed stage uses the active version's model; a standby version being
+    # re-embedded or kept for rollback is embedded again at flush time.
+    (active, collection), *standby_targets = chunk_targets(user_id)
+    summary_collection = tenancy.summary_collection(user_id, create=True)
+    mongo_collection = get_mongo_collection()
+
+    stats = BackfillStats()
+    stop = threading.Event()
+    errors = []
+    chunk_queue = queue.Queue(maxsize=BACKFILL_QUEUE_DEPTH)
+    write_queue = queue.Queue(maxsize=BACKFILL_QUEUE_DEPTH)
+
+    threads = [threading.Thread(
+        target=_chunk_stage,
+        args=(iter_extraction_records(source_path, start), chunk_queue, stop, errors),
+        daemon=True
+    )]
+    threads += [
+        threading.Thread(
+            target=_embed_stage,
+            args=(chunk_queue, write_queue, stats, active["model"], with_summaries, stop, errors),
+            daemon=True
+        )
+        for _ in range(BACKFILL_EMBED_WORKERS)
+    ]
+    for t in threads:
+        t.start()
+
+    pending = {"ids": [], "embeddings": [], "documents": [], "metadatas": []}
+    pending_docs = []  # (offset, payload, summary, chunk_count) waiting on the next flush
+    finished = set()
+    watermark = start
+
+    def flush():
+        nonlocal watermark
+        for _, payload, _, chunk_count in pending_docs:
+            if payload is not None:
+                record_manifest(payload, chunk_count)
+        if pending["ids"]:
+            writes = [(active, collection, pending["embeddings"])] + [
+                (version, target, get_embeddings(pending["documents"], model=version["model"])[0])
+                for version, target in standby_targets
+            ]
+            for version, target, embeddings in writes:
+                upsert_in_batches(
+                    target, pending["ids"], embeddings,
+                    pending["documents"], pending["metadatas"], batch_size=CHROMA_MAX_BATCH
+                )
+                hot_index = get_hot_index(user_id, version["version"])
+                if hot_index is not None:
+                    hot_index.upsert(pending["ids"], embeddings, pending["documents"], pending["metadatas"])
+            get_lexical_index(user_id).upsert_chunks(pending["ids"], pending["documents"], pending["metadatas"])
+            CHUNKS.labels(operation="written").inc(len(pending["ids"]))
+        for offset, payload, summary, chunk_count in pending_docs:
+            if payload is not None and summary is not None:
+                store_summary(payload, summary, mongo_collection, summary_collection)
+                # Lets a later process_file delivery for the same version skip the document.
+                save_document_progress(
+                    payload, cleared=True, chunks_written=chunk_count,
+                    summary_done=True, completed=True
+                )
+            if payload is not None:
+                stats.add(docs=1, chunks=chunk_count)
+            finished.add(offset)
+        record_document_changes(user_id, [p.get("file_path", "") for _, p, _, _ in pending_docs if p is not None])
+        for values in pending.values():
+            values.clear()
+        pending_docs.clear()
+        # Only advance over a contiguous prefix: embed workers may finish out of order.
+        while watermark in finished:
+            finished.discard(watermark)
+            watermark += 1
+        save_backfill_offset(user_id, source, watermark, stats.snapshot())
+
+    workers_left = BACKFILL_EMBED_WORKERS
+    last_reported = 0
+    try:
+        while workers_left:
+            item = write_queue.get()
+            if item is _DONE:
+                workers_left -= 1
+                continue
+            offset, payload, records, summary = item
+            chunk_count = 0
+            if records is not None:
+                ids, documents, metadatas, embeddings = records
+                pending["ids"].extend(ids)
+                pending["documents"].extend(documents)
+                pending["metadatas"].extend(metadatas)
+                pending["embeddings"].extend(embeddings)
+                chunk_count = len(ids)
+            pending_docs.append((offset, payload, summary, chunk_count))
+            if len(pending["ids"]) >= CHROMA_MAX_BATCH:
+                flush()
+                if stats.docs - last_reported >= BACKFILL_REPORT_EVERY:
+                    last_reported = stats.docs
+                    print(f"[INFO] Backfill progress for {user_id}: {stats.snapshot()}")
+        flush()
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        # Unblock producers waiting on a full queue so the threads can exit.
+        for q in (chunk_queue, write_queue):
+            while not q.empty():
+                q.get_nowait()
+
+    result = stats.snapshot()
+    result["next_offset"] = watermark
+    print(f"[INFO] Backfill complete for {user_id}: {result}")
+    return result
+
+
+@app.task(bind=True, name="data_ingestion.bulk_ingest_user", acks_late=True)
+def bulk_ingest_user(self, user_id, source_path=None, with_summaries=True, reset=False):
+    try:
+        return run_backfill(user_id, source_path, with_summaries=with_summaries, reset=reset)
+    except Exception as e:
+        print(f"[FATAL ERROR] Backfill failed for {user_id}: {e}")
+        # Progress is checkpointed, so a retry resumes rather than restarts.
+        raise self.retry(exc=e, countdown=30, max_retries=3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest extraction results for a user into ChromaDB.")
+    parser.add_argument("--user", required=True, help="User id whose extraction results should be ingested.")
+    parser.add_argument("--source", help="Path to the extraction JSON. Defaults to extraction_results/<user>.json.")
+    parser.add_argument("--skip-summaries", action="store_true", help="Only write chunk embeddings.")
+    parser.add_argument("--reset", action="store_true", help="Ignore any saved checkpoint and start over.")
+    parser.add_argument("--async", dest="use_celery", action="store_true", help="Queue the backfill as a Celery task.")
+    args = parser.parse_args()
+
+    if args.use_celery:
+        result = bulk_ingest_user.delay(args.user, args.source, not args.skip_summaries, args.reset)
+        print(f"Queued backfill task {result.id} for user '{args.user}'.")
+        return
+
+    run_backfill(args.user, args.source, with_summaries=not args.skip_summaries, reset=args.reset)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# checkpoints.py
+
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from common.resources import mongo_db
+
+load_dotenv()
+
+DB_NAME = "summary_db"
+BACKFILL_COLLECTION = "backfill_checkpoints"
+
+
+def get_db():
+    """summary_db on the process's shared, fork-safe Mongo client."""
+    return mongo_db(DB_NAME)
+
+
+def _backfill_key(user_id: str, source: str) -> str:
+    return f"{user_id}:{source}"
+
+
+def load_backfill_offset(user_id: str, source: str) -> int:
+    """Returns the number of leading records of `source` already fully ingested."""
+    doc = get_db()[BACKFILL_COLLECTION].find_one({"_id": _backfill_key(user_id, source)}, {"offset": 1})
+    return doc["offset"] if doc else 0
+
+
+def save_backfill_offset(user_id: str, source: str, offset: int, stats: dict):
+    """Records that every record before `offset` is durable in Chroma and Mongo."""
+    get_db()[BACKFILL_COLLECTION].update_one(
+        {"_id": _backfill_key(user_id, source)},
+        {"$set": {
+            "user_id": user_id,
+            "source": source,
+            "offset": offset,
+            "stats": stats,
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+
+def reset_backfill(user_id: str, source: str):
+    """Forgets backfill progress so the next run starts from the first record."""
+    get_db()[BACKFILL_COLLECTION].delete_one({"_id": _backfill_key(user_id, source)})
+
+
+# === Per-document ingestion progress ===
+
+PROGRESS_COLLECTION = "ingestion_progress"
+PROGRESS_TTL_SECONDS = int(os.getenv("INGESTION_PROGRESS_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_progress_indexed = False
+
+
+def _progress_collection():
+    global _progress_indexed
+    collection = get_db()[PROGRESS_COLLECTION]
+    if not _progress_indexed:
+        collection.create_index("updated_at", expireAfterSeconds=PROGRESS_TTL_SECONDS)
+        _progress_indexed = True
+    return collection
+
+
+def _progress_key(payload: dict) -> str:
+    # A new sha256 means new content, so a modified file never resumes from its old version.
+    return f"{payload['user_id']}:{payload['uuid']}:{payload['sha256']}"
+
+
+def load_document_progress(payload: dict) -> dict:
+    """Returns the durable progress for this version of the document, or a fresh record."""
+    doc = _progress_collection().find_one({"_id": _progress_key(payload)})
+    return doc or {
+        "_id": _progress_key(payload),
+        "cleared": False,
+        "chunks_embedded": 0,
+        "chunks_written": 0,
+        "summary": None,
+        "summary_done": False,
+        "completed": False,
+    }
+
+
+def save_document_progress(payload: dict, **fields):
+    """Persists the given progress fields for this version of the document."""
+    fields["updated_at"] = datetime.utcnow()
+    _progress_collection().update_one(
+        {"_id": _progress_key(payload)},
+        {"$set": {"user_id": payload['user_id'], "file_path": payload.get('file_path', ''), **fields}},
+        upsert=True
+    )
+
+
+def clear_document_progress(user_id: str, file_path, keep: dict = None):
+    """Drops progress for every version of a file, or list of files, except `keep`."""
+    paths = [file_path] if isinstance(file_path, str) else list(file_path)
+    query = {"user_id": user_id, "file_path": {"$in": paths}}
+    if keep is not None:
+        query["_id"] = {"$ne": _progress_key(keep)}
+    _progress_collection().delete_many(query)
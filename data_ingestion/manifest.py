@@ -0,0 +1,71 @@
+# manifest.py
+"""
+Chunk manifests: for every ingested document, the uuid and chunk count that
+determine its Chroma ids (`{uuid}_{i}` and `summary_{uuid}`). Deletes and
+modifications use the manifest to remove vectors by id instead of asking
+Chroma to scan metadata for a filename.
+"""
+import re
+from datetime import datetime
+
+from data_ingestion.checkpoints import get_db
+
+MANIFEST_COLLECTION = "chunk_manifests"
+
+_manifest_indexed = False
+
+
+def _manifest_collection():
+    global _manifest_indexed
+    collection = get_db()[MANIFEST_COLLECTION]
+    if not _manifest_indexed:
+        collection.create_index([("user_id", 1), ("file_path", 1)], unique=True)
+        _manifest_indexed = True
+    return collection
+
+
+def record_manifest(payload: dict, chunk_count: int):
+    """Records the chunk ids a document owns. Called before its chunks are written."""
+    _manifest_collection().update_one(
+        {"user_id": payload['user_id'], "file_path": payload.get('file_path', '')},
+        {"$set": {
+            "uuid": payload['uuid'],
+            "sha256": payload['sha256'],
+            "chunk_count": chunk_count,
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+
+def get_manifests(user_id: str, file_paths: list) -> dict:
+    """Returns {file_path: manifest} for the given files that have a manifest."""
+    cursor = _manifest_collection().find(
+        {"user_id": user_id, "file_path": {"$in": list(file_paths)}},
+        {"file_path": 1, "uuid": 1, "chunk_count": 1}
+    )
+    return {m["file_path"]: m for m in cursor}
+
+
+def manifest_chunk_ids(manifest: dict) -> list:
+    return [f"{manifest['uuid']}_{i}" for i in range(manifest.get("chunk_count", 0))]
+
+
+def delete_manifests(user_id: str, file_paths: list):
+    _manifest_collection().delete_many({"user_id": user_id, "file_path": {"$in": list(file_paths)}})
+
+
+def scope_chunk_count(user_id: str, type: str, file_or_folder_path: str):
+    """Total chunks in a file or folder scope, or None when no manifest covers it."""
+    if type == "file":
+        query = {"user_id": user_id, "file_path": file_or_folder_path}
+    elif type == "folder":
+        prefix = file_or_folder_path.rstrip("/") + "/"
+        query = {"user_id": user_id, "file_path": {"$regex": f"^{re.escape(prefix)}"}}
+    else:
+        return None
+    result = list(_manifest_collection().aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "total": {"$sum": "$chunk_count"}}}
+    ]))
+    return result[0]["total"] if result else None
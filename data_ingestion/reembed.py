@@ -0,0 +1,235 @@
+# reembed.py
+"""
+Blue-green re-embedding of a tenant's chunks when EMBED_MODEL changes.
+
+Chunk texts and metadata are read back from the user's active Chroma
+collection, so nothing is re-extracted. Pages are embedded with the new model in
+REEMBED_WORKERS parallel batches and upserted into a shadow collection for the
+new version (`..._chunks__<version>`), while the next page is already being
+read. Progress is saved after every page in `rag_db.embedding_versions`, and a
+restarted job resumes from there.
+
+While the job runs, ingestion writes new and changed documents to both versions
+(see common/embedding_versions.py). A final reconcile pass then compares the two
+collections by id and text and fixes whatever changed during the copy. Queries
+stay on the active version until `--swap` flips the user in one update.
+`--rollback` flips back, and `--retire` drops the standby copy once it is no
+longer needed.
+
+    python -m data_ingestion.reembed --user shilpa --model nvidia/nv-embedqa-e5-v5
+    python -m data_ingestion.reembed --user shilpa --swap
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import tenancy, embedding_versions
+from common.hot_index import get_hot_index
+from common.metrics import CHUNKS
+from common.scope import folder_ancestor_metadata
+from data_ingestion.worker import app, CHROMA_MAX_BATCH, EMBED_BATCH_SIZE, get_embeddings, upsert_in_batches
+
+REEMBED_PAGE_SIZE = int(os.getenv("REEMBED_PAGE_SIZE", "1000"))
+REEMBED_WORKERS = int(os.getenv("REEMBED_WORKERS", "4"))
+
+
+def _embed_texts(pool, texts, model):
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    return [e for embeddings, _ in pool.map(lambda b: get_embeddings(b, model=model), batches) for e in embeddings]
+
+
+def _copy_page(pool, user_id, target_version, target, page):
+    """Embeds one page read from the source collection and writes it to the target version."""
+    if not page["ids"]:
+        return 0
+    embeddings = _embed_texts(pool, page["documents"], target_version["model"])
+    # Chunks from before ancestor-folder metadata get it here, so folder scopes match them in the new version.
+    metadatas = [
+        {**folder_ancestor_metadata(meta.get("folder_path") or os.path.dirname(meta.get("file_path", ""))), **meta}
+        for meta in (m or {} for m in page["metadatas"])
+    ]
+    upsert_in_batches(target, page["ids"], embeddings, page["documents"], metadatas, batch_size=CHROMA_MAX_BATCH)
+    hot_index = get_hot_index(user_id, target_version["version"])
+    if hot_index is not None:
+        hot_index.upsert(page["ids"], embeddings, page["documents"], metadatas)
+    CHUNKS.labels(operation="reembedded").inc(len(page["ids"]))
+    return len(page["ids"])
+
+
+def _text_hashes(collection):
+    hashes, offset = {}, 0
+    while True:
+        page = collection.get(include=["documents"], limit=REEMBED_PAGE_SIZE, offset=offset)
+        if not page["ids"]:
+            return hashes
+        hashes.update(
+            (chunk_id, hashlib.sha1((text or "").encode("utf-8")).digest())
+            for chunk_id, text in zip(page["ids"], page["documents"])
+        )
+        offset += REEMBED_PAGE_SIZE
+
+
+def reconcile(user_id, source, target, target_version, pool):
+    """Makes the target hold exactly the source's chunks. Returns (copied, removed)."""
+    source_hashes, target_hashes = _text_hashes(source), _text_hashes(target)
+    stale = sorted(cid for cid, digest in source_hashes.items() if target_hashes.get(cid) != digest)
+    extra = sorted(set(target_hashes) - set(source_hashes))
+    copied = 0
+    for start in range(0, len(stale), REEMBED_PAGE_SIZE):
+        page = source.get(ids=stale[start:start + REEMBED_PAGE_SIZE], include=["documents", "metadatas"])
+        copied += _copy_page(pool, user_id, target_version, target, page)
+    for start in range(0, len(extra), CHROMA_MAX_BATCH):
+        target.delete(ids=extra[start:start + CHROMA_MAX_BATCH])
+    hot_index = get_hot_index(user_id, target_version["version"])
+    if hot_index is not None and extra:
+        hot_index.delete_ids(extra)
+    return copied, len(extra)
+
+
+def run_reembed(user_id: str, model: str, version: str = None) -> dict:
+    """Builds (or resumes building) the user's `version` of their chunks with `model`."""
+    version = version or embedding_versions.version_slug(model)
+    progress = embedding_versions.begin_reembed(user_id, version, model)
+    state = embedding_versions.get_state(user_id, fresh=True)
+    if progress["status"] == "ready":
+        print(f"[INFO] Version '{version}' for {user_id} is already built. Swap with --swap.")
+        return progress
+
+    source = tenancy.chunk_collection(user_id, version=state["active"]["version"])
+    target = tenancy.chunk_collection(user_id, create=True, version=version)
+    target_version = state["standby"]
+    started = time.monotonic()
+    offset, copied = progress["offset"], progress["copied"]
+    total = source.count()
+    embedding_versions.save_progress(user_id, total=total, status="running", error=None)
+    print(f"[INFO] Re-embedding {total} chunks for {user_id} with {model} into '{version}', resuming at {offset}")
+
+    def read(at):
+        return source.get(include=["documents", "metadatas"], limit=REEMBED_PAGE_SIZE, offset=at)
+
+    try:
+        with ThreadPoolExecutor(max_workers=REEMBED_WORKERS) as pool, ThreadPoolExecutor(max_workers=1) as reader:
+            next_page = reader.submit(read, offset)
+            while True:
+                page = next_page.result()
+                if not page["ids"]:
+                    break
+                # Read ahead while this page is embedded.
+                next_page = reader.submit(read, offset + REEMBED_PAGE_SIZE)
+                copied += _copy_page(pool, user_id, target_version, target, page)
+                offset += REEMBED_PAGE_SIZE
+                embedding_versions.save_progress(user_id, offset=offset, copied=copied)
+                rate = copied / max(time.monotonic() - started, 1e-9)
+                print(f"[INFO] Re-embed {user_id}: {copied}/{total} chunks ({rate:.1f}/s)")
+
+            fixed, removed = reconcile(user_id, source, target, target_version, pool)
+    except Exception as e:
+        embedding_versions.save_progress(user_id, status="failed", error=str(e))
+        raise
+
+    embedding_versions.save_progress(user_id, status="ready", copied=copied + fixed)
+    result = {"user_id": user_id, "version": version, "copied": copied, "reconciled": fixed, "removed": removed}
+    print(f"[INFO] Re-embed complete: {result}")
+    return result
+
+
+def swap_user(user_id: str) -> dict:
+    """Catches the standby up with the active version, then serves the user from it."""
+    state = embedding_versions.get_state(user_id, fresh=True)
+    if not state["standby"]:
+        raise ValueError(f"{user_id} has no standby version")
+    source = tenancy.chunk_collection(user_id, version=state["active"]["version"])
+    target = tenancy.chunk_collection(user_id, version=state["standby"]["version"])
+    with ThreadPoolExecutor(max_workers=REEMBED_WORKERS) as pool:
+        fixed, removed = reconcile(user_id, source, target, state["standby"], pool)
+    print(f"[INFO] Caught up '{state['standby']['version']}' for {user_id}: {fixed} copied, {removed} removed")
+    return embedding_versions.swap(user_id)
+
+
+def retire_user(user_id: str):
+    """Drops the standby version: its collection, its hot index and the dual writes to it."""
+    standby = embedding_versions.retire_standby(user_id)
+    if standby is None:
+        return None
+    try:
+        tenancy.get_registry().drop_version(user_id, standby["version"])
+    except Exception as e:
+        print(f"[ERROR] Could not drop '{standby['version']}' for {user_id}: {e}")
+    hot_index = get_hot_index(user_id, standby["version"])
+    if hot_index is not None and hot_index.exists():
+        hot_index.drop()
+    return standby
+
+
+@app.task(bind=True, name="data_ingestion.reembed_user", acks_late=True)
+def reembed_user(self, user_id, model, version=None):
+    try:
+        return run_reembed(user_id, model, version)
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"[FATAL ERROR] Re-embed failed for {user_id}: {e}")
+        # Progress is saved per page, so a retry resumes rather than restarts.
+        raise self.retry(exc=e, countdown=30, max_retries=3)
+
+
+def print_status(user_id=None):
+    states = embedding_versions.list_states()
+    for state in states:
+        if user_id and state["user_id"] != user_id:
+            continue
+        active, standby, job = state.get("active") or {}, state.get("standby") or {}, state.get("reembed") or {}
+        line = f"  - {state['user_id']}: active '{active.get('version', '')}' ({active.get('model')})"
+        if standby:
+            line += f", standby '{standby['version']}' ({standby['model']})"
+        if job:
+            line += f", re-embed {job.get('status')} {job.get('copied', 0)}/{job.get('total')}"
+            if job.get("error"):
+                line += f" [{job['error']}]"
+        print(line)
+    if not states:
+        print("No users have been re-embedded; everyone is on the default version.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed a user's chunks with a new model and swap to them.")
+    parser.add_argument("--user", help="User id to re-embed, swap, roll back or retire.")
+    parser.add_argument("--model", help="Embedding model for the new version.")
+    parser.add_argument("--version", help="Version id. Defaults to a slug of the model name.")
+    parser.add_argument("--async", dest="use_celery", action="store_true", help="Queue the re-embed as a Celery task.")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--swap", action="store_true", help="Serve the user from the finished standby version.")
+    action.add_argument("--rollback", action="store_true", help="Swap back to the previous version.")
+    action.add_argument("--retire", action="store_true", help="Drop the standby version and stop writing to it.")
+    action.add_argument("--status", action="store_true", help="Show versions and re-embed progress.")
+    args = parser.parse_args()
+
+    if args.status:
+        print_status(args.user)
+        return
+    if not args.user:
+        parser.error("--user is required")
+
+    if args.swap:
+        active = swap_user(args.user)
+        print(f"✅ {args.user} is now served from '{active['version']}' ({active['model']}).")
+    elif args.rollback:
+        active = embedding_versions.swap(args.user, require_ready=False)
+        print(f"✅ Rolled {args.user} back to '{active['version']}' ({active['model']}).")
+    elif args.retire:
+        standby = retire_user(args.user)
+        print(f"✅ Retired '{standby['version']}' for {args.user}." if standby else f"{args.user} has no standby version.")
+    else:
+        if not args.model:
+            parser.error("--model is required to start a re-embed")
+        if args.use_celery:
+            result = reembed_user.delay(args.user, args.model, args.version)
+            print(f"Queued re-embed task {result.id} for user '{args.user}'.")
+            return
+        run_reembed(args.user, args.model, args.version)
+
+
+if __name__ == "__main__":
+    main()
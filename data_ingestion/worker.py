@@ -1,24 +1,30 @@
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-import requests
 from datetime import datetime
-from pymongo import MongoClient
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from chromadb import HttpClient  # CHANGED
 from celery import Celery
-import tiktoken
 
-MONGO_URI = os.getenv("MONGO_URI")
-CHROMA_HOST = os.getenv("CHROMA_HOST")  # CHANGED
-TEXT_URL = os.getenv("TEXT_URL")
-EMBED_URL = os.getenv("EMBED_URL")
+from common import model_client, tenancy
+from common.resilience import ModelCallError
+from common.scope import folder_ancestor_metadata
+from common.answer_cache import record_document_changes
+from common.lexical_index import get_lexical_index, check_lexical_index_dir
+from common.hot_index import get_hot_index, check_hot_index_dir
+from common.embedding_versions import write_versions
+from common.tokenizer import count_tokens
+from common.metrics import CHUNKS, TOKENS, stage_timer, observe_stage, record_llm_usage, install_worker_exporter
+from data_ingestion.checkpoints import get_db, load_document_progress, save_document_progress, clear_document_progress
+from data_ingestion.manifest import record_manifest, get_manifests, manifest_chunk_ids, delete_manifests
+
 EMBED_MODEL = os.getenv("EMBED_MODEL")
 SUMMARY_TOKEN_LIMIT = int(os.getenv("SUMMARY_TOKEN_LIMIT"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+CHROMA_MAX_BATCH = int(os.getenv("CHROMA_MAX_BATCH", "1000"))
 
-app = Celery('data_ingestion_app', broker=os.getenv('BROKER_URL'), backend=os.getenv('BACKEND_URL'), include=['data_ingestion.worker'])
+app = Celery('data_ingestion_app', broker=os.getenv('BROKER_URL'), backend=os.getenv('BACKEND_URL'), include=['data_ingestion.worker', 'data_ingestion.backfill', 'data_ingestion.reembed'])
 
 app.conf.task_default_queue = 'data_ingestion_queue'
 app.conf.task_queues = {
@@ -30,48 +36,87 @@ app.conf.task_queues = {
 app.conf.task_routes = {
     'data_ingestion.*': {'queue': 'data_ingestion_queue'},
 }
+install_worker_exporter("data_ingestion")
+check_hot_index_dir()
+check_lexical_index_dir()
+
+
+SUMMARY_COLLECTION = "file_summaries"
+
+_summary_indexed = False
 
 
 def get_mongo_collection():
-    client = MongoClient(MONGO_URI)
-    return client['summary_db']['collection_of_summaries']
+    """Returns summary_db.file_summaries, which holds one document per (user_id, file_path)."""
+    global _summary_indexed
+    collection = get_db()[SUMMARY_COLLECTION]
+    if not _summary_indexed:
+        collection.create_index([("user_id", 1), ("file_path", 1)], unique=True)
+        collection.create_index("uuid")
+        _summary_indexed = True
+    return collection
 
 
 def call_llm(prompt):
     try:
-        res = requests.post(TEXT_URL, json={
+        res = model_client.post("text", {
             "model": "meta/llama-3.1-70b-instruct",
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": 2048
-        }, headers={"Content-Type": "application/json"})
-        return res.json()["choices"][0]["message"]["content"]
+        })
+        body = res.json()
+        record_llm_usage(body)
+        return body["choices"][0]["message"]["content"]
     except Exception as e:
+        # Surface the failure so the task retries instead of storing a placeholder summary.
         print(f"[ERROR] LLM call failed: {e}")
-        return "Summary generation failed."
+        raise ModelCallError(f"LLM call failed: {e}") from e
+
+
+def get_embeddings(texts, input_type="passage", model=None):
+    """Embeds texts in batches of EMBED_BATCH_SIZE with `model` (default EMBED_MODEL).
+
+    Returns (embeddings, token_count). Raises ModelCallError once the client
+    has exhausted its retries, so a partial document is never written.
+    """
+    embeddings, tokens = [], 0
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        res = model_client.post("embed", {
+            "input": batch, "model": model or EMBED_MODEL, "input_type": input_type
+        })
+        body = res.json()
+        data = sorted(body["data"], key=lambda d: d.get("index", 0))
+        embeddings.extend(d["embedding"] for d in data)
+        tokens += body.get("usage", {}).get("total_tokens") or sum(count_tokens(t) for t in batch)
+    TOKENS.labels(kind="embedding").inc(tokens)
+    return embeddings, tokens
+
+
+def upsert_in_batches(collection, ids, embeddings, documents, metadatas, batch_size=None):
+    """Upserts into Chroma in slices of at most CHROMA_MAX_BATCH records."""
+    batch_size = batch_size or CHROMA_MAX_BATCH
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        with stage_timer("chroma_write"):
+            collection.upsert(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                documents=documents[start:end],
+                metadatas=metadatas[start:end]
+            )
 
 
-def get_embedding(text, input_type="passage"):
-    try:
-        res = requests.post(EMBED_URL, json={
-            "input": [text], "model": EMBED_MODEL, "input_type": input_type
-        }, headers={"Content-Type": "application/json"})
-        return res.json()["data"][0]["embedding"]
-    except Exception as e:
-        print(f"[ERROR] Embedding call failed: {e}")
-        return []
+_splitter = None
 
 
 def chunk_text(text):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
-    return splitter.split_text(text)
-
-
-def count_tokens(text, model="llama"):
-    try:
-        enc = tiktoken.encoding_for_model(model)
-    except KeyError:
-        enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+    global _splitter
+    if _splitter is None:
+        # langchain takes longer to import than the rest of the worker; only chunking needs it.
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        _splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
+    return _splitter.split_text(text)
 
 
 def summarize_text(text):
@@ -90,129 +135,215 @@ def summarize_text(text):
         return call_llm(merged_summary_prompt)
 
 
+def build_chunk_records(payload, chunks, embeddings, first_index=0):
+    """Pairs chunks with their embeddings and Chroma metadata, skipping failed embeddings."""
+    ids, documents, metadatas, valid_embeddings = [], [], [], []
+    for idx, (chunk, emb) in enumerate(zip(chunks, embeddings), start=first_index):
+        if not emb:
+            continue
+        ids.append(f"{payload['uuid']}_{idx}")
+        documents.append(chunk)
+        valid_embeddings.append(emb)
+        metadatas.append({
+            "user_id": payload['user_id'],
+            "filename": payload['file_name'],
+            "file_path": payload.get('file_path', ''),
+            "folder_path": payload.get('folder_path', ''),
+            "uuid": payload['uuid'],
+            "sha256": payload['sha256'],
+            "chunk_index": idx,
+            "timestamp": datetime.utcnow().isoformat(),
+            **folder_ancestor_metadata(payload.get('folder_path', ''))
+        })
+    return ids, documents, metadatas, valid_embeddings
+
+
+def store_summary(payload, summary, mongo_collection, summary_collection):
+    """Upserts the file's summary document in Mongo and its entry in the Chroma summary collection."""
+    user_id = payload['user_id']
+    file_name = payload['file_name']
+    file_uuid = payload['uuid']
+
+    summary_metadata = {
+        "uuid": file_uuid,
+        "filename": file_name,
+        "file_path": payload.get('file_path', ''),
+        "folder_path": payload.get('folder_path', ''),
+        "sha256": payload['sha256'],
+        "status": payload['status'].lower(),
+        "summary": summary,
+        "last_updated": payload.get("last_updated", datetime.utcnow().isoformat())
+    }
+
+    mongo_collection.update_one(
+        {"user_id": user_id, "file_path": summary_metadata["file_path"]},
+        {"$set": {"user_id": user_id, **summary_metadata}},
+        upsert=True
+    )
+    print(f"[INFO] Stored summary for {file_name} under user {user_id}")
+
+    # Store in Chroma summary collection
+    chroma_summary_metadata = {
+        k: str(v) if isinstance(v, datetime) else v
+        for k, v in summary_metadata.items()
+    }
+    chroma_summary_metadata.update(folder_ancestor_metadata(summary_metadata["folder_path"]))
+
+    summary_collection.upsert(
+        documents=[summary],
+        metadatas=[chroma_summary_metadata],
+        ids=[f"summary_{file_uuid}"]
+    )
+    print(f"[INFO] Summary stored in Chroma for {file_name}")
+
+
+def chunk_targets(user_id):
+    """[(embedding version, chunk collection)] that ingestion must keep current: the
+    user's active version first, then the standby being re-embedded or kept for rollback."""
+    return [
+        (version, tenancy.chunk_collection(user_id, create=True, version=version["version"]))
+        for version in write_versions(user_id)
+    ]
+
+
+def delete_documents(user_id, file_paths, targets, summary_collection, mongo_collection, keep=None):
+    """Removes the vectors, summaries and manifests of `file_paths` using direct id deletes.
+
+    `targets` come from chunk_targets(). Files ingested before manifests existed fall
+    back to a file_path metadata filter. Returns the number of chunk ids deleted.
+    """
+    file_paths = list(file_paths)
+    manifests = get_manifests(user_id, file_paths)
+    chunk_ids, summary_ids = [], []
+    for manifest in manifests.values():
+        chunk_ids.extend(manifest_chunk_ids(manifest))
+        summary_ids.append(f"summary_{manifest['uuid']}")
+
+    for _, collection in targets:
+        for start in range(0, len(chunk_ids), CHROMA_MAX_BATCH):
+            collection.delete(ids=chunk_ids[start:start + CHROMA_MAX_BATCH])
+    for start in range(0, len(summary_ids), CHROMA_MAX_BATCH):
+        summary_collection.delete(ids=summary_ids[start:start + CHROMA_MAX_BATCH])
+
+    for path in file_paths:
+        if path not in manifests:
+            for _, collection in targets:
+                collection.delete(where={"file_path": path})
+            summary_collection.delete(where={"file_path": path})
+
+    get_lexical_index(user_id).delete_files(file_paths)
+    for version, _ in targets:
+        hot_index = get_hot_index(user_id, version["version"])
+        if hot_index is not None:
+            hot_index.delete_files(file_paths)
+    mongo_collection.delete_many({"user_id": user_id, "file_path": {"$in": file_paths}})
+    delete_manifests(user_id, file_paths)
+    clear_document_progress(user_id, file_paths, keep=keep)
+    record_document_changes(user_id, file_paths)
+    CHUNKS.labels(operation="deleted").inc(len(chunk_ids))
+    return len(chunk_ids)
+
+
+@app.task(bind=True, name="data_ingestion.bulk_delete_files")
+def bulk_delete_files(self, user_id, file_paths):
+    """Deletes many files for one user (e.g. a removed folder) in a single pass."""
+    try:
+        deleted = delete_documents(
+            user_id, file_paths, chunk_targets(user_id),
+            tenancy.summary_collection(user_id, create=True), get_mongo_collection()
+        )
+        print(f"[INFO] Bulk-deleted {len(file_paths)} files ({deleted} chunks) for user {user_id}")
+    except Exception as e:
+        print(f"[FATAL ERROR] Bulk delete failed for {user_id}: {e}")
+        raise self.retry(exc=e, countdown=10, max_retries=3)
+
+
+def embed_and_write_chunks(payload, chunks, targets, start=0):
+    """Embeds and upserts chunks[start:] one batch at a time, checkpointing after each write.
+
+    Each batch is embedded once per target from chunk_targets(), with that version's model.
+    Returns the number of chunks written to the active version by this call.
+    """
+    written = 0
+    for batch_start in range(start, len(chunks), EMBED_BATCH_SIZE):
+        batch = chunks[batch_start:batch_start + EMBED_BATCH_SIZE]
+        records = []
+        for version, _ in targets:
+            embeddings, _ = get_embeddings(batch, model=version["model"])
+            records.append(build_chunk_records(payload, batch, embeddings, batch_start))
+        save_document_progress(payload, chunks_embedded=batch_start + len(batch))
+        for (version, collection), (ids, documents, metadatas, valid_embeddings) in zip(targets, records):
+            if not valid_embeddings:
+                continue
+            upsert_in_batches(collection, ids, valid_embeddings, documents, metadatas)
+            hot_index = get_hot_index(payload['user_id'], version["version"])
+            if hot_index is not None:
+                hot_index.upsert(ids, valid_embeddings, documents, metadatas)
+        ids, documents, metadatas, valid_embeddings = records[0]
+        if valid_embeddings:
+            get_lexical_index(payload['user_id']).upsert_chunks(ids, documents, metadatas)
+        save_document_progress(payload, chunks_written=batch_start + len(batch), chunk_count=len(chunks))
+        CHUNKS.labels(operation="written").inc(len(valid_embeddings))
+        written += len(valid_embeddings)
+    return written
+
+
 @app.task(bind=True)
 def process_file(self, payload):
+    started = time.monotonic()
     try:
         user_id = payload['user_id']
         file_name = payload['file_name']
-        file_uuid = payload['uuid']
-        sha256 = payload['sha256']
-        file_path = payload.get('file_path', '')
-        folder_path = payload.get('folder_path', '')
         status = payload['status'].lower()
-        last_updated = payload.get("last_updated", datetime.utcnow().isoformat())
         extracted_text = payload.get('extracted_text', {})
         text = "\n".join(extracted_text.values())
 
-        collection_name = f"{user_id}_chunks"
-        summary_collection_name = f"{user_id}_summaries"
-
         mongo_collection = get_mongo_collection()
 
-        # CHANGED: use HttpClient instead of PersistentClient
-        chroma_client = HttpClient(host=CHROMA_HOST)
-
-        collection = chroma_client.get_or_create_collection(name=collection_name)
-        summary_collection = chroma_client.get_or_create_collection(name=summary_collection_name)
+        # Handles are cached per worker process and follow CHROMA_TENANCY.
+        targets = chunk_targets(user_id)
+        summary_collection = tenancy.summary_collection(user_id, create=True)
 
         if status == 'deleted':
-            collection.delete(where={"filename": file_name})
-            summary_collection.delete(where={"filename": file_name})
-            mongo_collection.update_one(
-                {"user_id": user_id},
-                {"$pull": {"files": {"filename": file_name}}}
-            )
+            delete_documents(user_id, [payload.get('file_path', '')], targets, summary_collection, mongo_collection)
             print(f"[INFO] Deleted all vectors and metadata for {file_name}")
             return
 
-        if status == 'modified':
-            collection.delete(where={"filename": file_name})
-            summary_collection.delete(where={"filename": file_name})
-            mongo_collection.update_one(
-                {"user_id": user_id},
-                {"$pull": {"files": {"filename": file_name}}}
+        progress = load_document_progress(payload)
+        if progress["completed"]:
+            print(f"[INFO] {file_name} already ingested at this version, skipping")
+            return
+
+        if status == 'modified' and not progress["cleared"]:
+            delete_documents(
+                user_id, [payload.get('file_path', '')], targets, summary_collection, mongo_collection, keep=payload
             )
+            save_document_progress(payload, cleared=True)
             print(f"[INFO] Cleared old data for modified file {file_name}")
 
         if status in ('add', 'modified'):
             chunks = chunk_text(text)
             print(f"[INFO] Chunking complete: {len(chunks)} chunks")
 
-            ids, embeddings, metadatas = [], [], []
-            for idx, chunk in enumerate(chunks):
-                emb = get_embedding(chunk)
-                if not emb:
-                    continue
-                ids.append(f"{file_uuid}_{idx}")
-                embeddings.append(emb)
-                metadatas.append({
-                    "user_id": user_id,
-                    "filename": file_name,
-                    "file_path": file_path,
-                    "folder_path": folder_path,
-                    "uuid": file_uuid,
-                    "sha256": sha256,
-                    "chunk_index": idx,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-
-            if embeddings:
-                collection.add(ids=ids, embeddings=embeddings, documents=chunks, metadatas=metadatas)
-                print(f"[INFO] Stored {len(embeddings)} embeddings for {file_name}")
-            else:
-                print(f"[WARN] No valid embeddings generated for {file_name}")
+            start = progress["chunks_written"]
+            record_manifest(payload, len(chunks))
+            if start:
+                print(f"[INFO] Resuming {file_name} at chunk {start}/{len(chunks)}")
+            stored = embed_and_write_chunks(payload, chunks, targets, start)
+            print(f"[INFO] Stored {stored} embeddings for {file_name}")
 
             # Generate and store summary using token-limit-aware approach
-            summary = summarize_text(text)
-
-            user_doc = mongo_collection.find_one({"user_id": user_id})
-
-            summary_metadata = {
-                "uuid": file_uuid,
-                "filename": file_name,
-                "file_path": file_path,
-                "folder_path": folder_path,
-                "sha256": sha256,
-                "status": status,
-                "summary": summary,
-                "last_updated": last_updated
-            }
-
-            if user_doc:
-                existing_files = user_doc.get("files", [])
-                file_exists = any(f["filename"] == file_name for f in existing_files)
-                if file_exists:
-                    mongo_collection.update_one(
-                        {"user_id": user_id, "files.filename": file_name},
-                        {"$set": {"files.$": summary_metadata}}
-                    )
-                    print(f"[INFO] Updated existing summary for {file_name} under user {user_id}")
-                else:
-                    mongo_collection.update_one(
-                        {"user_id": user_id},
-                        {"$push": {"files": summary_metadata}}
-                    )
-                    print(f"[INFO] Added new summary for {file_name} under user {user_id}")
-            else:
-                new_user_doc = {
-                    "user_id": user_id,
-                    "files": [summary_metadata]
-                }
-                mongo_collection.insert_one(new_user_doc)
-                print(f"[INFO] Created new user entry for {user_id} with file {file_name}")
-
-            # Store in Chroma summary collection
-            chroma_summary_metadata = {
-                k: str(v) if isinstance(v, datetime) else v
-                for k, v in summary_metadata.items()
-            }
-
-            summary_collection.add(
-                documents=[summary],
-                metadatas=[chroma_summary_metadata],
-                ids=[f"summary_{file_uuid}"]
-            )
-            print(f"[INFO] Summary stored in Chroma for {file_name}")
+            if not progress["summary_done"]:
+                summary = progress["summary"]
+                if summary is None:
+                    summary = summarize_text(text)
+                    save_document_progress(payload, summary=summary)
+                store_summary(payload, summary, mongo_collection, summary_collection)
+                save_document_progress(payload, summary_done=True)
+
+            save_document_progress(payload, completed=True)
+            record_document_changes(user_id, [payload.get('file_path', '')])
+            observe_stage("ingest", time.monotonic() - started)
 
     except Exception as e:
         print(f"[FATAL ERROR] Task failed: {e}")
@@ -1,9 +1,24 @@
-import requests
+import asyncio
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from chromadb import HttpClient  # ✅ UPDATED
-from pymongo import MongoClient
 from datetime import datetime
+from common import model_client, tenancy
+from common.embedding_service import QueryEmbeddingService, EMBED_CACHE_SIZE
+from common.reranker import Reranker
+from common.lexical_index import get_lexical_index, reciprocal_rank_fusion
+from common.hot_index import get_hot_index
+from common.scope import scope_where, in_scope
+from common.scope_backfill import legacy_scope_pending
+from common.tokenizer import count_tokens, count_message_tokens
+from common.context_packer import pack_context
+from common.deadline import Deadline
+from common.metrics import TOKENS, stage_timer, record_cache, record_llm_usage
+from common.embedding_versions import active_version, default_version
+from common.chat_history import get_recent_turns, append_turn, claim_title, set_objective
+from common.answer_cache import answer_cache, scope_changed_since, ANSWER_CACHE_ENABLED, ANSWER_CACHE_SEMANTIC
+from data_ingestion.manifest import scope_chunk_count
 
 # ---- Load Environment Variables ----
 load_dotenv()
@@ -14,120 +29,157 @@ EMBED_URL = os.getenv("EMBED_URL")
 EMBED_MODEL = os.getenv("EMBED_MODEL")
 RERANK_URL = os.getenv("RERANK_URL")
 RERANK_MODEL = os.getenv("RERANK_MODEL")
-CHROMA_HOST = os.getenv("CHROMA_HOST")  # ✅ UPDATED
+RAG_IO_THREADS = int(os.getenv("RAG_IO_THREADS", "32"))
+RAG_MAX_CANDIDATES = int(os.getenv("RAG_MAX_CANDIDATES", "100"))
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+LEXICAL_CANDIDATES = int(os.getenv("LEXICAL_CANDIDATES", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+SUMMARY_ROUTING = os.getenv("SUMMARY_ROUTING", "off").lower()  # "off", "on" or "auto"
+SUMMARY_ROUTING_TOP_FILES = int(os.getenv("SUMMARY_ROUTING_TOP_FILES", "20"))
+SUMMARY_ROUTING_MIN_FILES = int(os.getenv("SUMMARY_ROUTING_MIN_FILES", "2000"))
+SUMMARY_COUNT_TTL = 300
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", str(RAG_MAX_CANDIDATES)))
+RERANK_DISTANCE_MARGIN = float(os.getenv("RERANK_DISTANCE_MARGIN", "0"))  # 0 disables
+RERANK_DISTANCE_GAP = float(os.getenv("RERANK_DISTANCE_GAP", "0"))  # 0 disables
+RERANK_MIN_CANDIDATES = int(os.getenv("RERANK_MIN_CANDIDATES", "10"))
+RERANK_MIN_BUDGET_MS = int(os.getenv("RERANK_MIN_BUDGET_MS", "150"))
+RERANK_FULL_BUDGET_MS = int(os.getenv("RERANK_FULL_BUDGET_MS", "800"))
+RERANK_DEGRADED_CANDIDATES = int(os.getenv("RERANK_DEGRADED_CANDIDATES", "20"))
+RAG_BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))
+RAG_BATCH_MAX_CONCURRENCY = int(os.getenv("RAG_BATCH_MAX_CONCURRENCY", "32"))
+RAG_BATCH_QUERY_SIZE = int(os.getenv("RAG_BATCH_QUERY_SIZE", "16"))
+
+# ---- Blocking I/O Boundary ----
+# Chroma's HttpClient and pymongo are synchronous, so the async pipeline hands their calls
+# to a dedicated, bounded pool instead of blocking the event loop or uvicorn's threadpool.
+_io_executor = ThreadPoolExecutor(max_workers=RAG_IO_THREADS, thread_name_prefix="rag-io")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, lambda: fn(*args, **kwargs))
 
-# ---- MongoDB ----
-MONGO_URI = os.getenv("MONGO_URI")
-
-# ---- MongoDB Setup ----
-mongo_client = MongoClient(MONGO_URI)
-mongo_db = mongo_client["rag_db"]
-chat_collection = mongo_db["chat_history"]
+# ---- Embedding ----
+# Shared by all requests in this process: LRU for repeats, micro-batching for bursts.
+# Users re-embedded with another model (see common/embedding_versions.py) get their own service.
+# Batch queries go through BATCH-priority services that bypass the LRU.
+query_embeddings = QueryEmbeddingService(EMBED_MODEL)
+_query_embedders = {(EMBED_MODEL, model_client.INTERACTIVE): query_embeddings}
+
+
+def query_embedder(model, priority=model_client.INTERACTIVE):
+    service = _query_embedders.get((model, priority))
+    if service is None:
+        cache_size = 0 if priority == model_client.BATCH else EMBED_CACHE_SIZE
+        service = _query_embedders.setdefault(
+            (model, priority), QueryEmbeddingService(model, cache_size=cache_size, priority=priority)
+        )
+    return service
 
-# ---- ChromaDB (Remote) ----
-chroma_client = HttpClient(host=CHROMA_HOST)  # ✅ UPDATED
 
-# ---- Embedding ----
-def get_embedding(query):
+async def get_embedding(query, model=None, priority=model_client.INTERACTIVE):
     try:
-        res = requests.post(EMBED_URL, json={
-            "input": [query],
-            "model": EMBED_MODEL,
-            "input_type": "query"
-        }, headers={"Content-Type": "application/json"})
-        return res.json()["data"][0]["embedding"]
+        return await query_embedder(model or EMBED_MODEL, priority).embed(query)
     except Exception as e:
         print(f"[Embedding Error] {e}")
         return []
 
-# ---- Reranking ----
-def rerank_chunks(query, passages):
-    try:
-        payload = {
-            "model": RERANK_MODEL,
-            "query": {"text": query},
-            "passages": [{"text": p} for p in passages],
-            "truncate": "END"
-        }
-        res = requests.post(RERANK_URL, json=payload, headers={"Content-Type": "application/json"})
-        data = res.json()
 
-        if "rankings" not in data:
-            print(f"[Rerank API Response Missing 'rankings']: {data}")
-            return [(p, None) for p in passages]  # fallback: no scores
+async def get_embedding_version(user_id):
+    """The user's active {"version", "model"}; queries must embed with the model whose vectors they search."""
+    try:
+        return await run_blocking(active_version, user_id)
+    except Exception as e:
+        print(f"[Embedding Version Error] {e}. Using the default version.")
+        return default_version()
 
-        ranks = data["rankings"]
-        ranked_passages = sorted(ranks, key=lambda x: -x["logit"])
-        return [(passages[r["index"]], r["logit"]) for r in ranked_passages]
+# ---- Reranking ----
+# Shared score cache and sub-batching for all requests in this process.
+reranker = Reranker(RERANK_MODEL)
 
-    except Exception as e:
-        print(f"[Rerank Error] {e}")
-        return [(p, None) for p in passages]
+async def rerank_chunks(query, passages, priority=model_client.INTERACTIVE):
+    return await reranker.rerank(query, passages, priority)
 
 # ---- Get Session History ----
 def get_session_history(user_id, session_id):
-    user_doc = chat_collection.find_one({"user_id": user_id})
-    if not user_doc:
+    """Only the last CHAT_HISTORY_TURNS turns are replayed into the prompt."""
+    return get_recent_turns(user_id, session_id)
+
+
+async def load_session_history(user_id, session_id):
+    try:
+        return await run_blocking(get_session_history, user_id, session_id)
+    except Exception as e:
+        print(f"[Session History Error] {e}")
         return []
-    
-    session = next((s for s in user_doc.get("sessions", []) if s["session_id"] == session_id), None)
-    return session.get("history", []) if session else []
 
 # ---- Objective Generation ----
-def generate_objective_from_query(user_query):
+def placeholder_objective(user_query):
+    return user_query[:60] + "..."
+
+
+async def generate_objective_from_query(user_query):
     try:
         prompt = f"You are generating a session title (3-6 words) based on the user query and the retrieved document content. Do NOT guess or hallucinate names, professions, or entities. Only use information explicitly present in the retrieved content. If the full name is not mentioned, use a neutral placeholder like Profile Summary. And only respond with title.: '{user_query}'"
-        res = requests.post(TEXT_URL, json={
+        # Titles are generated off the request path, so they yield to interactive traffic.
+        res = await model_client.async_post("text", {
             "model": "meta/llama-3.1-70b-instruct",
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": 20
-        }, headers={"Content-Type": "application/json"})
+        }, priority=model_client.BATCH)
         return res.json()["choices"][0]["message"]["content"].strip().strip('"')
     except Exception as e:
         print(f"[Objective Generation Error] {e}")
-        return user_query[:60] + "..."
+        return placeholder_objective(user_query)
+
+
+_title_tasks = {}
+
+
+async def _generate_session_title(user_id, session_id, user_query):
+    try:
+        # The claim makes generation happen once per session across all API workers.
+        if not await run_blocking(claim_title, user_id, session_id):
+            return
+        objective = await generate_objective_from_query(user_query)
+        await run_blocking(set_objective, user_id, session_id, objective)
+    except Exception as e:
+        print(f"[Session Title Error] {e}")
+
+
+def schedule_session_title(user_id, session_id, user_query):
+    """Starts background title generation unless one is already running for the session."""
+    key = (user_id, session_id)
+    if key in _title_tasks:
+        return
+    task = asyncio.get_running_loop().create_task(_generate_session_title(user_id, session_id, user_query))
+    _title_tasks[key] = task
+    task.add_done_callback(lambda _: _title_tasks.pop(key, None))
+
+
+async def wait_for_session_titles():
+    """Lets pending title generation finish, e.g. before a script's event loop closes."""
+    if _title_tasks:
+        await asyncio.gather(*list(_title_tasks.values()), return_exceptions=True)
 
 # ---- Update Chat History ----
 def update_session_history(user_id, session_id, user_query, assistant_answer):
-    user_doc = chat_collection.find_one({"user_id": user_id})
-    
-    if not user_doc:
-        objective = generate_objective_from_query(user_query)
-        chat_collection.insert_one({
-            "user_id": user_id,
-            "sessions": [{
-                "session_id": session_id,
-                "objective": objective,
-                "created_at": datetime.utcnow(),
-                "history": [{"query": user_query, "answer": assistant_answer}]
-            }]
-        })
-    else:
-        sessions = user_doc.get("sessions", [])
-        session_index = next((i for i, s in enumerate(sessions) if s["session_id"] == session_id), None)
-
-        if session_index is None:
-            objective = generate_objective_from_query(user_query)
-            chat_collection.update_one(
-                {"user_id": user_id},
-                {"$push": {
-                    "sessions": {
-                        "session_id": session_id,
-                        "objective": objective,
-                        "created_at": datetime.utcnow(),
-                        "history": [{"query": user_query, "answer": assistant_answer}]
-                    }
-                }}
-            )
-        else:
-            history_path = f"sessions.{session_index}.history"
-            chat_collection.update_one(
-                {"user_id": user_id},
-                {"$push": {history_path: {"query": user_query, "answer": assistant_answer}}}
-            )
+    """Returns True when this turn started a new session, which still has a placeholder title."""
+    session = append_turn(
+        user_id, session_id, user_query, assistant_answer, objective=placeholder_objective(user_query)
+    )
+    return session["turn_count"] == 1
+
+
+async def save_turn(user_id, session_id, user_query, assistant_answer):
+    if await run_blocking(update_session_history, user_id, session_id, user_query, assistant_answer):
+        schedule_session_title(user_id, session_id, user_query)
 
 # ---- Call LLM ----
-def call_llm_rag(user_query, context_chunks, history):
+LLM_ERROR_ANSWER = "Sorry, the assistant couldn't answer due to an internal error."
+
+
+def build_rag_messages(user_query, context_chunks, history):
     joined_context = "\n---\n".join(context_chunks)
 
     prior_msgs = []
@@ -135,73 +187,366 @@ def call_llm_rag(user_query, context_chunks, history):
         prior_msgs.append({"role": "user", "content": item["query"]})
         prior_msgs.append({"role": "assistant", "content": item["answer"]})
 
-    full_messages = prior_msgs + [
+    return prior_msgs + [
         {"role": "system", "content": "You are a QA assistant. Please answer only from the given context. If the query is not related to the context, please reply with 'I don't know the answer.'"},
         {"role": "user", "content": f"Context:\n{joined_context}\n\nQuestion: {user_query}\nAnswer:"}
     ]
 
+
+async def call_llm_rag(user_query, context_chunks, history, priority=model_client.INTERACTIVE, wait_timeout=None):
+    """`wait_timeout` bounds the wait for a limiter slot (default: the client's INTERACTIVE_WAIT_TIMEOUT)."""
+    full_messages = build_rag_messages(user_query, context_chunks, history)
+
     try:
-        res = requests.post(TEXT_URL, json={
+        res = await model_client.async_post("text", {
             "model": "meta/llama-3.1-70b-instruct",
             "messages": full_messages,
             "max_tokens": 1024
-        }, headers={"Content-Type": "application/json"})
-        return res.json()["choices"][0]["message"]["content"]
+        }, priority=priority, wait_timeout=wait_timeout)
+        body = res.json()
+        record_llm_usage(body)
+        return body["choices"][0]["message"]["content"]
     except Exception as e:
         print(f"[LLM Error] {e}")
-        return "Sorry, the assistant couldn't answer due to an internal error."
+        return LLM_ERROR_ANSWER
 
-# ---- Main RAG Pipeline ----
-def rag_pipeline(
-    user_id: str,
-    session_id: str,
-    user_query: str,
-    type: str,
-    file_or_folder_path: str = "",
-    top_k: int = 5
-):
-    print(f"\n[INFO] RAG for user='{user_id}', session='{session_id}', query='{user_query}'")
 
-    # Step 1: Embed the query
-    query_embedding = get_embedding(user_query)
-    if not query_embedding:
-        return "Embedding failed. Cannot process your request."
+async def stream_llm_rag(user_query, context_chunks, history, wait_timeout=None):
+    """Yields answer tokens as the LLM produces them."""
+    async for token in model_client.async_stream("text", {
+        "model": "meta/llama-3.1-70b-instruct",
+        "messages": build_rag_messages(user_query, context_chunks, history),
+        "max_tokens": 1024
+    }, wait_timeout=wait_timeout):
+        yield token
+
+# ---- Scope Sizing ----
+async def _get_scope_size(user_id, type, file_or_folder_path):
+    if type == "all":
+        return None
+    try:
+        return await run_blocking(scope_chunk_count, user_id, type, file_or_folder_path)
+    except Exception as e:
+        print(f"[Scope Size Error] {e}")
+        return None
+
+
+def candidate_count(scope_size, top_k):
+    """Asks Chroma for every chunk of a small scope, capped at RAG_MAX_CANDIDATES."""
+    if scope_size is None:
+        return RAG_MAX_CANDIDATES
+    return max(top_k, min(scope_size, RAG_MAX_CANDIDATES))
+
+# ---- Summary Routing ----
+_summary_counts = {}
+
+
+async def _summary_count(user_id, collection):
+    cached = _summary_counts.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    count = await run_blocking(collection.count)
+    _summary_counts[user_id] = (count, time.monotonic() + SUMMARY_COUNT_TTL)
+    return count
+
+
+async def route_by_summaries(user_id, user_query, type, file_or_folder_path):
+    """Stage one of two-stage retrieval: uuids of the files whose summaries best match the query.
+
+    Returns None when chunk search should not be restricted (routing off, a single-file
+    scope, a corpus below SUMMARY_ROUTING_MIN_FILES in "auto" mode, no summaries, or a
+    folder scope whose summaries may still lack ancestor-folder metadata).
+    """
+    if SUMMARY_ROUTING not in ("on", "auto") or type == "file":
+        return None
+    where = scope_where(type, file_or_folder_path)
+    if await _legacy_scope(user_id, type, where):
+        return None
+    try:
+        collection = await run_blocking(tenancy.summary_collection, user_id)
+        if SUMMARY_ROUTING == "auto" and await _summary_count(user_id, collection) < SUMMARY_ROUTING_MIN_FILES:
+            return None
+        # Summaries are written with the collection's own embedding function, so it embeds the query too.
+        results = await run_blocking(
+            collection.query,
+            query_texts=[user_query],
+            n_results=SUMMARY_ROUTING_TOP_FILES,
+            where=where,
+            include=["metadatas"]
+        )
+        uuids = list(dict.fromkeys(m["uuid"] for m in results["metadatas"][0] if m.get("uuid")))
+        return uuids or None
+    except Exception as e:
+        print(f"[Summary Routing Error] {e}")
+        return None
+
+# ---- Answer Cache ----
+async def _reuse(value):
+    return value
+
+
+async def lookup_cached_answer(user_id, type, file_or_folder_path, user_query, version):
+    """Returns (cached_response, query_embedding).
+
+    The embedding is only computed for the semantic lookup, with the model of the
+    user's embedding `version`, and is handed back so a miss does not embed the query twice.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None, None
+    query_embedding = None
+    entry = answer_cache.get(user_id, type, file_or_folder_path, user_query)
+    if entry is None and ANSWER_CACHE_SEMANTIC:
+        query_embedding = await get_embedding(user_query, version["model"])
+        entry = await run_blocking(
+            answer_cache.get_similar, user_id, type, file_or_folder_path, query_embedding, _cache_version(version)
+        )
+    if entry is None:
+        record_cache("answer", misses=1)
+        return None, query_embedding
+    try:
+        stale = await run_blocking(scope_changed_since, user_id, type, file_or_folder_path, entry["started_at"])
+    except Exception as e:
+        print(f"[Answer Cache Error] {e}")
+        stale = True
+    if stale:
+        answer_cache.invalidate(entry)
+        record_cache("answer", misses=1)
+        return None, query_embedding
+    record_cache("answer", hits=1)
+    return entry["response"], query_embedding
+
+
+def _response_metadata(response):
+    return {k: v for k, v in response.items() if k != "answer"}
+
+
+def _cache_version(version):
+    # Embeddings are only comparable within one embedding version and model.
+    return f"{version['version']}|{version['model']}"
+
+
+def store_cached_answer(user_id, type, file_or_folder_path, user_query, response, query_embedding, started_at, version):
+    # Answers built from a degraded pipeline are not worth repeating.
+    if ANSWER_CACHE_ENABLED and response["answer"] != LLM_ERROR_ANSWER and not response.get("degradations"):
+        answer_cache.put(
+            user_id, type, file_or_folder_path, user_query, dict(response), query_embedding, started_at,
+            _cache_version(version)
+        )
+
+# ---- Retrieval ----
+def _hot_index_for(user_id, version):
+    hot = get_hot_index(user_id, version)
+    return hot if hot is not None and hot.exists() else None
+
+
+def _routed_uuids(where):
+    return where["uuid"]["$in"] if where and "uuid" in where else None
+
+
+async def vector_search(user_id, query_embedding, n_results, type, file_or_folder_path, where, version=""):
+    """Returns [(chunk_id, text, distance)] from Chroma, best first, or an error message string.
+
+    `version` selects the embedding version's chunk collection. Hot tenants are
+    searched in the in-process memory-mapped index instead.
+    """
+    hot = _hot_index_for(user_id, version)
+    if hot is not None:
+        try:
+            with stage_timer("hot_index_query"):
+                return await run_blocking(
+                    hot.search, query_embedding, n_results, type, file_or_folder_path, _routed_uuids(where)
+                )
+        except Exception as e:
+            print(f"[Hot Index Error] {e}. Falling back to Chroma.")
 
-    # Step 2: Retrieve ChromaDB collection
     try:
-        collection = chroma_client.get_collection(name=f"{user_id}_chunks")
+        collection = await run_blocking(tenancy.chunk_collection, user_id, version=version)
     except Exception as e:
         return f"[ERROR] No chunk collection found for user {user_id}: {e}"
 
-    # Step 3: Query chunks
     try:
-        results = collection.query(
+        scoped = _scoped_query(collection, query_embedding, n_results, where)
+        if await _legacy_scope(user_id, type, where):
+            hits, legacy_hits = await asyncio.gather(
+                scoped, legacy_scope_search(collection, query_embedding, type, file_or_folder_path)
+            )
+            return merge_hits(hits, legacy_hits, n_results)
+        return await scoped
+    except Exception as e:
+        return f"[ERROR] Querying Chroma failed: {e}"
+
+
+async def _scoped_query(collection, query_embedding, n_results, where):
+    with stage_timer("chroma_query"):
+        results = await run_blocking(
+            collection.query,
             query_embeddings=[query_embedding],
-            n_results=100,
-            include=["documents", "metadatas", "distances"]
+            n_results=n_results,
+            where=where,
+            include=["documents", "distances"]
         )
+    return list(zip(results["ids"][0], results["documents"][0], results["distances"][0]))
+
+
+async def _legacy_scope(user_id, type, where):
+    """True while a folder `where` may miss chunks stored without ancestor-folder metadata."""
+    if type != "folder" or where is None or "uuid" in where:
+        return False
+    try:
+        return await run_blocking(legacy_scope_pending, user_id)
     except Exception as e:
-        return f"[ERROR] Querying Chroma failed: {e}"
+        print(f"[Scope Backfill Error] {e}. Searching legacy chunks too.")
+        return True
 
-    # Step 4: Filter chunks
-    docs = []
 
-    if type == "all":
-        docs = results["documents"][0]
-    else:
-        is_folder = (type == "folder")
-        for doc, meta in zip(results["documents"][0], results["metadatas"][0]):
-            path = meta.get("file_path", "")
-            if (is_folder and path.startswith(file_or_folder_path)) or (not is_folder and path == file_or_folder_path):
-                docs.append(doc)
+async def legacy_scope_search(collection, query_embedding, type, file_or_folder_path):
+    """Global top-RAG_MAX_CANDIDATES filtered in Python, for chunks the scope's `where` cannot match
+    until utilities/backfill_folder_metadata.py has run."""
+    with stage_timer("chroma_query"):
+        results = await run_blocking(
+            collection.query,
+            query_embeddings=[query_embedding],
+            n_results=RAG_MAX_CANDIDATES,
+            include=["documents", "metadatas", "distances"]
+        )
+    return [
+        (chunk_id, doc, distance)
+        for chunk_id, doc, meta, distance in zip(
+            results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0]
+        )
+        if in_scope(meta, type, file_or_folder_path)
+    ]
+
+
+def merge_hits(hits, extra_hits, n_results):
+    """Union of two [(chunk_id, text, distance)] lists, best first, cut to n_results."""
+    merged = {hit[0]: hit for hit in extra_hits}
+    merged.update((hit[0], hit) for hit in hits)
+    return sorted(merged.values(), key=lambda hit: hit[2])[:n_results]
+
+
+async def lexical_search(user_id, user_query, type, file_or_folder_path):
+    """Returns [(chunk_id, text)] from the user's BM25 index, best first."""
+    if not HYBRID_SEARCH_ENABLED:
+        return []
+    index = get_lexical_index(user_id)
+    if not index.exists():
+        return []
+    try:
+        rows = await run_blocking(index.search, user_query, type, file_or_folder_path, LEXICAL_CANDIDATES)
+        return [(chunk_id, text) for chunk_id, text, _, _ in rows]
+    except Exception as e:
+        print(f"[Lexical Search Error] {e}")
+        return []
 
-        if not docs:
-            return f"No relevant chunks found for '{file_or_folder_path}'."
 
-    # Step 5: Rerank filtered chunks
-    reranked_docs_with_scores = rerank_chunks(user_query, docs)
+def prune_vector_hits(vector_hits, keep_min):
+    """Drops dense candidates that are clearly worse than the best one before they reach the reranker.
+
+    A hit is cut when its distance exceeds the best by RERANK_DISTANCE_MARGIN, or at the
+    first jump of more than RERANK_DISTANCE_GAP between consecutive hits. The best
+    `keep_min` hits are always kept.
+    """
+    if not vector_hits or (RERANK_DISTANCE_MARGIN <= 0 and RERANK_DISTANCE_GAP <= 0):
+        return vector_hits
+    kept = list(vector_hits[:keep_min])
+    best = vector_hits[0][2]
+    previous = kept[-1][2]
+    for hit in vector_hits[keep_min:]:
+        distance = hit[2]
+        if RERANK_DISTANCE_MARGIN > 0 and distance > best + RERANK_DISTANCE_MARGIN:
+            break
+        if RERANK_DISTANCE_GAP > 0 and distance - previous > RERANK_DISTANCE_GAP:
+            break
+        kept.append(hit)
+        previous = distance
+    return kept
+
+
+def fuse_candidates(vector_hits, lexical_hits):
+    """Reciprocal rank fusion of dense and lexical hits, capped at RERANK_MAX_CANDIDATES texts."""
+    if not lexical_hits:
+        return [doc for _, doc, _ in vector_hits[:RERANK_MAX_CANDIDATES]]
+    texts = dict(lexical_hits)
+    texts.update((chunk_id, doc) for chunk_id, doc, _ in vector_hits)
+    fused = reciprocal_rank_fusion([[i for i, _, _ in vector_hits], [i for i, _ in lexical_hits]], k=RRF_K)
+    return [texts[i] for i in fused[:RERANK_MAX_CANDIDATES]]
+
+async def retrieve_context(
+    user_id: str,
+    session_id: str,
+    user_query: str,
+    type: str,
+    file_or_folder_path: str = "",
+    top_k: int = 5,
+    query_embedding=None,
+    deadline: Deadline = None,
+    version: dict = None
+):
+    """Runs steps 1-7 of the pipeline, reusing `query_embedding` if already computed.
+    `query_embedding` must come from the model of the embedding `version` (default: the user's active one).
+
+    Optional stages are shortened or skipped to meet `deadline`; each such
+    decision is recorded in `deadline.degradations`.
+
+    Returns {"chunks": [...], "history": [...]} or an error message string.
+    """
+    deadline = deadline or Deadline(0)
+    version = version or await get_embedding_version(user_id)
+    # History does not depend on retrieval, so it loads in the background from the start.
+    history_task = asyncio.ensure_future(load_session_history(user_id, session_id))
+    try:
+        return await _retrieve(
+            user_id, user_query, type, file_or_folder_path, top_k, query_embedding, deadline, history_task, version
+        )
+    finally:
+        if not history_task.done():
+            history_task.cancel()
+
+
+async def _retrieve(user_id, user_query, type, file_or_folder_path, top_k, query_embedding, deadline, history_task,
+                    version):
+    # Step 1: Embed the query, size the requested scope and route it to files concurrently
+    query_embedding, scope_size, routed_uuids = await asyncio.gather(
+        _reuse(query_embedding) if query_embedding else get_embedding(user_query, version["model"]),
+        _get_scope_size(user_id, type, file_or_folder_path),
+        deadline.run_optional("summary_routing", route_by_summaries(user_id, user_query, type, file_or_folder_path), None)
+    )
+    if not query_embedding:
+        return "Embedding failed. Cannot process your request."
+    # Routed files already lie inside the scope, so their uuids replace the scope filter.
+    where = {"uuid": {"$in": routed_uuids}} if routed_uuids else scope_where(type, file_or_folder_path)
+
+    # Steps 2-3: Dense (Chroma) and lexical (BM25) retrieval run concurrently
+    n_results = candidate_count(scope_size, top_k)
+    vector_hits, lexical_hits = await asyncio.gather(
+        vector_search(user_id, query_embedding, n_results, type, file_or_folder_path, where, version["version"]),
+        deadline.run_optional("lexical_search", lexical_search(user_id, user_query, type, file_or_folder_path), [])
+    )
+    if isinstance(vector_hits, str):
+        return vector_hits
+
+    # Step 4: Prune weak dense hits, fuse both rankings and check the scope had matches
+    vector_hits = prune_vector_hits(vector_hits, max(top_k, RERANK_MIN_CANDIDATES))
+    docs = fuse_candidates(vector_hits, lexical_hits)
+    if type != "all" and not docs:
+        return f"No relevant chunks found for '{file_or_folder_path}'."
+
+    # Step 5: Rerank filtered chunks, falling back to retrieval order when the deadline is near
+    retrieval_order = [(doc, None) for doc in docs]
+    budget = deadline.optional_budget()
+    if budget is not None and budget * 1000 < RERANK_MIN_BUDGET_MS:
+        deadline.degrade("rerank_skipped")
+        reranked_docs_with_scores = retrieval_order
+    else:
+        if budget is not None and budget * 1000 < RERANK_FULL_BUDGET_MS and len(docs) > RERANK_DEGRADED_CANDIDATES:
+            deadline.degrade("rerank_candidates_reduced")
+            docs = docs[:RERANK_DEGRADED_CANDIDATES]
+        reranked_docs_with_scores = await deadline.run_optional(
+            "rerank", rerank_chunks(user_query, docs), retrieval_order
+        )
 
-    #  Print reranked chunks with logit scores
+    #  Print reranked chunks with logit scores
     print("\n[DEBUG] Reranked chunks sent to LLM:")
     for i, (chunk, score) in enumerate(reranked_docs_with_scores[:top_k]):
         print(f"\n[Chunk {i+1}] (logit: {score}):\n{chunk}\n---")
@@ -209,20 +554,348 @@ def rag_pipeline(
     # Extract only the chunk texts to send to LLM
     reranked_docs = [doc for doc, _ in reranked_docs_with_scores[:top_k]]
 
-    # Step 6: Get prior history
-    prior_history = get_session_history(user_id, session_id)
+    # Step 6: Get prior history (started concurrently with step 1)
+    prior_history = await deadline.run_optional("history", history_task, [])
 
-    # Step 7: Call LLM
-    answer = call_llm_rag(user_query, reranked_docs, prior_history)
-
-    # Step 8: Store full query-answer pair in Mongo
-    update_session_history(user_id, session_id, user_query, answer)
+    # Step 7: Fit chunks (best first) and recent history into the prompt's token budget
+    packed = pack_context(
+        reranked_docs, prior_history,
+        fixed_tokens=count_message_tokens(build_rag_messages(user_query, [], []))
+    )
+    print(f"[INFO] Prompt ~{packed['prompt_tokens']} tokens "
+          f"(dropped {packed['dropped_chunks']} chunks, {packed['dropped_turns']} history turns)")
 
     return {
+        "chunks": packed["chunks"],
+        "history": packed["history"],
+        "prompt_tokens": packed["prompt_tokens"],
+        "query_embedding": query_embedding
+    }
+
+# ---- Main RAG Pipeline ----
+async def rag_pipeline_async(
+    user_id: str,
+    session_id: str,
+    user_query: str,
+    type: str,
+    file_or_folder_path: str = "",
+    top_k: int = 5,
+    deadline_ms: int = None
+):
+    """Runs the full pipeline. `deadline_ms` (default RAG_DEADLINE_MS) bounds optional stages;
+    the response lists any `degradations` taken to meet it."""
+    print(f"\n[INFO] RAG for user='{user_id}', session='{session_id}', query='{user_query}'")
+    deadline = Deadline(deadline_ms)
+
+    # Step 0: Serve repeated questions in this scope from the answer cache
+    started_at = datetime.utcnow()
+    version = await get_embedding_version(user_id)
+    cached, query_embedding = await lookup_cached_answer(user_id, type, file_or_folder_path, user_query, version)
+    if cached is not None:
+        await save_turn(user_id, session_id, user_query, cached["answer"])
+        return {
+            **cached, "session_id": session_id, "query": user_query, "prompt_tokens": 0, "degradations": [], "cached": True
+        }
+
+    # Steps 1-7: Embed, retrieve, rerank, load history and pack the prompt
+    context = await retrieve_context(
+        user_id, session_id, user_query, type, file_or_folder_path, top_k, query_embedding, deadline, version
+    )
+    if isinstance(context, str):
+        return context
+
+    # Step 8: Call LLM
+    # Under load the call queues for a limiter slot for as long as the request deadline allows.
+    answer = await call_llm_rag(user_query, context["chunks"], context["history"], wait_timeout=deadline.remaining())
+
+    # Step 9: Store full query-answer pair in Mongo
+    await save_turn(user_id, session_id, user_query, answer)
+    if deadline.enabled and deadline.remaining() < 0:
+        deadline.degrade("deadline_exceeded")
+
+    response = {
+        "session_id": session_id,
+        "query": user_query,
+        "type": type,
+        "file_or_folder": file_or_folder_path,
+        "chunks_used": context["chunks"],
+        "answer": answer,
+        "prompt_tokens": context["prompt_tokens"],
+        "degradations": deadline.degradations,
+        "cached": False
+    }
+    store_cached_answer(
+        user_id, type, file_or_folder_path, user_query, response, context["query_embedding"], started_at, version
+    )
+    return response
+
+
+async def rag_pipeline_stream(
+    user_id: str,
+    session_id: str,
+    user_query: str,
+    type: str,
+    file_or_folder_path: str = "",
+    top_k: int = 5,
+    deadline_ms: int = None
+):
+    """Streaming variant of rag_pipeline_async.
+
+    Yields (event, data) pairs: one "metadata" event once retrieval is done, a
+    "token" event per LLM delta, then "done" with the full answer. History is only
+    written once the answer has streamed completely; if that write fails, the error is
+    logged and "done" is still sent. Other failures yield an "error" event.
+    """
+    print(f"\n[INFO] Streaming RAG for user='{user_id}', session='{session_id}', query='{user_query}'")
+    deadline = Deadline(deadline_ms)
+
+    started_at = datetime.utcnow()
+    version = await get_embedding_version(user_id)
+    cached, query_embedding = await lookup_cached_answer(user_id, type, file_or_folder_path, user_query, version)
+    if cached is not None:
+        yield "metadata", {
+            **_response_metadata(cached), "session_id": session_id, "query": user_query,
+            "prompt_tokens": 0, "degradations": [], "cached": True
+        }
+        yield "token", {"text": cached["answer"]}
+        try:
+            await save_turn(user_id, session_id, user_query, cached["answer"])
+        except Exception as e:
+            print(f"[Stream Persist Error] {e}")
+        yield "done", {"session_id": session_id, "answer": cached["answer"]}
+        return
+
+    context = await retrieve_context(
+        user_id, session_id, user_query, type, file_or_folder_path, top_k, query_embedding, deadline, version
+    )
+    if isinstance(context, str):
+        yield "error", {"detail": context}
+        return
+
+    metadata = {
         "session_id": session_id,
         "query": user_query,
         "type": type,
         "file_or_folder": file_or_folder_path,
-        "chunks_used": reranked_docs,
-        "answer": answer
+        "chunks_used": context["chunks"],
+        "prompt_tokens": context["prompt_tokens"],
+        "degradations": deadline.degradations,
+        "cached": False
+    }
+    yield "metadata", metadata
+
+    tokens = []
+    try:
+        async for token in stream_llm_rag(
+            user_query, context["chunks"], context["history"], wait_timeout=deadline.remaining()
+        ):
+            tokens.append(token)
+            yield "token", {"text": token}
+    except Exception as e:
+        print(f"[LLM Stream Error] {e}")
+        yield "error", {"detail": LLM_ERROR_ANSWER}
+        return
+
+    answer = "".join(tokens)
+    # Streams carry no usage block, so the counts are the tokenizer's estimates.
+    TOKENS.labels(kind="prompt").inc(context["prompt_tokens"])
+    TOKENS.labels(kind="completion").inc(count_tokens(answer))
+    try:
+        await save_turn(user_id, session_id, user_query, answer)
+        store_cached_answer(
+            user_id, type, file_or_folder_path, user_query, {**metadata, "answer": answer},
+            context["query_embedding"], started_at, version
+        )
+    except Exception as e:
+        # The client already has the whole answer, so a failed write must not end the stream in an error.
+        print(f"[Stream Persist Error] {e}")
+    yield "done", {"session_id": session_id, "answer": answer}
+
+
+# ---- Batch RAG ----
+async def vector_search_many(user_id, query_embeddings_list, n_results, type, file_or_folder_path, where, version=""):
+    """One Chroma query per RAG_BATCH_QUERY_SIZE embeddings. Returns one hit list per
+    embedding, in order, or an error message string."""
+    hot = _hot_index_for(user_id, version)
+    if hot is not None:
+        try:
+            with stage_timer("hot_index_query"):
+                return await run_blocking(hot.search_many, query_embeddings_list, n_results, type, file_or_folder_path)
+        except Exception as e:
+            print(f"[Hot Index Error] {e}. Falling back to Chroma.")
+
+    try:
+        collection = await run_blocking(tenancy.chunk_collection, user_id, version=version)
+    except Exception as e:
+        return f"[ERROR] No chunk collection found for user {user_id}: {e}"
+
+    async def query_slice(embeddings):
+        with stage_timer("chroma_query"):
+            results = await run_blocking(
+                collection.query,
+                query_embeddings=embeddings,
+                n_results=n_results,
+                where=where,
+                include=["documents", "distances"]
+            )
+        return [
+            list(zip(ids, docs, distances))
+            for ids, docs, distances in zip(results["ids"], results["documents"], results["distances"])
+        ]
+
+    try:
+        slices = await asyncio.gather(*(
+            query_slice(query_embeddings_list[i:i + RAG_BATCH_QUERY_SIZE])
+            for i in range(0, len(query_embeddings_list), RAG_BATCH_QUERY_SIZE)
+        ))
+    except Exception as e:
+        return f"[ERROR] Querying Chroma failed: {e}"
+    return [hits for part in slices for hits in part]
+
+
+async def _answer_batch_item(item, vector_hits, top_k, slots):
+    try:
+        # The whole per-query path holds a slot, so lexical search, reranking and the LLM
+        # call of a large batch queue here instead of piling up on the model rate limits.
+        async with slots:
+            return await _answer_one(item, vector_hits, top_k)
+    except Exception as e:
+        print(f"[Batch RAG Error] {e}")
+        return {**item, "error": str(e)}
+
+
+async def _answer_one(item, vector_hits, top_k):
+    user_query = item["user_query"]
+    if isinstance(vector_hits, str):
+        return {**item, "error": vector_hits}
+    if _hot_index_for(item["user_id"], item["version"]["version"]) is None and await _legacy_scope(
+            item["user_id"], item["type"], item["where"]):
+        # Same legacy-metadata merge as the single-query path.
+        try:
+            collection = await run_blocking(tenancy.chunk_collection, item["user_id"], version=item["version"]["version"])
+            legacy_hits = await legacy_scope_search(
+                collection, item["query_embedding"], item["type"], item["file_or_folder_path"]
+            )
+        except Exception as e:
+            return {**item, "error": f"[ERROR] Querying Chroma failed: {e}"}
+        vector_hits = merge_hits(vector_hits, legacy_hits, item["n_results"])
+    lexical_hits = await lexical_search(item["user_id"], user_query, item["type"], item["file_or_folder_path"])
+
+    vector_hits = prune_vector_hits(vector_hits, max(top_k, RERANK_MIN_CANDIDATES))
+    docs = fuse_candidates(vector_hits, lexical_hits)
+    if item["type"] != "all" and not docs:
+        return {**item, "error": f"No relevant chunks found for '{item['file_or_folder_path']}'."}
+
+    reranked = await rerank_chunks(user_query, docs, priority=model_client.BATCH)
+    packed = pack_context(
+        [doc for doc, _ in reranked[:top_k]], [],
+        fixed_tokens=count_message_tokens(build_rag_messages(user_query, [], []))
+    )
+    answer = await call_llm_rag(user_query, packed["chunks"], [], priority=model_client.BATCH)
+    return {
+        **item,
+        "chunks_used": packed["chunks"],
+        "answer": answer,
+        "prompt_tokens": packed["prompt_tokens"]
+    }
+
+
+def _batch_result(item):
+    result = {
+        "index": item["index"],
+        "id": item.get("id"),
+        "query": item["user_query"],
+        "type": item["type"],
+        "file_or_folder": item["file_or_folder_path"]
     }
+    for key in ("chunks_used", "answer", "prompt_tokens", "error"):
+        if key in item:
+            result[key] = item[key]
+    return result
+
+
+async def rag_batch(user_id: str, queries: list, top_k: int = 5, concurrency: int = RAG_BATCH_CONCURRENCY):
+    """Answers many independent queries for one user, yielding results as they finish.
+
+    Each query is {"user_query", "type", "file_or_folder_path", "id"?}. Queries are
+    embedded together and share one multi-embedding Chroma query per scope; at most
+    `concurrency` (capped at RAG_BATCH_MAX_CONCURRENCY) queries are reranked and
+    answered at a time. Batch
+    queries are stateless: they neither read nor write chat history or the answer cache.
+    """
+    print(f"\n[INFO] Batch RAG for user='{user_id}', {len(queries)} queries")
+    version = await get_embedding_version(user_id)
+    items = [{
+        "index": i,
+        "id": q.get("id"),
+        "user_id": user_id,
+        "user_query": q["user_query"],
+        "type": q.get("type", "all"),
+        "file_or_folder_path": q.get("file_or_folder_path") or "",
+        "version": version
+    } for i, q in enumerate(queries)]
+
+    # Step 1: Embed every query at batch priority, outside the live query cache; the service batches them.
+    embeddings = await asyncio.gather(*(
+        get_embedding(item["user_query"], version["model"], model_client.BATCH) for item in items
+    ))
+
+    # Step 2: Group queries by scope so each group is one multi-embedding Chroma query.
+    groups = {}
+    for item, embedding in zip(items, embeddings):
+        item["query_embedding"] = embedding
+        item["where"] = scope_where(item["type"], item["file_or_folder_path"])
+        if not embedding:
+            item["error"] = "Embedding failed. Cannot process your request."
+            yield _batch_result(item)
+            continue
+        groups.setdefault((item["type"], item["file_or_folder_path"]), []).append(item)
+
+    slots = asyncio.Semaphore(max(1, min(concurrency, RAG_BATCH_MAX_CONCURRENCY)))
+
+    async def run_group(group):
+        first = group[0]
+        scope_size = await _get_scope_size(user_id, first["type"], first["file_or_folder_path"])
+        n_results = candidate_count(scope_size, top_k)
+        for item in group:
+            item["n_results"] = n_results
+        hits = await vector_search_many(
+            user_id, [item["query_embedding"] for item in group], n_results,
+            first["type"], first["file_or_folder_path"], first["where"], version["version"]
+        )
+        per_item = [hits] * len(group) if isinstance(hits, str) else hits
+        return [
+            asyncio.ensure_future(_answer_batch_item(item, item_hits, top_k, slots))
+            for item, item_hits in zip(group, per_item)
+        ]
+
+    # Steps 3-5: Per query, fuse with lexical hits, rerank, pack and answer.
+    pending = [task for tasks in await asyncio.gather(*(run_group(g) for g in groups.values())) for task in tasks]
+    try:
+        for finished in asyncio.as_completed(pending):
+            yield _batch_result(await finished)
+    finally:
+        # The consumer may stop early (e.g. the HTTP client disconnected).
+        for task in pending:
+            task.cancel()
+    print(f"[INFO] Batch RAG finished for user='{user_id}'")
+
+
+def rag_pipeline(
+    user_id: str,
+    session_id: str,
+    user_query: str,
+    type: str,
+    file_or_folder_path: str = "",
+    top_k: int = 5,
+    deadline_ms: int = None
+):
+    """Synchronous entry point for scripts such as test_rag.py."""
+    async def run():
+        response = await rag_pipeline_async(
+            user_id, session_id, user_query, type, file_or_folder_path, top_k, deadline_ms
+        )
+        await wait_for_session_titles()
+        return response
+
+    return asyncio.run(run())
@@ -6,6 +6,10 @@ cd "$(dirname "$0")"
 # Export PYTHONPATH to include the current directory for module resolution
 export PYTHONPATH=$(pwd)
 
+# Workers and the API share these indexes; on a single host, keep them under the project root
+export HOT_INDEX_DIR=${HOT_INDEX_DIR:-$(pwd)/hot_index}
+export LEXICAL_INDEX_DIR=${LEXICAL_INDEX_DIR:-$(pwd)/lexical_index}
+
 echo "Starting Celery worker for text extraction..."
 python3 -m celery -A text_extraction.celery_app_config.app worker --loglevel=info -Q text_extraction_queue &
 
@@ -1,6 +1,8 @@
 # celery_app_config.py
 from celery import Celery
 
+from common.metrics import install_worker_exporter
+
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -39,4 +41,6 @@ app.conf.beat_schedule = {
 
 app.conf.timezone = 'UTC'
 
+install_worker_exporter("text_extraction")
+
 app.autodiscover_tasks(['text_extraction.tasks', 'text_extraction.docvlm_task', 'text_extraction.idp_app.tasks'])
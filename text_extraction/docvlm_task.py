@@ -7,15 +7,13 @@ import tempfile
 from pathlib import Path
 from datetime import datetime
 from base64 import b64encode
-import pandas as pd
-import pdfplumber
-from PIL import Image
-import requests
 from dotenv import load_dotenv
 load_dotenv()
 from celery import shared_task
+from common import model_client
+from common.metrics import PAGES, stage_timer, record_llm_usage
+from common.resilience import ModelCallError
 from text_extraction.mongodb_state_db import get_file_document
-from data_ingestion.worker import app, process_file
 
 # === Constants ===
 VISION_URL = os.getenv("VLM_URL")
@@ -39,12 +37,14 @@ class UniversalDocumentExtractor:
         self.logger = logging.getLogger(__name__)
 
     def _call_llm(self, prompt: str) -> str:
-        response = requests.post(TEXT_URL, json={
+        response = model_client.post("text", {
             "model": "meta/llama-3.1-70b-instruct",
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": 1024
-        }, headers={"Content-Type": "application/json"})
-        return response.json()["choices"][0]["message"]["content"]
+        })
+        body = response.json()
+        record_llm_usage(body)
+        return body["choices"][0]["message"]["content"]
 
     def _call_vision(self, image_path: str) -> str:
         prompt = (
@@ -58,25 +58,29 @@ class UniversalDocumentExtractor:
             img_data = img_file.read()
         b64_string = b64encode(img_data).decode()
 
-        response = requests.post(VISION_URL, json={
+        response = model_client.post("vlm", {
             "model": "meta/llama-3.2-11b-vision-instruct",
             "messages": [{"role": "user", "content": [
                 {"type": "text", "text": prompt},
                 {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_string}"}}
             ]}],
             "max_tokens": 2048
-        }, headers={"Content-Type": "application/json"})
-        return response.json()["choices"][0]["message"]["content"]
+        })
+        body = response.json()
+        record_llm_usage(body)
+        return body["choices"][0]["message"]["content"]
 
     def _convert_to_pdf(self, input_path: Path) -> Path:
         tmpdir = tempfile.mkdtemp()
-        subprocess.run([SOFFICE_PATH, "--headless", "--convert-to", "pdf", str(input_path), "--outdir", tmpdir], check=True)
+        with stage_timer("convert"):
+            subprocess.run([SOFFICE_PATH, "--headless", "--convert-to", "pdf", str(input_path), "--outdir", tmpdir], check=True)
         return next(Path(tmpdir).glob("*.pdf"))
 
     def _convert_pdf_to_images(self, pdf_path: Path, output_dir: Path) -> list:
+        import pdfplumber
         output_dir.mkdir(parents=True, exist_ok=True)
         images = []
-        with pdfplumber.open(pdf_path) as pdf:
+        with stage_timer("render"), pdfplumber.open(pdf_path) as pdf:
             for i, page in enumerate(pdf.pages):
                 img = page.to_image(resolution=150).original
                 img_path = output_dir / f"page_{i+1}.png"
@@ -85,6 +89,7 @@ class UniversalDocumentExtractor:
         return images
 
     def _extract_excel(self, file_path: Path) -> dict:
+        import pandas as pd
         sheets = pd.read_excel(file_path, sheet_name=None, engine="openpyxl")
         extracted = {}
         for name, df in sheets.items():
@@ -128,10 +133,16 @@ class UniversalDocumentExtractor:
             else:
                 extracted_text["error"] = "Unsupported file format"
 
+        except ModelCallError:
+            # Model backend is down or timing out: let the task retry later rather than
+            # storing an error record that would be ingested as document text.
+            raise
         except Exception as e:
             self.logger.error(f"Extraction failed for {file_path}: {str(e)}")
             extracted_text["error"] = str(e)
 
+        if "error" not in extracted_text:
+            PAGES.labels(format=ext.lstrip(".")).inc(len(extracted_text))
         return extracted_text
 
 
@@ -176,7 +187,8 @@ def docvlm_extraction_task(self, user_id: str, filepath_str: str, file_hash: str
             vlm_prompt="Extract ALL content page by page"
         )
 
-        extracted_text = extractor.extract_text_from_file(filepath)
+        with stage_timer("extract"):
+            extracted_text = extractor.extract_text_from_file(filepath)
 
         final_record = {
             "uuid": db_record.get("uuid"),
@@ -196,6 +208,8 @@ def docvlm_extraction_task(self, user_id: str, filepath_str: str, file_hash: str
         print(f"✅ ({user_id}) Successfully processed and saved metadata for {filename}.")
         print(f"   -> Results saved to: {output_path}")
 
+        # Imported here so the extraction worker does not load the ingestion stack at startup.
+        from data_ingestion.worker import process_file
         process_file.apply_async(args=[final_record])
 
     except Exception as e:
@@ -1,29 +1,21 @@
 # mongodb_state_db.py
 
-from pymongo import MongoClient, UpdateOne
-import os
+from pymongo import UpdateOne
 from typing import List, Optional, Dict, Any
 import uuid
 
+from common.resources import mongo_db
 from text_extraction.files_comparator import FileMetadata, SyncResult, SyncAction
 
-MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "test_metadata"
 
-_client = None
-_db = None
-
 def get_db():
     """Establishes a fork-safe connection to the database."""
-    global _client, _db
-    if _db is None:
-        try:
-            _client = MongoClient(MONGO_URI)
-            _db = _client[DB_NAME]
-        except Exception as e:
-            print(f"❌ Could not connect to MongoDB: {e}")
-            raise
-    return _db
+    try:
+        return mongo_db(DB_NAME)
+    except Exception as e:
+        print(f"❌ Could not connect to MongoDB: {e}")
+        raise
 
 def get_file_document(user_id: str, file_path: str) -> Optional[Dict[str, Any]]:
     """
@@ -2,27 +2,27 @@
 import uuid
 import hashlib
 from datetime import datetime, timezone
-import os
 
-from pymongo import MongoClient
-import chromadb
+from common.resources import mongo_db, local_chroma_client
 
-# --- MODIFIED LINE ---
-# Update this URI to match the one in mongodb_state_db.py
-MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "rag_pipeline_db"
 METADATA_COLLECTION = "document_metadata"
 PROCESSED_JSON_COLLECTION = "processed_json_files"
+VECTOR_COLLECTION = "document_vectors"
+DELETE_BATCH_SIZE = 1000
 
-# --- Database Clients (Initialized once per process) ---
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-metadata_col = db[METADATA_COLLECTION]
-processed_json_col = db[PROCESSED_JSON_COLLECTION]
 
-# This assumes your vector DB is local and doesn't need the auth
-chroma_client = chromadb.PersistentClient(path="./rag_local_db")
-vector_collection = chroma_client.get_or_create_collection("document_vectors")
+# --- Database Clients (opened on first use, shared per process; see common/resources.py) ---
+
+def metadata_col():
+    return mongo_db(DB_NAME)[METADATA_COLLECTION]
+
+def processed_json_col():
+    return mongo_db(DB_NAME)[PROCESSED_JSON_COLLECTION]
+
+def vector_collection():
+    # This assumes your vector DB is local and doesn't need the auth
+    return local_chroma_client().get_or_create_collection(VECTOR_COLLECTION)
 
 
 # === 1. UUID & Hashing Functions ===
@@ -44,11 +44,11 @@ def compute_file_hash(filepath):
 
 def check_if_json_is_processed(json_content_hash):
     """Checks MongoDB to see if a JSON file with this exact content has already been processed."""
-    return processed_json_col.find_one({"_id": json_content_hash}) is not None
+    return processed_json_col().find_one({"_id": json_content_hash}) is not None
 
 def log_processed_json(json_filename, json_content_hash):
     """Logs a record that a JSON file has been successfully processed."""
-    processed_json_col.update_one(
+    processed_json_col().update_one(
         {"_id": json_content_hash},
         {"$set": {"filename": json_filename, "processed_time": datetime.now(timezone.utc)}},
         upsert=True
@@ -59,7 +59,7 @@ def log_processed_json(json_filename, json_content_hash):
 
 def add_document_metadata_to_mongo(doc_id, user_id, doc_filename, chunk_count):
     """Adds or updates the metadata for a single document in MongoDB."""
-    metadata_col.update_one(
+    metadata_col().update_one(
         {"_id": doc_id},
         {"$set": {
             "user_id": user_id,
@@ -83,7 +83,7 @@ def insert_embeddings_to_chroma(doc_id, embeddings, chunks):
             "chunk_index": i
         })
         
-    vector_collection.upsert(
+    vector_collection().upsert(
         ids=ids,
         embeddings=embeddings,
         documents=chunks,
@@ -99,7 +99,7 @@ def delete_document_from_all_dbs(user_id, doc_filename):
     print(f"🔥 Deleting document '{doc_filename}' for user '{user_id}'...")
     
     # Find the document in MongoDB to get its ID
-    doc_record = metadata_col.find_one({"user_id": user_id, "filename": doc_filename})
+    doc_record = metadata_col().find_one({"user_id": user_id, "filename": doc_filename})
     
     if not doc_record:
         print(f"  -> Document not found in MongoDB. Nothing to delete.")
@@ -107,10 +107,14 @@ def delete_document_from_all_dbs(user_id, doc_filename):
 
     doc_id = doc_record["_id"]
 
-    # Delete vectors from ChromaDB using the document_id
-    vector_collection.delete(where={"document_id": doc_id})
-    print(f"  -> Deleted vectors from ChromaDB.")
+    # Chunk ids are `{doc_id}_{i}`, so the stored chunk_count is the document's manifest;
+    # deleting by id avoids a metadata scan in ChromaDB.
+    chunk_ids = [f"{doc_id}_{i}" for i in range(doc_record.get("chunk_count", 0))]
+    collection = vector_collection()
+    for start in range(0, len(chunk_ids), DELETE_BATCH_SIZE):
+        collection.delete(ids=chunk_ids[start:start + DELETE_BATCH_SIZE])
+    print(f"  -> Deleted {len(chunk_ids)} vectors from ChromaDB.")
 
     # Delete metadata record from MongoDB
-    metadata_col.delete_one({"_id": doc_id})
+    metadata_col().delete_one({"_id": doc_id})
     print(f"  -> Deleted metadata from MongoDB.")
\ No newline at end of file
@@ -7,6 +7,7 @@ from pathlib import Path
 from typing import List
 
 from celery import shared_task
+from common.metrics import stage_timer
 from text_extraction.mongodb_state_db import get_user_file_states, apply_sync_results
 from text_extraction.docvlm_task import docvlm_extraction_task
 from text_extraction.files_comparator import FileMetadata, FileSyncComparator, SyncResult, SyncAction
@@ -18,7 +19,7 @@ SOURCE_DATA_PATH = Path(__file__).parent / "source_documents"
 def get_file_sha256(filepath: Path) -> str:
     """Calculates the SHA-256 hash of a file's content."""
     sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
+    with stage_timer("hash"), open(filepath, "rb") as f:
         for byte_block in iter(lambda: f.read(4096), b""):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
@@ -72,7 +73,8 @@ def scan_user_files_task(user_id: str):
     user_files_path = SOURCE_DATA_PATH / user_id / "files"
 
     # 1. Get current state from the filesystem and database
-    fs_files = _scan_user_disk_files(user_id, user_files_path)
+    with stage_timer("scan"):
+        fs_files = _scan_user_disk_files(user_id, user_files_path)
     db_files = get_user_file_states(user_id)
 
     # 2. Compare the two states to get a list of actions
@@ -87,6 +89,7 @@ def scan_user_files_task(user_id: str):
     apply_sync_results(user_id, sync_results)
 
     # 4. Queue tasks based on the actions
+    deleted_paths = []
     for result in sync_results:
         meta = result.file_metadata
         if result.action in [SyncAction.ADD, SyncAction.UPDATE]:
@@ -94,18 +97,10 @@ def scan_user_files_task(user_id: str):
             docvlm_extraction_task.delay(user_id, meta.file_path, meta.sha256)
             
         elif result.action == SyncAction.DELETE:
-            print(f" U-Task ({user_id}): Queuing '{meta.file_name}' for deletion from vector DB.")
-            from data_ingestion.worker import process_file
-            payload = {
-                "user_id": user_id,
-                "file_name": meta.file_name,
-                "file_path": meta.file_path,
-                "folder_path": meta.folder_path,
-                "extension": meta.extension,
-                "last_modified": meta.last_modified,
-                "sha256": meta.sha256,
-                "size_bytes": meta.size_bytes,
-                "status": "deleted",
-                "uuid": getattr(meta, "uuid", None) or "",  # Use empty string if uuid not present
-            }
-            process_file.delay(payload)
+            deleted_paths.append(meta.file_path)
+
+    # Deletions (e.g. a removed folder) go out as one id-based bulk delete instead of a task per file.
+    if deleted_paths:
+        print(f" U-Task ({user_id}): Queuing {len(deleted_paths)} file(s) for deletion from vector DB.")
+        from data_ingestion.worker import bulk_delete_files
+        bulk_delete_files.delay(user_id, deleted_paths)
@@ -0,0 +1,78 @@
+# backfill_folder_metadata.py
+# Adds the ancestor-folder keys (folder_1, folder_2, ...) to chunks and summaries
+# stored in ChromaDB before folder scopes became a metadata filter. Until this has
+# run, folder-scoped queries also search a filtered global top-N; recording it as
+# complete switches that off (see common/scope_backfill.py).
+import argparse
+from pathlib import PurePosixPath
+
+from common.embedding_versions import write_versions
+from common.scope import folder_ancestor_metadata
+from common.scope_backfill import ALL_USERS, mark_complete
+from common.tenancy import chunk_collection, get_registry, summary_collection
+
+PAGE_SIZE = 1000
+
+
+def backfill_collection(collection, dry_run: bool = False) -> int:
+    """Updates every entry whose metadata lacks one of its ancestor keys. Returns how many."""
+    updated, offset = 0, 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=PAGE_SIZE, offset=offset)
+        if not page["ids"]:
+            return updated
+        ids, metadatas = [], []
+        for chunk_id, meta in zip(page["ids"], page["metadatas"]):
+            meta = meta or {}
+            file_path = meta.get("file_path")
+            ancestors = folder_ancestor_metadata(
+                meta.get("folder_path") or (str(PurePosixPath(file_path).parent) if file_path else "")
+            )
+            if any(meta.get(key) != value for key, value in ancestors.items()):
+                ids.append(chunk_id)
+                metadatas.append({**meta, **ancestors})
+        if ids and not dry_run:
+            collection.update(ids=ids, metadatas=metadatas)
+        updated += len(ids)
+        offset += PAGE_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add ancestor-folder metadata to existing Chroma chunks and summaries.")
+    parser.add_argument("--user", help="Only backfill this user. Defaults to every user with chunks in Chroma.")
+    parser.add_argument("--dry-run", action="store_true", help="Count the entries to update without writing them.")
+    args = parser.parse_args()
+
+    users = [args.user] if args.user else get_registry().list_users()
+
+    failed = 0
+    for user_id in users:
+        try:
+            # Ingestion writes to the standby version too, so both must be scoped correctly.
+            collections = [chunk_collection(user_id, version=v["version"]) for v in write_versions(user_id)]
+            try:
+                collections.append(summary_collection(user_id))
+            except Exception as e:
+                print(f"  - {user_id}: no summaries ({e})")
+            counts = [backfill_collection(collection, args.dry_run) for collection in collections]
+        except Exception as e:
+            print(f"❌ Backfill failed for {user_id}: {e}")
+            failed += 1
+            continue
+        print(f"  - {user_id}: {'would update' if args.dry_run else 'updated'} {sum(counts)} entries")
+        if not args.dry_run:
+            mark_complete(user_id)
+
+    if args.dry_run:
+        print(f"\n✅ Dry run finished for {len(users)} users.")
+    elif failed:
+        print(f"\n❌ {failed} users failed; re-run before folder queries stop searching legacy chunks.")
+    else:
+        if not args.user:
+            # Users ingested from now on get the keys from the start.
+            mark_complete(ALL_USERS)
+        print(f"\n✅ Backfilled folder metadata for {len(users)} users.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# build_hot_index.py
+# Builds the memory-mapped vector index for hot tenants from chunks already stored
+# in ChromaDB. Ingestion keeps the index current from then on; this is needed once
+# when a user is added to HOT_INDEX_USERS. The index is built for the user's active
+# embedding version, which is the one queries read.
+import argparse
+
+from common.embedding_versions import active_version
+from common.hot_index import HotIndex, HOT_INDEX_USERS
+from common.tenancy import chunk_collection
+
+PAGE_SIZE = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build hot-tenant vector indexes from existing Chroma chunk collections.")
+    parser.add_argument("--user", help="Only build this user's index. Defaults to every user in HOT_INDEX_USERS.")
+    args = parser.parse_args()
+
+    users = [args.user] if args.user else sorted(HOT_INDEX_USERS)
+    if not users:
+        print("❌ No users given and HOT_INDEX_USERS is empty.")
+        return
+
+    for user_id in users:
+        version = active_version(user_id)["version"]
+        try:
+            collection = chunk_collection(user_id, version=version)
+        except Exception as e:
+            print(f"❌ No chunk collection for {user_id}: {e}")
+            continue
+        index = HotIndex(user_id, version=version)
+        total, offset = 0, 0
+        while True:
+            page = collection.get(include=["embeddings", "documents", "metadatas"], limit=PAGE_SIZE, offset=offset)
+            if not len(page["ids"]):
+                break
+            index.upsert(page["ids"], page["embeddings"], page["documents"], page["metadatas"])
+            total += len(page["ids"])
+            offset += PAGE_SIZE
+        print(f"  - {user_id}: indexed {total} chunks")
+
+    print(f"\n✅ Built hot indexes for {len(users)} users.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# build_lexical_index.py
+# Builds the per-user lexical (BM25) index from chunks already stored in ChromaDB.
+# Ingestion keeps the index current from then on; this is only needed once for
+# users whose documents were ingested before hybrid search existed.
+import argparse
+
+from common.embedding_versions import active_version
+from common.lexical_index import get_lexical_index
+from common.tenancy import chunk_collection, get_registry
+
+PAGE_SIZE = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build lexical indexes from existing Chroma chunk collections.")
+    parser.add_argument("--user", help="Only build this user's index. Defaults to every user with chunks in Chroma.")
+    args = parser.parse_args()
+
+    users = [args.user] if args.user else get_registry().list_users()
+
+    for user_id in users:
+        try:
+            # Chunk texts are the same in every embedding version; read the one being served.
+            collection = chunk_collection(user_id, version=active_version(user_id)["version"])
+        except Exception as e:
+            print(f"❌ No chunk collection for {user_id}: {e}")
+            continue
+        index = get_lexical_index(user_id)
+        total, offset = 0, 0
+        while True:
+            page = collection.get(include=["documents", "metadatas"], limit=PAGE_SIZE, offset=offset)
+            if not page["ids"]:
+                break
+            index.upsert_chunks(page["ids"], page["documents"], page["metadatas"])
+            total += len(page["ids"])
+            offset += PAGE_SIZE
+        print(f"  - {user_id}: indexed {total} chunks")
+
+    print(f"\n✅ Built lexical indexes for {len(users)} users.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# migrate_chat_history.py
+# Moves chat history from rag_db.chat_history (one document per user with a
+# `sessions` array) into rag_db.chat_sessions and rag_db.chat_turns.
+# Safe to re-run. Sessions that already have turns in the new layout are skipped
+# and reported, and their per-user document is kept even with --drop-old.
+import argparse
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = "rag_db"
+OLD_COLLECTION = "chat_history"
+BATCH_SIZE = 500
+
+
+def write_batches(collection, ops):
+    for start in range(0, len(ops), BATCH_SIZE):
+        try:
+            collection.bulk_write(ops[start:start + BATCH_SIZE], ordered=False)
+        except BulkWriteError as e:
+            # A session that already exists fails its upsert guard with a duplicate key; that is expected.
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate per-user chat history to per-session and per-turn documents.")
+    parser.add_argument("--user", help="Only migrate this user. Defaults to all users.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    parser.add_argument("--drop-old", action="store_true", help="Delete migrated per-user documents afterwards.")
+    args = parser.parse_args()
+
+    try:
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+    except Exception as e:
+        print(f"❌ Could not connect to MongoDB: {e}")
+        return
+
+    old = db[OLD_COLLECTION]
+    if not args.dry_run:
+        db["chat_sessions"].create_index([("user_id", 1), ("session_id", 1)], unique=True)
+        db["chat_sessions"].create_index([("user_id", 1), ("updated_at", -1)])
+        db["chat_turns"].create_index([("user_id", 1), ("session_id", 1), ("turn", 1)], unique=True)
+    query = {"user_id": args.user} if args.user else {}
+    users, sessions, turns, skipped = 0, 0, 0, 0
+
+    for user_doc in old.find(query):
+        user_id = user_doc["user_id"]
+        legacy = {session["session_id"]: session for session in user_doc.get("sessions", [])}
+        session_ops = []
+        for session_id, session in legacy.items():
+            history = session.get("history", [])
+            created_at = session.get("created_at", datetime.utcnow())
+            # Only creates sessions that have no turns in the new layout yet. The turn count is
+            # reserved with $inc, as append_turn does, so new turns are numbered after these.
+            session_ops.append(UpdateOne(
+                {"user_id": user_id, "session_id": session_id, "turn_count": {"$exists": False}},
+                {
+                    "$inc": {"turn_count": len(history)},
+                    "$setOnInsert": {
+                        "objective": session.get("objective", ""),
+                        "created_at": created_at,
+                        "updated_at": created_at,
+                        "migrated_turns": len(history)
+                    }
+                },
+                upsert=True
+            ))
+        if not args.dry_run:
+            write_batches(db["chat_sessions"], session_ops)
+
+        # Sessions without `migrated_turns` were started in the new layout and already have
+        # their own turns 1..n; migrating into them would collide, so they are left alone.
+        existing = {
+            s["session_id"]: s.get("migrated_turns")
+            for s in db["chat_sessions"].find(
+                {"user_id": user_id, "session_id": {"$in": list(legacy)}}, {"_id": 0, "session_id": 1, "migrated_turns": 1}
+            )
+        }
+        conflicts = [sid for sid in legacy if sid in existing and existing[sid] is None]
+        turn_ops = []
+        for session_id, session in legacy.items():
+            if session_id in conflicts:
+                continue
+            created_at = session.get("created_at", datetime.utcnow())
+            for turn, item in enumerate(session.get("history", []), start=1):
+                turn_ops.append(UpdateOne(
+                    {"user_id": user_id, "session_id": session_id, "turn": turn},
+                    {"$setOnInsert": {"query": item["query"], "answer": item["answer"], "created_at": created_at}},
+                    upsert=True
+                ))
+        users += 1
+        sessions += len(legacy) - len(conflicts)
+        turns += len(turn_ops)
+        skipped += len(conflicts)
+        print(f"  - {user_id}: {len(legacy) - len(conflicts)} sessions, {len(turn_ops)} turns"
+              + (f", skipped {len(conflicts)} already in the new layout: {', '.join(conflicts)}" if conflicts else ""))
+
+        if args.dry_run:
+            continue
+        write_batches(db["chat_turns"], turn_ops)
+        if args.drop_old and not conflicts:
+            old.delete_one({"_id": user_doc["_id"]})
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"\n✅ {action} {sessions} sessions and {turns} turns for {users} users.")
+    if skipped:
+        print(f"❌ Skipped {skipped} sessions that already have turns in the new layout; "
+              f"their per-user documents were kept.")
+
+
+if __name__ == "__main__":
+    main()
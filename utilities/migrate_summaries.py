@@ -0,0 +1,69 @@
+# migrate_summaries.py
+# Moves summaries from summary_db.collection_of_summaries (one document per user
+# with a growing `files` array) into summary_db.file_summaries (one document per file).
+import argparse
+import os
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = "summary_db"
+OLD_COLLECTION = "collection_of_summaries"
+NEW_COLLECTION = "file_summaries"
+BATCH_SIZE = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate per-user summary documents to per-file documents.")
+    parser.add_argument("--user", help="Only migrate this user. Defaults to all users.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    parser.add_argument("--drop-old", action="store_true", help="Delete migrated per-user documents afterwards.")
+    args = parser.parse_args()
+
+    try:
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+    except Exception as e:
+        print(f"❌ Could not connect to MongoDB: {e}")
+        return
+
+    old = db[OLD_COLLECTION]
+    new = db[NEW_COLLECTION]
+    if not args.dry_run:
+        new.create_index([("user_id", 1), ("file_path", 1)], unique=True)
+        new.create_index("uuid")
+
+    query = {"user_id": args.user} if args.user else {}
+    users, files = 0, 0
+
+    for user_doc in old.find(query):
+        user_id = user_doc["user_id"]
+        operations = []
+        for entry in user_doc.get("files", []):
+            doc = {"user_id": user_id, **entry}
+            # $setOnInsert keeps any summary ingestion has already written in the new layout.
+            operations.append(UpdateOne(
+                {"user_id": user_id, "file_path": entry.get("file_path", "")},
+                {"$setOnInsert": doc},
+                upsert=True
+            ))
+        files += len(operations)
+        users += 1
+        print(f"  - {user_id}: {len(operations)} file summaries")
+
+        if args.dry_run:
+            continue
+        for start in range(0, len(operations), BATCH_SIZE):
+            new.bulk_write(operations[start:start + BATCH_SIZE], ordered=False)
+        if args.drop_old:
+            old.delete_one({"_id": user_doc["_id"]})
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"\n✅ {action} {files} file summaries for {users} users into '{NEW_COLLECTION}'.")
+
+
+if __name__ == "__main__":
+    main()
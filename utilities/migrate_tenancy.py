@@ -0,0 +1,91 @@
+# migrate_tenancy.py
+# Copies users' chunk and summary vectors from one Chroma tenancy layout to another
+# (see common/tenancy.py), e.g. from per-user collections to shared shards:
+#   python3 -m utilities.migrate_tenancy --from collection --to shared
+# Stored embeddings are copied as-is, nothing is re-embedded. Upserts make the copy
+# safe to re-run; set CHROMA_TENANCY to the new layout once it has finished.
+import argparse
+
+from common.embedding_versions import active_version
+from common.tenancy import CollectionRegistry, CHUNKS, KINDS, TENANCY_MODES, CHROMA_TENANCY
+
+PAGE_SIZE = 1000
+
+
+def copy_user(source, target, user_id, dry_run):
+    """Returns {kind: records copied} for one user. Chunks are copied for the user's active
+    embedding version only; retire or finish a re-embed before migrating."""
+    copied = {}
+    for kind in KINDS:
+        version = active_version(user_id)["version"] if kind == CHUNKS else ""
+        try:
+            src = source.get(user_id, kind, version=version)
+        except Exception:
+            copied[kind] = 0
+            continue
+        dst = None if dry_run else target.get(user_id, kind, create=True, version=version)
+        total, offset = 0, 0
+        while True:
+            page = src.get(include=["embeddings", "documents", "metadatas"], limit=PAGE_SIZE, offset=offset)
+            if not len(page["ids"]):
+                break
+            if dst is not None:
+                dst.upsert(
+                    ids=page["ids"], embeddings=page["embeddings"],
+                    documents=page["documents"], metadatas=page["metadatas"]
+                )
+            total += len(page["ids"])
+            offset += PAGE_SIZE
+        copied[kind] = total
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate Chroma vectors between tenancy layouts.")
+    parser.add_argument("--from", dest="source", default=CHROMA_TENANCY, choices=TENANCY_MODES,
+                        help="Current layout. Defaults to CHROMA_TENANCY.")
+    parser.add_argument("--to", dest="target", required=True, choices=TENANCY_MODES, help="New layout.")
+    parser.add_argument("--user", help="Only migrate this user. Defaults to every user in the current layout.")
+    parser.add_argument("--dry-run", action="store_true", help="Count what would be copied without writing.")
+    parser.add_argument("--drop-old", action="store_true",
+                        help="Delete each user's data from the old layout once it has been copied and verified.")
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        print("❌ --from and --to are the same layout.")
+        return
+
+    source = CollectionRegistry(args.source)
+    target = CollectionRegistry(args.target)
+    users = [args.user] if args.user else source.list_users()
+    print(f"Migrating {len(users)} users from '{args.source}' to '{args.target}'" + (" (dry run)" if args.dry_run else ""))
+
+    failed = []
+    for user_id in users:
+        try:
+            copied = copy_user(source, target, user_id, args.dry_run)
+        except Exception as e:
+            print(f"❌ {user_id}: {e}")
+            failed.append(user_id)
+            continue
+        print(f"  - {user_id}: " + ", ".join(f"{n} {kind}" for kind, n in copied.items()))
+        if args.drop_old and not args.dry_run:
+            version = active_version(user_id)["version"]
+            counts = {
+                kind: target.get(user_id, kind, create=True, version=version if kind == CHUNKS else "").count()
+                for kind in KINDS
+            }
+            if all(counts[kind] >= copied[kind] for kind in KINDS):
+                source.drop_user(user_id, version)
+            else:
+                print(f"❌ {user_id}: target has {counts}, expected {copied}. Keeping the old data.")
+                failed.append(user_id)
+
+    if failed:
+        print(f"\n❌ {len(failed)} users need another run: {', '.join(failed)}")
+    else:
+        print(f"\n✅ Migrated {len(users)} users.")
+
+
+if __name__ == "__main__":
+    main()
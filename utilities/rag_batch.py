@@ -0,0 +1,65 @@
+# rag_batch.py
+# Runs many RAG queries for one user in-process and writes one JSON result per line.
+# Input is JSON lines; each record's question is read from --query-field, e.g.
+#   python3 -m utilities.rag_batch --user darshan --input questions.jsonl --output answers.jsonl
+import argparse
+import asyncio
+import json
+import time
+
+from rag_query_pipeline import rag_batch, RAG_BATCH_CONCURRENCY
+
+CHUNK_SIZE = 500
+
+
+def read_queries(path, args):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {
+                "id": str(record.get(args.id_field, line_no)),
+                "user_query": record[args.query_field],
+                "type": record.get("type", args.type),
+                "file_or_folder_path": record.get("file_or_folder_path", args.path)
+            }
+
+
+async def run(args, out):
+    started, done, failed = time.time(), 0, 0
+    queries = read_queries(args.input, args)
+    while True:
+        # Bounded slices keep memory flat for large evaluation sets.
+        chunk = [q for _, q in zip(range(CHUNK_SIZE), queries)]
+        if not chunk:
+            break
+        async for result in rag_batch(args.user, chunk, top_k=args.top_k, concurrency=args.concurrency):
+            result.pop("index", None)
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            done += 1
+            failed += "error" in result
+    elapsed = time.time() - started
+    print(f"\n✅ {done} queries ({failed} failed) in {elapsed:.1f}s, {done / max(elapsed, 1e-9):.2f} queries/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSON-lines file of questions with the RAG pipeline.")
+    parser.add_argument("--user", required=True, help="User whose documents are searched.")
+    parser.add_argument("--input", required=True, help="JSON-lines file of questions.")
+    parser.add_argument("--output", required=True, help="Where to write JSON-lines results.")
+    parser.add_argument("--query-field", default="user_query", help="Record field holding the question.")
+    parser.add_argument("--id-field", default="id", help="Record field copied to each result as `id`.")
+    parser.add_argument("--type", default="all", choices=["all", "file", "folder"], help="Default scope type.")
+    parser.add_argument("--path", default="", help="Default file or folder path for the scope.")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=RAG_BATCH_CONCURRENCY, help="Queries reranked and answered at a time.")
+    args = parser.parse_args()
+
+    with open(args.output, "w", encoding="utf-8") as out:
+        asyncio.run(run(args, out))
+
+
+if __name__ == "__main__":
+    main()
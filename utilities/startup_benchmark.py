@@ -0,0 +1,90 @@
+# startup_benchmark.py
+# Measures how long each service entry point takes to import in a fresh interpreter:
+# what a new Celery worker child, an autoscaled worker or a `uvicorn --reload` restart
+# pays before it can serve. Clients and heavy libraries (chromadb, langchain, numpy, pandas,
+# pdfplumber, tiktoken) are loaded on first use, so none of them should show up here.
+#   python3 -m utilities.startup_benchmark [--runs 5] [--budget 1.0] [--top 10]
+import argparse
+import statistics
+import subprocess
+import sys
+
+ENTRY_MODULES = [
+    "app",
+    "rag_query_pipeline",
+    "data_ingestion.worker",
+    "text_extraction.celery_app_config",
+    "text_extraction.tasks",
+]
+HEAVY_MODULES = ["chromadb", "langchain", "numpy", "pandas", "pdfplumber", "PIL", "tiktoken"]
+
+_TIMER = (
+    "import sys, time\n"
+    "start = time.perf_counter()\n"
+    "import {module}\n"
+    "elapsed = time.perf_counter() - start\n"
+    "heavy = [m for m in {heavy!r} if m in sys.modules]\n"
+    "print(f\"{{elapsed}}|{{','.join(heavy)}}\")\n"
+)
+
+
+def time_import(module: str):
+    """(seconds, heavy modules loaded) for one import in a new interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-c", _TIMER.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+    # Modules may print while importing, so the measurement is the last line.
+    elapsed, heavy = result.stdout.strip().splitlines()[-1].split("|")
+    return float(elapsed), [m for m in heavy.split(",") if m]
+
+
+def slowest_imports(module: str, top: int):
+    """The `top` imports with the highest cumulative time, from `python -X importtime`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[1:top + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time cold imports of the API and worker entry points.")
+    parser.add_argument("--module", action="append", help="Module to time. Defaults to every entry point.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module; the median is reported.")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds a module may take to import.")
+    parser.add_argument("--top", type=int, default=0, help="Also list each module's N slowest imports.")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.module or ENTRY_MODULES:
+        try:
+            runs = [time_import(module) for _ in range(max(args.runs, 1))]
+        except Exception as e:
+            print(f"❌ {module}: {e}")
+            over_budget.append(module)
+            continue
+        median = statistics.median(elapsed for elapsed, _ in runs)
+        heavy = runs[-1][1]
+        ok = median <= args.budget and not heavy
+        print(f"{'✅' if ok else '❌'} {module}: {median:.3f}s"
+              + (f" (loads {', '.join(heavy)} at import)" if heavy else ""))
+        if not ok:
+            over_budget.append(module)
+        for seconds, name in slowest_imports(module, args.top) if args.top else []:
+            print(f"      {seconds:.3f}s  {name}")
+
+    if over_budget:
+        print(f"\n❌ {len(over_budget)} entry points over the {args.budget:.2f}s budget: {', '.join(over_budget)}")
+        sys.exit(1)
+    print(f"\n✅ All entry points import within {args.budget:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()